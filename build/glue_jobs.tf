@@ -45,7 +45,7 @@ resource "aws_iam_role_policy_attachment" "glue_policy_attachment" {
 
 resource "null_resource" "upload_unzip_script" {
   provisioner "local-exec" {
-    command = "aws s3 cp ../src/unzip_job.py s3://${aws_s3_bucket.gdelt_project.bucket}/dependencies/unzip_job.py"
+    command = "aws s3 cp ../src/unzip_job.py s3://${aws_s3_bucket.gdelt_project.bucket}/dependencies/unzip_job.py && aws s3 cp ../src/s3_json.py s3://${aws_s3_bucket.gdelt_project.bucket}/dependencies/s3_json.py && aws s3 cp ../src/date_shards.py s3://${aws_s3_bucket.gdelt_project.bucket}/dependencies/date_shards.py"
   }
 
   depends_on = [
@@ -66,6 +66,7 @@ resource "aws_glue_job" "gdelt_glue_job" {
     "--TempDir"                = "s3://${aws_s3_bucket.gdelt_project.bucket}/temp/"
     "--job-bookmark-option"    = "job-bookmark-enable"
     "--enable-glue-datacatalog" = "true"
+    "--extra-py-files"         = "s3://${aws_s3_bucket.gdelt_project.bucket}/dependencies/s3_json.py,s3://${aws_s3_bucket.gdelt_project.bucket}/dependencies/date_shards.py"
   }
   max_capacity = 3.0
 
@@ -0,0 +1,153 @@
+"""Vectorized one-step forecasts of every (country, metric) series at once.
+
+An alternative to fitting a statsmodels ARIMA per series: all series are stacked
+into one left-padded matrix and each candidate model (historical mean, naive,
+drift, simple exponential smoothing and AR(p) by least squares) is fitted to
+every row with array operations. As in forecast_metrics, the last point of each
+series is held out and each series keeps the candidate with the lowest error on it.
+"""
+
+import numpy as np
+
+import weekly_metrics
+
+# AR orders fitted by batched least squares, each with an intercept
+AR_ORDERS = (1, 2)
+# Smoothing constants tried for SES; each series keeps the one with the lowest in-sample one-step error
+SES_ALPHAS = np.linspace(0.1, 0.9, 9)
+# Small ridge term keeping the normal equations solvable for flat or very short series
+RIDGE = 1e-8
+
+MODEL_NAMES = ['mean', 'naive', 'drift', 'ses'] + [f'ar{p}' for p in AR_ORDERS]
+
+
+def stack_series(series_by_country):
+    """Stack every (country, metric) series into a left-padded float matrix
+
+    Returns (keys, values, mask), where keys[i] is the (country, metric) of row i
+    and mask marks the observed points. Rows are right-aligned, so the last point
+    of every series (the one forecast_series holds out) is in the last column.
+    """
+    keys = []
+    rows = []
+    for country, data in series_by_country.items():
+        for metric in weekly_metrics.METRIC_COLUMNS:
+            y = np.asarray(data[metric], dtype=np.float64)
+            y = y[~np.isnan(y)]
+            keys.append((country, metric))
+            rows.append(y)
+    length = max((len(y) for y in rows), default=0)
+    values = np.full((len(rows), length), np.nan)
+    for index, y in enumerate(rows):
+        if len(y):
+            values[index, length - len(y):] = y
+    return keys, values, ~np.isnan(values)
+
+
+def mean_forecast(values, mask):
+    """ARIMA(0,0,0): the mean of the observed points"""
+    counts = mask.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(mask, values, 0.0).sum(axis=1) / counts
+
+
+def naive_forecast(values, mask):
+    """ARIMA(0,1,0): the last observed point"""
+    return values[:, -1]
+
+
+def drift_forecast(values, mask):
+    """ARIMA(0,1,0) with a constant: the last point plus the average step"""
+    counts = mask.sum(axis=1)
+    first = values[np.arange(len(values)), np.argmax(mask, axis=1)] if values.size else values[:, 0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (values[:, -1] - first) / (counts - 1)
+    return np.where(counts >= 2, values[:, -1] + slope, np.nan)
+
+
+def ses_forecast(values, mask):
+    """Simple exponential smoothing, with the constant chosen per row from SES_ALPHAS"""
+    rows = len(values)
+    alphas = SES_ALPHAS[np.newaxis, :]
+    level = np.full((rows, len(SES_ALPHAS)), np.nan)
+    sse = np.zeros((rows, len(SES_ALPHAS)))
+    for column in range(values.shape[1]):
+        observed = mask[:, column][:, np.newaxis]
+        y = values[:, column][:, np.newaxis]
+        started = ~np.isnan(level)
+        error = np.where(observed & started, y - level, 0.0)
+        sse += error ** 2
+        updated = np.where(started, level + alphas * (y - level), y)
+        level = np.where(observed, updated, level)
+    best_alpha = np.argmin(sse, axis=1)
+    forecast = level[np.arange(rows), best_alpha]
+    return np.where(mask.sum(axis=1) >= 2, forecast, np.nan)
+
+
+def ar_forecast(values, mask, p):
+    """AR(p) with intercept fitted to every row at once through batched normal equations"""
+    rows, length = values.shape
+    if length <= p + 1:
+        return np.full(rows, np.nan)
+    # Design rows: [1, y[t-1], ..., y[t-p]] -> y[t], for every t with p predecessors
+    targets = values[:, p:]
+    lags = np.stack([values[:, p - lag:length - lag] for lag in range(1, p + 1)], axis=2)
+    valid = mask[:, p:] & np.all(np.stack([mask[:, p - lag:length - lag] for lag in range(1, p + 1)], axis=2), axis=2)
+    design = np.concatenate([np.ones(lags.shape[:2] + (1,)), lags], axis=2)
+    design = np.where(valid[:, :, np.newaxis], design, 0.0)
+    targets = np.where(valid, targets, 0.0)
+
+    gram = np.einsum('stk,stl->skl', design, design) + RIDGE * np.eye(p + 1)
+    moment = np.einsum('stk,st->sk', design, targets)
+    coefficients = np.linalg.solve(gram, moment[:, :, np.newaxis])[:, :, 0]
+
+    latest = np.concatenate([np.ones((rows, 1)), values[:, ::-1][:, :p]], axis=1)
+    forecast = np.einsum('sk,sk->s', coefficients, latest)
+    # Need more equations than coefficients, otherwise the fit is exact and the forecast meaningless
+    return np.where(valid.sum(axis=1) > p + 1, forecast, np.nan)
+
+
+def candidate_forecasts(values, mask):
+    """One-step forecasts of every model for every row, as a (rows, models) matrix"""
+    forecasts = [
+        mean_forecast(values, mask),
+        naive_forecast(values, mask),
+        drift_forecast(values, mask),
+        ses_forecast(values, mask),
+    ] + [ar_forecast(values, mask, p) for p in AR_ORDERS]
+    return np.column_stack(forecasts)
+
+
+def forecast_all(series_by_country):
+    """Forecast every metric of every country; returns ({country: {metric: value}}, {country: {metric: model}})
+
+    Each series is split like forecast_series does (all but the last point to fit,
+    the last one as holdout), and keeps the model with the lowest holdout error.
+    Series too short for any model are left out.
+    """
+    keys, values, mask = stack_series(series_by_country)
+    if not keys or values.shape[1] < 2:
+        return {}, {}
+
+    train_values, train_mask = values[:, :-1], mask[:, :-1]
+    holdout = values[:, -1]
+    forecasts = candidate_forecasts(train_values, train_mask)
+    errors = (forecasts - holdout[:, np.newaxis]) ** 2
+    usable = np.isfinite(errors)
+    best_model = np.argmin(np.where(usable, errors, np.inf), axis=1)
+    best_forecast = forecasts[np.arange(len(keys)), best_model]
+    has_forecast = usable.any(axis=1)
+
+    predictions = {}
+    models = {}
+    for (country, metric), ok, value, model in zip(keys, has_forecast, best_forecast, best_model):
+        if not ok:
+            continue
+        predictions.setdefault(country, {})[metric] = float(value)
+        models.setdefault(country, {})[metric] = MODEL_NAMES[model]
+    # A country is forecast only when all of its metrics are
+    complete = {
+        country: metrics for country, metrics in predictions.items()
+        if len(metrics) == len(weekly_metrics.METRIC_COLUMNS)
+    }
+    return complete, {country: models[country] for country in complete}
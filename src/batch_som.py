@@ -0,0 +1,192 @@
+"""Self-organizing map trained with the batch algorithm in NumPy.
+
+MiniSom's train_random updates the codebook one sample at a time in Python.
+The batch SOM instead assigns every sample to its best matching unit per epoch
+and sets each unit to the neighbourhood-weighted mean of the samples, so an
+epoch is a few array operations over the whole dataset. Features are
+standardized with a mean and scale fitted on the training data and kept on the
+model, so the raw metrics (TotalMentions in the millions, tone near zero) all
+weigh the same. winner() and distance_map() follow MiniSom's, so distance.py
+scores either model the same way.
+"""
+
+import time
+
+import numpy as np
+
+# Rows per block when finding best matching units, bounding the (rows, units) distance matrix
+CHUNK_ROWS = 65536
+# Neighbourhood radius at the last epoch; the first one defaults to half the larger map side
+SIGMA_END = 0.5
+# Grid distance under which two units are adjacent (diagonals included), as MiniSom's topographic error
+ADJACENCY = 1.42
+
+
+def fit_scaling(data):
+    """Mean and scale standardizing each column of the raw data; constant columns keep a scale of 1"""
+    data = np.asarray(data, dtype=np.float64)
+    scale = data.std(axis=0)
+    return data.mean(axis=0), np.where(scale > 0, scale, 1.0)
+
+
+class BatchSOM:
+    """Rectangular SOM with a Gaussian neighbourhood whose radius shrinks exponentially over the epochs"""
+
+    def __init__(self, x, y, input_len, sigma=None, sigma_end=SIGMA_END, random_seed=None):
+        self.x = x
+        self.y = y
+        self.input_len = input_len
+        self.sigma = sigma if sigma is not None else max(x, y) / 2
+        self.sigma_end = min(sigma_end, self.sigma)
+        self.random_seed = random_seed
+        self.weights = np.zeros((x, y, input_len))
+        self.mean = np.zeros(input_len)
+        self.scale = np.ones(input_len)
+        self.epochs_trained = 0
+        grid = np.indices((x, y)).reshape(2, -1).T.astype(np.float64)
+        self._grid = grid
+        self._grid_d2 = ((grid[:, np.newaxis, :] - grid[np.newaxis, :, :]) ** 2).sum(axis=2)
+
+    @classmethod
+    def from_weights(cls, weights, mean=None, scale=None):
+        """Wrap a codebook trained elsewhere (e.g. MiniSom.get_weights()) with its feature scaling"""
+        weights = np.asarray(weights, dtype=np.float64)
+        som = cls(weights.shape[0], weights.shape[1], weights.shape[2])
+        som.weights = weights.copy()
+        if mean is not None:
+            som.mean = np.asarray(mean, dtype=np.float64)
+        if scale is not None:
+            som.scale = np.asarray(scale, dtype=np.float64)
+        return som
+
+    def fit_scaling(self, data):
+        """Fit the standardization to the raw training data"""
+        self.mean, self.scale = fit_scaling(data)
+        return self
+
+    def transform(self, data):
+        """Raw features to the standardized space the codebook lives in"""
+        return (np.asarray(data, dtype=np.float64) - self.mean) / self.scale
+
+    def pca_weights_init(self, data):
+        """Spread the codebook over the plane of the first two principal components of the (standardized) data
+
+        Deterministic, and it starts the map already ordered, which the batch
+        algorithm needs far more than the sequential one to avoid twisted maps.
+        """
+        data = np.asarray(data, dtype=np.float64)
+        center = data.mean(axis=0)
+        if len(data) < 2 or self.input_len < 2:
+            rng = np.random.default_rng(self.random_seed)
+            self.weights = data[rng.integers(len(data), size=self.x * self.y)].reshape(self.x, self.y, -1).copy()
+            return self
+        _, singular_values, components = np.linalg.svd(data - center, full_matrices=False)
+        spread = singular_values[:2] / np.sqrt(len(data))
+        steps_x = np.linspace(-1, 1, self.x) if self.x > 1 else np.zeros(1)
+        steps_y = np.linspace(-1, 1, self.y) if self.y > 1 else np.zeros(1)
+        self.weights = (
+            center
+            + steps_x[:, np.newaxis, np.newaxis] * spread[0] * components[0]
+            + steps_y[np.newaxis, :, np.newaxis] * spread[1] * components[1]
+        )
+        return self
+
+    def _codebook(self):
+        return self.weights.reshape(-1, self.input_len)
+
+    def _nearest_units(self, data, count=1):
+        """Flat indices of the `count` closest units of each row, closest first, as a (rows, count) array"""
+        data = np.asarray(data, dtype=np.float64)
+        codebook = self._codebook()
+        codebook_sq = (codebook ** 2).sum(axis=1)
+        nearest = np.empty((len(data), count), dtype=np.intp)
+        for start in range(0, len(data), CHUNK_ROWS):
+            block = data[start:start + CHUNK_ROWS]
+            # |x - w|^2 without the |x|^2 term, which does not change the ranking
+            d2 = codebook_sq[np.newaxis, :] - 2 * block @ codebook.T
+            if count == 1:
+                nearest[start:start + len(block), 0] = np.argmin(d2, axis=1)
+            else:
+                closest = np.argpartition(d2, count - 1, axis=1)[:, :count]
+                order = np.argsort(np.take_along_axis(d2, closest, axis=1), axis=1)
+                nearest[start:start + len(block)] = np.take_along_axis(closest, order, axis=1)
+        return nearest
+
+    def winners(self, data):
+        """Flat index of the best matching unit of every (standardized) row"""
+        return self._nearest_units(data)[:, 0]
+
+    def winner(self, x):
+        """Grid coordinates of the best matching unit of one standardized sample, as MiniSom.winner"""
+        return np.unravel_index(int(self.winners(np.asarray(x)[np.newaxis, :])[0]), (self.x, self.y))
+
+    def sigma_at(self, epoch, epochs):
+        if epochs <= 1:
+            return self.sigma_end
+        return self.sigma * (self.sigma_end / self.sigma) ** (epoch / (epochs - 1))
+
+    def train(self, data, epochs, deadline=None, verbose=False):
+        """Batch-train on standardized data for up to `epochs` epochs; returns the number run
+
+        Each epoch finds every row's best matching unit, sums the rows per unit
+        and sets the codebook to the neighbourhood-weighted means of those sums.
+        Training stops early once time.monotonic() passes `deadline`.
+        """
+        data = np.asarray(data, dtype=np.float64)
+        units = self.x * self.y
+        for epoch in range(epochs):
+            if deadline is not None and time.monotonic() > deadline:
+                print(f"Training deadline reached after {epoch} of {epochs} epochs.")
+                break
+            bmu = self.winners(data)
+            counts = np.bincount(bmu, minlength=units).astype(np.float64)
+            sums = np.column_stack([np.bincount(bmu, weights=data[:, k], minlength=units) for k in range(self.input_len)])
+
+            sigma = self.sigma_at(epoch, epochs)
+            neighbourhood = np.exp(-self._grid_d2 / (2 * sigma ** 2))
+            numerator = neighbourhood @ sums
+            denominator = neighbourhood @ counts
+            codebook = self._codebook()
+            self.weights = np.where(
+                denominator[:, np.newaxis] > 0,
+                numerator / np.maximum(denominator, np.finfo(np.float64).tiny)[:, np.newaxis],
+                codebook
+            ).reshape(self.x, self.y, self.input_len)
+            self.epochs_trained += 1
+            if verbose:
+                print(f"Epoch {epoch + 1}/{epochs}: sigma {sigma:.3f}")
+        return self.epochs_trained
+
+    def quantization_error(self, data):
+        """Mean distance between each standardized row and its best matching unit"""
+        data = np.asarray(data, dtype=np.float64)
+        bmu = self.winners(data)
+        return float(np.linalg.norm(data - self._codebook()[bmu], axis=1).mean())
+
+    def topographic_error(self, data):
+        """Share of rows whose two best matching units are not adjacent on the grid"""
+        if self.x * self.y < 2:
+            return float('nan')
+        nearest = self._nearest_units(data, count=2)
+        gap = np.linalg.norm(self._grid[nearest[:, 0]] - self._grid[nearest[:, 1]], axis=1)
+        return float((gap > ADJACENCY).mean())
+
+    def distance_map(self):
+        """U-matrix: each unit's summed distance to its 8 neighbours, normalized to a maximum of 1, as MiniSom's"""
+        weights = self.weights
+        um = np.zeros((self.x, self.y))
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                if di == 0 and dj == 0:
+                    continue
+                # Pairs (i, j) -> (i + di, j + dj) that stay inside the grid
+                rows = slice(max(0, -di), self.x - max(0, di))
+                cols = slice(max(0, -dj), self.y - max(0, dj))
+                shifted_rows = slice(max(0, di), self.x - max(0, -di))
+                shifted_cols = slice(max(0, dj), self.y - max(0, -dj))
+                um[rows, cols] += np.linalg.norm(weights[rows, cols] - weights[shifted_rows, shifted_cols], axis=2)
+        top = um.max()
+        return um / top if top > 0 else um
+
+    def get_weights(self):
+        return self.weights
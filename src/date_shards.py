@@ -0,0 +1,18 @@
+"""Splitting a backfill date range across parallel invocations.
+
+The ingestion Lambda and the unzip Glue job both take a shard and shard_count,
+so a long backfill can run as several invocations at once. Each shard gets one
+contiguous slice of the days, so the invocations never share a file.
+"""
+
+from datetime import timedelta
+
+
+def shard_date_range(start_date, end_date, shard, shard_count):
+    """Split [start_date, end_date] into shard_count contiguous slices and return the first and last day of one"""
+    total_days = (end_date - start_date).days + 1
+    first_day = shard * total_days // shard_count
+    last_day = (shard + 1) * total_days // shard_count - 1
+    if last_day < first_day:
+        return None
+    return start_date + timedelta(days=first_day), start_date + timedelta(days=last_day)
@@ -1,174 +1,80 @@
 import boto3
 import json
-import pickle
-import time
+import os
+import redshift_data
+import weekly_metrics
+import som_artifact
 import numpy as np
-from minisom import MiniSom
-from concurrent.futures import ThreadPoolExecutor, as_completed
+
+DISTANCE_COLUMNS = ['country', 'distance']
+MODEL_PATH = '/tmp/som_model.npz'
+
+# Modelo carregado numa invocação anterior deste container, com o ETag do objeto no S3
+_model = None
+_model_etag = None
 
 def lambda_handler(event, context):
     s3_client = boto3.client('s3')
-    client = boto3.client('redshift-data')
-    
-    s3_bucket = 'gdelt-project'
-    s3_key = 'dependencies/minisom_model.pkl'
     
-    workgroup_name = 'default-workgroup'
-    database = 'dev'
-    secret_arn = 'arn:aws:secretsmanager:us-east-2:339713000240:secret:prod-dw-access-H7nfCP'
     forecast_table = 'forecast'
     distance_table = 'distance'
 
     try:
-        # Carregar o modelo MiniSom do S3
-        with open('/tmp/minisom_model.pkl', 'wb') as f:
-            s3_client.download_fileobj(s3_bucket, s3_key, f)
-
-        with open('/tmp/minisom_model.pkl', 'rb') as f:
-            som = pickle.load(f)
-
-        # Deletar todos os dados da tabela distance antes de inserir novos dados
-        delete_query = f"DELETE FROM {distance_table}"
-        delete_response = client.execute_statement(
-            WorkgroupName=workgroup_name,
-            Database=database,
-            SecretArn=secret_arn,
-            Sql=delete_query
-        )
-        
-        delete_execution_id = delete_response['Id']
-        print(f"Delete execution ID: {delete_execution_id}")
-        
-        # Aguardando a conclusão da operação de delete
-        while True:
-            delete_status_response = client.describe_statement(Id=delete_execution_id)
-            delete_status = delete_status_response['Status']
-            print(f"Delete execution status: {delete_status}")
-            
-            if delete_status == 'FINISHED':
-                print("Delete operation completed successfully.")
-                break
-            elif delete_status == 'FAILED':
-                print(f"Delete operation failed: {delete_status_response['Error']}")
-                return {
-                    'statusCode': 500,
-                    'body': json.dumps(f"Delete operation failed with error: {delete_status_response['Error']}")
-                }
-            else:
-                print("Waiting for delete operation to complete...")
-                time.sleep(5)
+        # Carregar o modelo SOM do S3, só quando mudou desde a última invocação
+        som = load_model(s3_client)
 
         # Recuperar os dados previstos da tabela forecast
         query = f"""
         SELECT country, TotalMentions, TotalSources, TotalArticles, MedianAvgTone, MedianGoldsteinScale
         FROM {forecast_table}
         """
-        response = client.execute_statement(
-            WorkgroupName=workgroup_name,
-            Database=database,
-            SecretArn=secret_arn,
-            Sql=query
-        )
-        
-        execution_id = response['Id']
-        print(f"Query execution ID: {execution_id}")
-        
-        while True:
-            status_response = client.describe_statement(Id=execution_id)
-            status = status_response['Status']
-            print(f"Query execution status: {status}")
-            
-            if status == 'FINISHED':
-                print("Query completed successfully.")
-                break;
-            elif status == 'FAILED':
-                print(f"Query failed: {status_response['Error']}")
-                return {
-                    'statusCode': 500,
-                    'body': json.dumps(f"Query failed with error: {status_response['Error']}")
-                }
-            else:
-                print("Waiting for query to complete...")
-                time.sleep(5)
-
-        result_response = client.get_statement_result(Id=execution_id)
-        records = result_response['Records']
+        status_response = redshift_data.run_statement(query)
+        print("Query completed successfully.")
 
-        # Organizar os dados para cálculo das distâncias
-        country_data = {}
-        for record in records:
-            country_code = record[0]['stringValue']
-            data = [
-                float(record[1]['stringValue']),
-                float(record[2]['stringValue']),
-                float(record[3]['stringValue']),
-                float(record[4]['stringValue']),
-                float(record[5]['stringValue'])
-            ]
-            if country_code not in country_data:
-                country_data[country_code] = {'data': []}
-            country_data[country_code]['data'].append(data)
+        columns = redshift_data.fetch_columns(status_response['Id'])
 
-        # Função para processar cada país
-        def process_country(country_code, values):
-            try:
-                X_test = np.array(values['data'])
-                distances = np.array([som.distance_map()[som.winner(x)] for x in X_test])
+        # Distância de cada previsão ao seu neurônio vencedor no mapa U do SOM
+        distance_rows = []
+        if columns:
+            features = np.column_stack([columns[column.lower()] for column in weekly_metrics.METRIC_COLUMNS]).astype(np.float64)
+            distances = som.distances(features)
+            for country_code, distance in zip(columns['country'], distances):
                 print(f"Country: {country_code}, Distance: {distance}")
-                for distance in distances:
-                    insert_query = f"""
-                    INSERT INTO {distance_table} (country, distance)
-                    VALUES ('{country_code}', {distance})
-                    """
-                    insert_response = client.execute_statement(
-                        WorkgroupName=workgroup_name,
-                        Database=database,
-                        SecretArn=secret_arn,
-                        Sql=insert_query
-                    )
-                    
-                    insert_execution_id = insert_response['Id']
-                    print(f"Insert execution ID for country {country_code}: {insert_execution_id}")
-                    
-                    while True:
-                        insert_status_response = client.describe_statement(Id=insert_execution_id)
-                        insert_status = insert_status_response['Status']
-                        print(f"Insert execution status for country {country_code}: {insert_status}")
-                        
-                        if insert_status == 'FINISHED':
-                            print(f"Insert completed successfully for country {country_code}.")
-                            break
-                        elif insert_status == 'FAILED':
-                            print(f"Insert failed for country {country_code}: {insert_status_response['Error']}")
-                            return f"Failed for country {country_code}"
-                        else:
-                            print(f"Waiting for insert to complete for country {country_code}...")
-                            time.sleep(5)
-                return f"Success for country {country_code}"
-            except Exception as e:
-                print(f"Error processing country {country_code}: {str(e)}")
-                return f"Failed for country {country_code}"
+                distance_rows.append((country_code, float(distance)))
 
-        # Executando as chamadas em paralelo usando ThreadPoolExecutor
-        with ThreadPoolExecutor(max_workers=50) as executor:  # Ajuste o número de workers conforme necessário
-            futures = {executor.submit(process_country, country_code, values): country_code for country_code, values in country_data.items()}
-
-            for future in as_completed(futures):
-                country_code = futures[future]
-                try:
-                    result = future.result()
-                    print(f"Result for {country_code}: {result}")
-                except Exception as e:
-                    print(f"Exception for {country_code}: {str(e)}")
+        version = redshift_data.refresh_table(distance_table, DISTANCE_COLUMNS, distance_rows, (event or {}).get('refresh_mode', 'swap'))
+        print(f"Wrote {len(distance_rows)} rows to the {distance_table} table (snapshot {version}).")
 
         return {
             'statusCode': 200,
             'body': json.dumps("Distance table updated successfully.")
         }
 
+    except redshift_data.RedshiftDataError as e:
+        print(f"Query failed: {e.error}")
+        return {
+            'statusCode': 500,
+            'body': json.dumps(f"Query failed with error: {e.error}")
+        }
+
     except Exception as e:
         print(f"Error loading the model or updating the distance table: {str(e)}")
         return {
             'statusCode': 500,
             'body': json.dumps(f"Error loading the model or updating the distance table: {str(e)}")
         }
+
+def load_model(s3_client):
+    """The SOM model in S3, memory-mapped from /tmp and reused while its ETag does not change"""
+    global _model, _model_etag
+    etag = s3_client.head_object(Bucket=som_artifact.S3_BUCKET, Key=som_artifact.ARTIFACT_KEY)['ETag']
+    if _model is None or etag != _model_etag:
+        # O modelo carregado ainda mapeia o arquivo atual: o novo é baixado ao lado e trocado por rename
+        download_path = f"{MODEL_PATH}.download"
+        with open(download_path, 'wb') as f:
+            s3_client.download_fileobj(som_artifact.S3_BUCKET, som_artifact.ARTIFACT_KEY, f)
+        os.replace(download_path, MODEL_PATH)
+        _model = som_artifact.load_artifact(MODEL_PATH)
+        _model_etag = etag
+        print(f"Loaded SOM model {_model.sha256}.")
+    return _model
@@ -1,177 +1,211 @@
 import boto3
 import json
-import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import batch_forecast
+import forecast_cache
+import fanout
+import forecast_metrics
+import redshift_data
+import weekly_metrics
+import worker_pool
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+
+FORECAST_COLUMNS = ['country', 'TotalMentions', 'TotalSources', 'TotalArticles', 'MedianAvgTone', 'MedianGoldsteinScale']
+ZERO_FORECAST = {metric: 0 for metric in weekly_metrics.METRIC_COLUMNS}
+# Event keys passed on to forecast_metrics, in either mode
+FORECAST_OPTIONS = ['forecast_cache', 'search_strategy', 'fit_timeout', 'order_cache', 'force_search', 'research_days', 'degradation_factor']
 
 def lambda_handler(event, context):
-    client = boto3.client('redshift-data')
-    lambda_client = boto3.client('lambda')
-    workgroup_name = 'default-workgroup'
-    database = 'dev'
-    secret_arn = 'arn:aws:secretsmanager:us-east-2:339713000240:secret:prod-dw-access-H7nfCP'
+    # Sem retentativas no cliente: o AdaptiveFanout repete os throttles e os erros transitórios, e precisa ver os throttles para ajustar a concorrência
+    lambda_client = boto3.client('lambda', config=Config(retries={'total_max_attempts': 1}, max_pool_connections=50))
     table_name = 'forecast'
 
-    query = """
-    SELECT DISTINCT(ActionGeo_CountryCode)
-    FROM gdelt_event
-    """
+    # 'batch' prevê todos os países neste processo; 'lambda' invoca forecast_metrics por país
+    options = event or {}
+    forecast_mode = options.get('forecast_mode', 'batch')
 
     try:
         # Executando a consulta no Redshift
-        response = client.execute_statement(
-            WorkgroupName=workgroup_name,
-            Database=database,
-            SecretArn=secret_arn,
-            Sql=query
-        )
-        
-        execution_id = response['Id']
-        print(f"Query execution ID: {execution_id}")
-        
-        # Aguardando a conclusão da consulta
-        while True:
-            status_response = client.describe_statement(Id=execution_id)
-            status = status_response['Status']
-            print(f"Query execution status: {status}")
-            
-            if status == 'FINISHED':
-                print("Query completed successfully.")
-                break
-            elif status == 'FAILED':
-                print(f"Query failed: {status_response['Error']}")
-                return {
-                    'statusCode': 500,
-                    'body': json.dumps(f"Query failed with error: {status_response['Error']}")
-                }
-            else:
-                print("Waiting for query to complete...")
-                time.sleep(5)
-
-        # Deletando todos os dados da tabela forecast antes de inserir novos dados
-        delete_query = f"DELETE FROM {table_name}"
-        delete_response = client.execute_statement(
-            WorkgroupName=workgroup_name,
-            Database=database,
-            SecretArn=secret_arn,
-            Sql=delete_query
-        )
-        
-        delete_execution_id = delete_response['Id']
-        print(f"Delete execution ID: {delete_execution_id}")
-        
-        # Aguardando a conclusão da operação de delete
-        while True:
-            delete_status_response = client.describe_statement(Id=delete_execution_id)
-            delete_status = delete_status_response['Status']
-            print(f"Delete execution status: {delete_status}")
-            
-            if delete_status == 'FINISHED':
-                print("Delete operation completed successfully.")
-                break
-            elif delete_status == 'FAILED':
-                print(f"Delete operation failed: {delete_status_response['Error']}")
-                return {
-                    'statusCode': 500,
-                    'body': json.dumps(f"Delete operation failed with error: {delete_status_response['Error']}")
-                }
-            else:
-                print("Waiting for delete operation to complete...")
-                time.sleep(5)
+        status_response = redshift_data.run_statement(weekly_metrics.COUNTRIES_SQL)
+        print("Query completed successfully.")
 
         # Recuperando os resultados da consulta
-        result_response = client.get_statement_result(Id=execution_id)
-        records = result_response['Records']
-
-        # Função para processar cada país
-        def process_country(country_code):
-            try:
-                # Chamando a segunda Lambda Function para obter as métricas
-                forecast_response = lambda_client.invoke(
-                    FunctionName='arn:aws:lambda:us-east-2:339713000240:function:forecast_metrics',
-                    InvocationType='RequestResponse',
-                    Payload=json.dumps({"ActionGeo_CountryCode": country_code})
-                )
-                
-                forecast_result = json.loads(forecast_response['Payload'].read())
-                forecast_data = json.loads(forecast_result['body'])
-
-                # Verificação para garantir que a resposta seja válida
-                if 'TotalMentions' not in forecast_data or 'TotalSources' not in forecast_data or 'TotalArticles' not in forecast_data or 'MedianAvgTone' not in forecast_data or 'MedianGoldsteinScale' not in forecast_data:
-                    raise ValueError("Invalid response structure")
-
-            except Exception as e:
-                print(f"Error processing country {country_code}: {str(e)}. Filling with zeros.")
-                # Se houver erro, definimos os valores como zero
-                forecast_data = {
-                    'TotalMentions': 0,
-                    'TotalSources': 0,
-                    'TotalArticles': 0,
-                    'MedianAvgTone': 0,
-                    'MedianGoldsteinScale': 0
-                }
-
-            # Atualizando a tabela forecast no Redshift
-            try:
-                update_query = f"""
-                INSERT INTO {table_name} (country, TotalMentions, TotalSources, TotalArticles, MedianAvgTone, MedianGoldsteinScale)
-                VALUES ('{country_code}', {forecast_data['TotalMentions']}, {forecast_data['TotalSources']}, {forecast_data['TotalArticles']}, {forecast_data['MedianAvgTone']}, {forecast_data['MedianGoldsteinScale']})
-                """
-                
-                update_response = client.execute_statement(
-                    WorkgroupName=workgroup_name,
-                    Database=database,
-                    SecretArn=secret_arn,
-                    Sql=update_query
-                )
-                
-                update_execution_id = update_response['Id']
-                print(f"Update execution ID for country {country_code}: {update_execution_id}")
-
-                # Aguardando a conclusão da atualização
-                while True:
-                    update_status_response = client.describe_statement(Id=update_execution_id)
-                    update_status = update_status_response['Status']
-                    print(f"Update execution status for country {country_code}: {update_status}")
-                    
-                    if update_status == 'FINISHED':
-                        print(f"Update for country {country_code} completed successfully.")
-                        break
-                    elif update_status == 'FAILED':
-                        print(f"Update failed for country {country_code}: {update_status_response['Error']}")
-                        return {
-                            'statusCode': 500,
-                            'body': json.dumps(f"Update failed for country {country_code} with error: {update_status_response['Error']}")
-                        }
-                    else:
-                        print(f"Waiting for update to complete for country {country_code}...")
-                        time.sleep(5)
-
-                return f"Success for country {country_code}"
-
-            except Exception as e:
-                print(f"Error updating forecast table for country {country_code}: {str(e)}")
-                return f"Failed for country {country_code}"
-
-        # Executando as chamadas em paralelo usando ThreadPoolExecutor
-        with ThreadPoolExecutor(max_workers=50) as executor:  # Ajuste o número de workers conforme necessário
-            futures = {executor.submit(process_country, record[0]['stringValue']): record[0]['stringValue'] for record in records}
-
-            for future in as_completed(futures):
-                country_code = futures[future]
-                try:
-                    result = future.result()
-                    print(f"Result for {country_code}: {result}")
-                except Exception as e:
-                    print(f"Exception for {country_code}: {str(e)}")
+        countries = [country_code for (country_code,) in redshift_data.iter_records(status_response['Id']) if country_code]
+
+        forecast_options = {key: options[key] for key in FORECAST_OPTIONS if key in options}
+        if forecast_mode == 'lambda':
+            forecast_rows = invoke_forecasts(lambda_client, countries, forecast_options, options.get('fanout'))
+        else:
+            forecast_rows = batch_forecasts(countries, options.get('num_months', -2), forecast_options, options.get('forecast_engine', 'arima'))
+
+        version = redshift_data.refresh_table(table_name, FORECAST_COLUMNS, forecast_rows, options.get('refresh_mode', 'swap'))
+        print(f"Wrote {len(forecast_rows)} rows to the {table_name} table (snapshot {version}).")
 
         return {
             'statusCode': 200,
             'body': json.dumps("Forecast table updated successfully.")
         }
     
+    except redshift_data.RedshiftDataError as e:
+        print(f"Query failed: {e.error}")
+        return {
+            'statusCode': 500,
+            'body': json.dumps(f"Query failed with error: {e.error}")
+        }
+
     except Exception as e:
         print(f"Error executing the query or updating the forecast table: {str(e)}")
         return {
             'statusCode': 500,
             'body': json.dumps(f"Error executing the query or updating the forecast table: {str(e)}")
         }
+
+def forecast_row(country_code, forecast_data):
+    return (country_code,) + tuple(float(forecast_data[metric]) for metric in weekly_metrics.METRIC_COLUMNS)
+
+def invoke_forecasts(lambda_client, countries, forecast_options=None, fanout_options=None):
+    """Forecast each country with its own forecast_metrics invocation
+
+    Invocations go through an AdaptiveFanout, so throttled ones are retried with
+    backoff while the concurrency settles under the account's limit, and 5xx or
+    connection failures are retried too. A country whose forecast fails gets zeros; one still throttled after every retry is
+    left out rather than written as a zero forecast.
+    """
+    # Função para processar cada país
+    def process_country(country_code):
+        # Chamando a segunda Lambda Function para obter as métricas
+        forecast_response = lambda_client.invoke(
+            FunctionName='arn:aws:lambda:us-east-2:339713000240:function:forecast_metrics',
+            InvocationType='RequestResponse',
+            Payload=json.dumps({"ActionGeo_CountryCode": country_code, **(forecast_options or {})})
+        )
+
+        forecast_result = json.loads(forecast_response['Payload'].read())
+        # forecast_metrics devolve 500 quando a Data API o estrangula; isso é repetido, não vira zero
+        if forecast_result.get('statusCode') != 200 and any(code in str(forecast_result.get('body')) for code in fanout.THROTTLE_CODES):
+            raise fanout.ThrottledError(forecast_result.get('body'))
+        forecast_data = json.loads(forecast_result['body'])
+
+        # Verificação para garantir que a resposta seja válida
+        if any(metric not in forecast_data for metric in weekly_metrics.METRIC_COLUMNS):
+            raise ValueError("Invalid response structure")
+        return forecast_data
+
+    controller = fanout.AdaptiveFanout(**(fanout_options or {}))
+    forecast_rows = []
+    for result in controller.map(process_country, countries):
+        country_code = result.item
+        if result.throttled:
+            print(f"Country {country_code} still throttled after {result.attempts} attempts, leaving it out: {result.error}")
+            continue
+        if result.ok:
+            print(f"Forecast ready for {country_code}: {result.timing()}")
+            forecast_data = result.value
+        else:
+            print(f"Error processing country {country_code}: {str(result.error)}. Filling with zeros.")
+            # Se houver erro, definimos os valores como zero
+            forecast_data = ZERO_FORECAST
+        forecast_rows.append(forecast_row(country_code, forecast_data))
+    print(f"Lambda fan-out: {controller.stats}")
+    return forecast_rows
+
+def forecast_country(item):
+    """Worker task: the forecast of one country's series and its updated order cache, or the error"""
+    country_code, series, forecast_options, order_cache = item
+    try:
+        predictions = forecast_metrics.forecast_series(series, forecast_options, order_cache=order_cache)
+        return country_code, predictions, None, order_cache
+    except Exception as e:
+        return country_code, None, str(e), order_cache
+
+def batch_forecasts(countries, num_months=-2, forecast_options=None, engine='arima'):
+    """Forecast every country from one query over the weekly rollup
+
+    Countries whose series match a cached fingerprint reuse that forecast. The
+    rest go to the 'arima' engine, which searches each country across all
+    available cores, or the 'vectorized' one, which fits simple models to every
+    series at once (batch_forecast).
+    """
+    forecast_options = forecast_options or {}
+    status_response = redshift_data.run_statement(weekly_metrics.all_series_sql(num_months))
+    series = weekly_metrics.series_by_country(redshift_data.fetch_columns(status_response['Id']))
+    print(f"Fetched weekly series for {len(series)} countries.")
+
+    s3_client = boto3.client('s3')
+    forecast_countries = [country_code for country_code in countries if country_code in series]
+    forecasts = {}
+    caches = {}
+    fingerprints = {}
+    if forecast_options.get('forecast_cache', True):
+        settings = forecast_cache.forecast_settings(forecast_options, engine)
+        caches = load_caches(forecast_cache.load_forecast_cache, s3_client, forecast_countries)
+        for country_code in forecast_countries:
+            fingerprints[country_code] = forecast_cache.series_fingerprint(series[country_code], settings)
+            if forecast_options.get('force_search'):
+                # A forced order search refits every country; the new forecasts still replace the cached ones
+                continue
+            predictions = forecast_cache.lookup(caches[country_code], fingerprints[country_code])
+            if predictions is not None:
+                forecasts[country_code] = predictions
+        print(f"{len(forecasts)} countries have unchanged series and reuse their cached forecast.")
+
+    pending = [country_code for country_code in forecast_countries if country_code not in forecasts]
+    if engine == 'vectorized':
+        # Todos os países e métricas de uma vez, sem statsmodels nem processos
+        fitted, _ = batch_forecast.forecast_all({country_code: series[country_code] for country_code in pending})
+        print(f"Forecast {len(fitted)} countries with the vectorized engine.")
+    else:
+        fitted = arima_forecasts(pending, series, forecast_options, s3_client)
+
+    for country_code, predictions in fitted.items():
+        forecasts[country_code] = predictions
+        if country_code in caches:
+            forecast_cache.store(caches[country_code], fingerprints[country_code], predictions)
+    if caches:
+        save_caches(forecast_cache.save_forecast_cache, s3_client, caches)
+
+    missing = [country_code for country_code in countries if country_code not in forecasts]
+    if missing:
+        print(f"No forecast for {len(missing)} countries, filling with zeros.")
+    return [forecast_row(country_code, forecasts.get(country_code, ZERO_FORECAST)) for country_code in countries]
+
+def load_caches(load, s3_client, countries):
+    """Read one per-country cache object for each country, in parallel"""
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        return dict(zip(countries, executor.map(lambda country_code: load(s3_client, country_code), countries)))
+
+def save_caches(save, s3_client, caches):
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(lambda item: save(s3_client, *item), caches.items()))
+
+def arima_forecasts(countries, series, forecast_options, s3_client):
+    """ARIMA forecasts of the countries across worker processes; countries that fail are left out"""
+    # Os caches de ordens ARIMA são lidos e gravados aqui; os processos só recebem e devolvem os dicts
+    order_caches = {}
+    if forecast_options.get('order_cache', True):
+        order_caches = load_caches(forecast_metrics.load_order_cache, s3_client, countries)
+    cached = {country_code: json.dumps(cache, sort_keys=True) for country_code, cache in order_caches.items()}
+
+    # Countries already run in parallel here, so each one searches its ARIMA orders sequentially
+    items = [
+        (country_code, series[country_code], forecast_options, order_caches.get(country_code))
+        for country_code in countries
+    ]
+    with worker_pool.WorkerPool(os.cpu_count() or 1) as pool:
+        results = pool.map(forecast_country, items)
+
+    forecasts = {}
+    changed_caches = {}
+    for country_code, predictions, error, order_cache in results:
+        if error is not None:
+            print(f"Error processing country {country_code}: {error}. Filling with zeros.")
+            continue
+        forecasts[country_code] = predictions
+        if order_cache is not None and json.dumps(order_cache, sort_keys=True) != cached[country_code]:
+            changed_caches[country_code] = order_cache
+
+    if changed_caches:
+        save_caches(forecast_metrics.save_order_cache, s3_client, changed_caches)
+        print(f"Updated the ARIMA order cache of {len(changed_caches)} countries.")
+    return forecasts
@@ -0,0 +1,187 @@
+"""Fan-out executor that adapts its concurrency to throttling, AIMD style.
+
+Tasks run on a thread pool, but only `limit` of them are in flight at a time.
+Each completed task raises the limit by 1/limit (about +1 per round of tasks);
+a throttled one halves it, at most once per round, and the task is retried
+after a jittered exponential backoff. Transient failures (5xx responses, dropped
+or timed-out connections) are retried with the same backoff but leave the limit
+alone. Tasks slower than latency_threshold count as congestion too, without
+being retried. Throughput therefore settles just
+under the service limit instead of bouncing off it.
+"""
+
+import heapq
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+# Error codes AWS services use to reject requests over their rate or concurrency limits
+THROTTLE_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'TooManyRequests',
+    'TooManyRequestsException', 'RequestLimitExceeded', 'SlowDown', 'ProvisionedThroughputExceededException',
+}
+
+
+class ThrottledError(Exception):
+    """Raised by a task whose call was throttled in a way boto3 does not surface as an error (e.g. inside a payload)"""
+
+
+def is_throttle(error):
+    """Whether an exception means the call was throttled and is worth retrying"""
+    if isinstance(error, ThrottledError):
+        return True
+    if isinstance(error, ClientError):
+        response = error.response
+        code = response.get('Error', {}).get('Code')
+        status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        return code in THROTTLE_CODES or status == 429
+    return False
+
+
+def is_transient(error):
+    """Whether an exception is a server-side or connection failure worth retrying, other than a throttle"""
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return True
+    if isinstance(error, ClientError):
+        return error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500 and not is_throttle(error)
+    return False
+
+
+class TaskResult:
+    """Outcome of one task: its value or final error, the attempts it took and where the time went"""
+
+    def __init__(self, item):
+        self.item = item
+        self.value = None
+        self.error = None
+        self.attempts = 0
+        self.throttles = 0
+        self.run_seconds = 0.0
+        self.backoff_seconds = 0.0
+        self.queued_at = time.monotonic()
+        self.finished_at = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def throttled(self):
+        """Failed because every attempt was throttled"""
+        return self.error is not None and is_throttle(self.error)
+
+    @property
+    def total_seconds(self):
+        return (self.finished_at or time.monotonic()) - self.queued_at
+
+    def timing(self):
+        return {
+            'attempts': self.attempts,
+            'throttles': self.throttles,
+            'run_seconds': round(self.run_seconds, 3),
+            'backoff_seconds': round(self.backoff_seconds, 3),
+            'total_seconds': round(self.total_seconds, 3),
+        }
+
+
+class AdaptiveFanout:
+    """Run a function over many items with AIMD-controlled concurrency and jittered retries on throttling and transient errors"""
+
+    def __init__(self, initial_concurrency=8, min_concurrency=1, max_concurrency=50,
+                 decrease_factor=0.5, max_attempts=6, base_delay=0.1, max_delay=10.0, latency_threshold=None):
+        self.initial_concurrency = initial_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.decrease_factor = decrease_factor
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.latency_threshold = latency_threshold
+        self.stats = {}
+
+    def backoff(self, attempt):
+        """Full-jitter exponential backoff before retry number `attempt`"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def map(self, function, items):
+        """Apply function to every item; returns one TaskResult per item, in input order
+
+        Throttling and transient errors are retried; any other exception is the
+        task's final error. Tasks still throttled after max_attempts fail with
+        the throttle error, so callers can tell them apart (TaskResult.throttled).
+        """
+        items = list(items)
+        results = [TaskResult(item) for item in items]
+        limit = float(min(self.initial_concurrency, self.max_concurrency))
+        # Index of the last task submitted before the limit was last cut; only throttles of later tasks cut it again
+        last_decrease_mark = -1
+        submitted = 0
+        ready = list(range(len(items)))
+        ready.reverse()
+        delayed = []
+        in_flight = {}
+        self.stats = {'tasks': len(items), 'throttles': 0, 'transient_errors': 0, 'retries': 0, 'peak_concurrency': 0, 'final_concurrency': None}
+
+        def run(index):
+            started = time.monotonic()
+            try:
+                return function(items[index]), None, time.monotonic() - started
+            except Exception as e:
+                return None, e, time.monotonic() - started
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            while ready or delayed or in_flight:
+                now = time.monotonic()
+                while delayed and delayed[0][0] <= now:
+                    _, index = heapq.heappop(delayed)
+                    ready.append(index)
+
+                while ready and len(in_flight) < int(limit):
+                    index = ready.pop()
+                    results[index].attempts += 1
+                    in_flight[executor.submit(run, index)] = (index, submitted)
+                    submitted += 1
+                self.stats['peak_concurrency'] = max(self.stats['peak_concurrency'], len(in_flight))
+
+                timeout = max(0.0, delayed[0][0] - time.monotonic()) if delayed else None
+                if not in_flight:
+                    time.sleep(timeout or 0)
+                    continue
+                done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    index, mark = in_flight.pop(future)
+                    value, error, seconds = future.result()
+                    result = results[index]
+                    result.run_seconds += seconds
+                    retryable = False
+                    if error is not None and is_throttle(error):
+                        result.throttles += 1
+                        self.stats['throttles'] += 1
+                        if mark > last_decrease_mark:
+                            limit = max(self.min_concurrency, limit * self.decrease_factor)
+                            last_decrease_mark = submitted - 1
+                        retryable = True
+                    elif error is not None and is_transient(error):
+                        self.stats['transient_errors'] += 1
+                        retryable = True
+                    elif self.latency_threshold is not None and seconds > self.latency_threshold:
+                        if mark > last_decrease_mark:
+                            limit = max(self.min_concurrency, limit * self.decrease_factor)
+                            last_decrease_mark = submitted - 1
+                    elif error is None:
+                        limit = min(self.max_concurrency, limit + 1 / limit)
+                    if retryable and result.attempts < self.max_attempts:
+                        delay = self.backoff(result.attempts)
+                        result.backoff_seconds += delay
+                        self.stats['retries'] += 1
+                        heapq.heappush(delayed, (time.monotonic() + delay, index))
+                        continue
+                    result.value = value
+                    result.error = error
+                    result.finished_at = time.monotonic()
+
+        self.stats['final_concurrency'] = round(limit, 2)
+        return results
@@ -0,0 +1,82 @@
+"""Forecasts cached under a fingerprint of the weekly series they were computed from.
+
+Each country has one JSON object in S3 mapping series fingerprints to the
+predictions made for them, so a country whose rollup rows did not change since
+an earlier run gets its forecast back without fitting anything. Entries unused
+for FORECAST_CACHE_TTL_DAYS are dropped and at most FORECAST_CACHE_ENTRIES are
+kept per country, evicting the least recently used.
+"""
+
+import hashlib
+import json
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+import s3_json
+import weekly_metrics
+
+S3_BUCKET = 'gdelt-project'
+FORECAST_CACHE_PREFIX = 'dependencies/forecast_cache/'
+FORECAST_CACHE_ENTRIES = 8
+FORECAST_CACHE_TTL_DAYS = 14
+# Bump when the forecasting code changes in a way that should invalidate every cached forecast
+FORECAST_CACHE_VERSION = 1
+
+
+def series_fingerprint(data, settings=None):
+    """SHA-256 of a country's weekly series (as built by series_from_columns) and the settings that shape its forecast"""
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'version': FORECAST_CACHE_VERSION, 'settings': settings or {}}, sort_keys=True).encode('utf-8'))
+    digest.update('\n'.join(str(week) for week in data['Week']).encode('utf-8'))
+    for metric in weekly_metrics.METRIC_COLUMNS:
+        digest.update(metric.encode('utf-8'))
+        digest.update(np.ascontiguousarray(data[metric], dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def forecast_settings(options, engine='arima'):
+    """The options that change a forecast for the same series, to fold into its fingerprint"""
+    if engine == 'arima':
+        return {'engine': engine, 'search_strategy': options.get('search_strategy', 'stepwise')}
+    return {'engine': engine}
+
+
+def load_forecast_cache(s3_client, country_code):
+    """The {fingerprint: {'predictions', 'created_at', 'last_used'}} cache of a country, or {}"""
+    return s3_json.load_json(s3_client, S3_BUCKET, f"{FORECAST_CACHE_PREFIX}{country_code}.json", default={})
+
+
+def save_forecast_cache(s3_client, country_code, cache):
+    s3_json.save_json(s3_client, S3_BUCKET, f"{FORECAST_CACHE_PREFIX}{country_code}.json", cache)
+
+
+def lookup(cache, fingerprint, now=None):
+    """Cached predictions for the fingerprint, or None; a hit is marked as used"""
+    entry = cache.get(fingerprint)
+    if entry is None:
+        return None
+    entry['last_used'] = (now or datetime.now(timezone.utc)).isoformat()
+    return entry['predictions']
+
+
+def store(cache, fingerprint, predictions, now=None):
+    """Add the predictions under the fingerprint, then evict expired and least recently used entries"""
+    now = now or datetime.now(timezone.utc)
+    cache[fingerprint] = {
+        'predictions': {metric: float(value) for metric, value in predictions.items()},
+        'created_at': now.isoformat(),
+        'last_used': now.isoformat()
+    }
+    evict(cache, now)
+
+
+def evict(cache, now=None):
+    now = now or datetime.now(timezone.utc)
+    expired_before = now - timedelta(days=FORECAST_CACHE_TTL_DAYS)
+    for fingerprint, entry in list(cache.items()):
+        if datetime.fromisoformat(entry['last_used']) < expired_before:
+            del cache[fingerprint]
+    by_last_use = sorted(cache, key=lambda fingerprint: cache[fingerprint]['last_used'], reverse=True)
+    for fingerprint in by_last_use[FORECAST_CACHE_ENTRIES:]:
+        del cache[fingerprint]
@@ -1,11 +1,38 @@
 import boto3
+import forecast_cache
+import functools
 import json
+import os
 import time
+import warnings
+import redshift_data
+import s3_json
+import weekly_metrics
+import worker_pool
+import numpy as np
+from datetime import datetime, timedelta, timezone
+from statsmodels.tools.sm_exceptions import ConvergenceWarning
 from statsmodels.tsa.arima.model import ARIMA
+from statsmodels.tsa.stattools import kpss
+
+# (p, d, q) are searched in range(MAX_ORDER + 1), like the original 27-order grid
+MAX_ORDER = 2
+SEARCH_STRATEGIES = ('grid', 'stepwise')
+# Starting orders of the stepwise search (Hyndman-Khandakar), before clipping to MAX_ORDER
+STEPWISE_START_ORDERS = [(2, 2), (0, 0), (1, 0), (0, 1)]
+# KPSS p-value under which the series is differenced once more
+KPSS_ALPHA = 0.05
+
+S3_BUCKET = 'gdelt-project'
+# One JSON per country with the chosen order and fitted parameters of each metric
+ORDER_CACHE_PREFIX = 'dependencies/arima_orders/'
+# A cached order is searched again after this many days, or sooner when its holdout error degrades
+RESEARCH_INTERVAL_DAYS = 28
+DEGRADATION_FACTOR = 2.0
+# One-week holdout errors can be ~0 by chance; degradation is measured against at least this share of the series variance
+ERROR_FLOOR_FRACTION = 0.1
 
 def lambda_handler(event, context):
-    client = boto3.client('redshift-data')
-    
     if 'ActionGeo_CountryCode' not in event:
         return {
             'statusCode': 400,
@@ -13,141 +40,58 @@ def lambda_handler(event, context):
         }
     
     action_geo_country_code = event['ActionGeo_CountryCode']
-    
-    workgroup_name = 'default-workgroup'
-    database = 'dev'
-    secret_arn = 'arn:aws:secretsmanager:us-east-2:339713000240:secret:prod-dw-access-H7nfCP'
-
-    query = f"""
-    WITH recent_weeks AS (
-        SELECT DISTINCT DATE_TRUNC('week', TO_DATE(SQLDATE, 'YYYYMMDD')) AS Week
-        FROM gdelt_event
-        WHERE TO_DATE(SQLDATE, 'YYYYMMDD') >= ADD_MONTHS(DATE_TRUNC('week', CURRENT_DATE), -2)
-    )
-    SELECT 
-        aggregated_data.Week,
-        aggregated_data.TotalMentions,
-        aggregated_data.TotalSources,
-        aggregated_data.TotalArticles,
-        median_data.AvgTone AS MedianAvgTone,
-        median_data.GoldsteinScale AS MedianGoldsteinScale
-    FROM 
-        (
-            SELECT
-                DATE_TRUNC('week', TO_DATE(SQLDATE, 'YYYYMMDD')) AS Week,
-                SUM(NumMentions) AS TotalMentions,
-                SUM(NumSources) AS TotalSources,
-                SUM(NumArticles) AS TotalArticles
-            FROM 
-                gdelt_event
-            WHERE 
-                EventRootCode IN ('6', '7', '13', '14', '15', '16', '17', '18', '19', '20')
-                AND ActionGeo_CountryCode = '{action_geo_country_code}'
-                AND TO_DATE(SQLDATE, 'YYYYMMDD') >= ADD_MONTHS(DATE_TRUNC('week', CURRENT_DATE), -2)
-            GROUP BY 
-                DATE_TRUNC('week', TO_DATE(SQLDATE, 'YYYYMMDD'))
-        ) AS aggregated_data
-    JOIN 
-        (
-            SELECT 
-                Week,
-                AVG(AvgTone) AS AvgTone,
-                AVG(GoldsteinScale) AS GoldsteinScale
-            FROM (
-                SELECT 
-                    DATE_TRUNC('week', TO_DATE(SQLDATE, 'YYYYMMDD')) AS Week,
-                    AvgTone,
-                    GoldsteinScale,
-                    NTILE(2) OVER (PARTITION BY DATE_TRUNC('week', TO_DATE(SQLDATE, 'YYYYMMDD')) ORDER BY AvgTone) AS tone_ntile,
-                    NTILE(2) OVER (PARTITION BY DATE_TRUNC('week', TO_DATE(SQLDATE, 'YYYYMMDD')) ORDER BY GoldsteinScale) AS goldstein_ntile
-                FROM 
-                    gdelt_event
-                WHERE 
-                    EventRootCode IN ('6', '7', '13', '14', '15', '16', '17', '18', '19', '20')
-                    AND ActionGeo_CountryCode = '{action_geo_country_code}'
-                    AND TO_DATE(SQLDATE, 'YYYYMMDD') >= ADD_MONTHS(DATE_TRUNC('week', CURRENT_DATE), -2)
-            ) AS subquery
-            WHERE tone_ntile = 1 AND goldstein_ntile = 1
-            GROUP BY 
-                Week
-        ) AS median_data
-    ON 
-        aggregated_data.Week = median_data.Week
-    WHERE aggregated_data.Week IN (SELECT Week FROM recent_weeks)
-    ORDER BY 
-        aggregated_data.Week DESC;
-    """
+
+    query = weekly_metrics.weekly_series_sql(action_geo_country_code, -2)
 
     try:
-        response = client.execute_statement(
-            WorkgroupName=workgroup_name,
-            Database=database,
-            SecretArn=secret_arn,
-            Sql=query
-        )
-        
-        execution_id = response['Id']
-        print(f"Query execution ID: {execution_id}")
-        
-        while True:
-            status_response = client.describe_statement(Id=execution_id)
-            status = status_response['Status']
-            print(f"Query execution status: {status}")
-            
-            if status == 'FINISHED':
-                print("Query completed successfully.")
-                break
-            elif status == 'FAILED':
-                print(f"Query failed: {status_response['Error']}")
+        status_response = redshift_data.run_statement(query)
+        print("Query completed successfully.")
+
+        data = weekly_metrics.series_from_columns(redshift_data.fetch_columns(status_response['Id']))
+
+        # Uma série igual à de uma execução anterior devolve a previsão guardada sem ajustar modelos
+        s3_client = boto3.client('s3')
+        use_forecast_cache = event.get('forecast_cache', True)
+        if use_forecast_cache:
+            fingerprint = forecast_cache.series_fingerprint(data, forecast_cache.forecast_settings(event))
+            cache = forecast_cache.load_forecast_cache(s3_client, action_geo_country_code)
+            # force_search ajusta os modelos de novo; o resultado ainda substitui a previsão guardada
+            predictions = None if event.get('force_search') else forecast_cache.lookup(cache, fingerprint)
+            if predictions is not None:
+                print(f"Series of {action_geo_country_code} unchanged, returning the cached forecast.")
+                forecast_cache.save_forecast_cache(s3_client, action_geo_country_code, cache)
                 return {
-                    'statusCode': 500,
-                    'body': json.dumps(f"Query failed with error: {status_response['Error']}")
+                    'statusCode': 200,
+                    'body': json.dumps(predictions)
                 }
-            else:
-                print("Waiting for query to complete...")
-                time.sleep(5)
-
-        result_response = client.get_statement_result(Id=execution_id)
-        records = result_response['Records']
-
-        data = {
-            'Week': [],
-            'TotalMentions': [],
-            'TotalSources': [],
-            'TotalArticles': [],
-            'MedianAvgTone': [],
-            'MedianGoldsteinScale': []
-        }
-
-        for record in records:
-            week_str = record[0]['stringValue'].split(" ")[0]
-            data['Week'].append(week_str)
-            data['TotalMentions'].append(float(record[1]['longValue']))
-            data['TotalSources'].append(float(record[2]['longValue']))
-            data['TotalArticles'].append(float(record[3]['longValue']))
-            data['MedianAvgTone'].append(float(record[4]['stringValue']))
-            data['MedianGoldsteinScale'].append(float(record[5]['stringValue']))
 
         data['Week'] = [time.strptime(week, '%Y-%m-%d') for week in data['Week']]
 
-        predictions = {}
-
-        for column in ['TotalMentions', 'TotalSources', 'TotalArticles', 'MedianAvgTone', 'MedianGoldsteinScale']:
-            y = data[column]
+        use_order_cache = event.get('order_cache', True)
+        order_cache = load_order_cache(s3_client, action_geo_country_code) if use_order_cache else None
+        cached = json.dumps(order_cache, sort_keys=True)
 
-            y_train = y[:-1]
-            y_test = y[-1]
+        with worker_pool.WorkerPool(event.get('max_workers', os.cpu_count() or 1)) as pool:
+            predictions = forecast_series(data, event, pool, order_cache)
 
-            best_model, best_order, best_score = find_best_arima_model(y_train, y_test)
-
-            forecast = best_model.forecast(steps=1)
-            predictions[column] = forecast[0]
+        if use_order_cache and json.dumps(order_cache, sort_keys=True) != cached:
+            save_order_cache(s3_client, action_geo_country_code, order_cache)
+        if use_forecast_cache:
+            forecast_cache.store(cache, fingerprint, predictions)
+            forecast_cache.save_forecast_cache(s3_client, action_geo_country_code, cache)
 
         return {
             'statusCode': 200,
             'body': json.dumps(predictions)
         }
     
+    except redshift_data.RedshiftDataError as e:
+        print(f"Query failed: {e.error}")
+        return {
+            'statusCode': 500,
+            'body': json.dumps(f"Query failed with error: {e.error}")
+        }
+
     except Exception as e:
         print(f"Error executing the query: {str(e)}")
         return {
@@ -155,29 +99,209 @@ def lambda_handler(event, context):
             'body': json.dumps(f"Error executing the query: {str(e)}")
         }
 
-def find_best_arima_model(y_train, y_test):
-    best_score = float('inf')
-    best_order = None
-    best_model = None
-    
-    for p in range(3):
-        for d in range(3):
-            for q in range(3):
-                try:
-                    model = ARIMA(y_train, order=(p, d, q))
-                    model_fit = model.fit()
-                    forecast = model_fit.forecast(steps=1)
-                    
-                    mse = mean_squared_error(y_test, forecast[0])
-                    
-                    if mse < best_score:
-                        best_score = mse
-                        best_order = (p, d, q)
-                        best_model = model_fit
-                except Exception as e:
-                    continue
-
-    return best_model, best_order, best_score
+def forecast_series(data, options=None, executor=None, order_cache=None):
+    """One-step ARIMA forecast of every metric of a country's weekly series (as built by series_from_columns)
+
+    options carries the event keys search_strategy, fit_timeout, force_search,
+    research_days and degradation_factor. With an order_cache (the country's
+    {metric: entry} dict) cached orders are refitted instead of searched, and
+    the dict is updated in place. Raises ValueError when no order of a metric
+    could be fitted.
+    """
+    options = options or {}
+    predictions = {}
+
+    for column in weekly_metrics.METRIC_COLUMNS:
+        y = data[column]
+
+        y_train = y[:-1]
+        y_test = y[-1]
+
+        entry = order_cache.get(column) if order_cache is not None else None
+        best_model = None
+        if entry is not None and not search_due(entry, options):
+            best_model, score = refit_cached_order(y_train, y_test, entry)
+            if best_model is not None and score <= degradation_threshold(y_train, entry, options):
+                entry.update({'params': best_model.params.tolist(), 'mse': score})
+            else:
+                print(f"Cached order {tuple(entry['order'])} of {column} failed or degraded, searching again.")
+                best_model = None
+
+        if best_model is None:
+            best_model, best_order, best_score = find_best_arima_model(
+                y_train, y_test, options.get('search_strategy', 'stepwise'), executor, options.get('fit_timeout')
+            )
+            if order_cache is not None and best_model is not None:
+                order_cache[column] = {
+                    'order': list(best_order),
+                    'params': best_model.params.tolist(),
+                    'search_mse': best_score,
+                    'mse': best_score,
+                    'searched_at': datetime.now(timezone.utc).isoformat()
+                }
+            if best_model is None:
+                raise ValueError(f"No ARIMA order of {column} could be fitted")
+
+        forecast = best_model.forecast(steps=1)
+        predictions[column] = forecast[0]
+
+    return predictions
+
+def load_order_cache(s3_client, country_code):
+    """The cached {metric: {'order', 'params', 'search_mse', 'mse', 'searched_at'}} of a country, or {}"""
+    return s3_json.load_json(s3_client, S3_BUCKET, f"{ORDER_CACHE_PREFIX}{country_code}.json", default={})
+
+def save_order_cache(s3_client, country_code, order_cache):
+    s3_json.save_json(s3_client, S3_BUCKET, f"{ORDER_CACHE_PREFIX}{country_code}.json", order_cache)
+
+def search_due(entry, options):
+    """Whether the scheduled full search of a cached order is due (or forced with force_search)"""
+    if options.get('force_search'):
+        return True
+    searched_at = datetime.fromisoformat(entry['searched_at'])
+    research_days = options.get('research_days', RESEARCH_INTERVAL_DAYS)
+    return datetime.now(timezone.utc) - searched_at >= timedelta(days=research_days)
+
+def degradation_threshold(y_train, entry, options):
+    """Holdout error above which a refitted cached order is replaced by a new search"""
+    floor = ERROR_FLOOR_FRACTION * float(np.var(y_train))
+    return options.get('degradation_factor', DEGRADATION_FACTOR) * max(entry['search_mse'], floor)
+
+def refit_cached_order(y_train, y_test, entry):
+    """Refit the cached order starting from its previous parameters; returns (model, holdout error) or (None, inf)"""
+    try:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            model_fit = ARIMA(y_train, order=tuple(entry['order'])).fit(start_params=np.asarray(entry['params']))
+        if any(issubclass(warning.category, ConvergenceWarning) for warning in caught):
+            return None, float('inf')
+        forecast = model_fit.forecast(steps=1)
+        return model_fit, float(mean_squared_error(y_test, forecast[0]))
+    except Exception as e:
+        print(f"Refit of order {tuple(entry['order'])} failed: {str(e)}")
+        return None, float('inf')
+
+def fit_order(y_train, y_test, order):
+    """Fit one candidate order and summarize it; failures are reported instead of raised
+
+    Only the summary (with the fitted parameters) crosses the process boundary;
+    the chosen model is rebuilt from its parameters without refitting.
+    """
+    started = time.perf_counter()
+    try:
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            model_fit = ARIMA(y_train, order=order).fit()
+        converged = not any(issubclass(warning.category, ConvergenceWarning) for warning in caught)
+        forecast = model_fit.forecast(steps=1)
+        return {
+            'order': order,
+            'mse': float(mean_squared_error(y_test, forecast[0])),
+            'aic': float(model_fit.aic),
+            'converged': converged,
+            'params': np.asarray(model_fit.params),
+            'seconds': time.perf_counter() - started,
+            'error': None
+        }
+    except Exception as e:
+        return {'order': order, 'error': str(e), 'seconds': time.perf_counter() - started}
+
+def fit_orders(y_train, y_test, orders, executor=None, fit_timeout=None):
+    """Fit several orders, across the executor's worker processes when it has them
+
+    With workers, a fit still running fit_timeout seconds after it started is
+    stopped and reported as an error. In a single process a running fit cannot
+    be interrupted, so the budget is checked between fits and the remaining
+    orders are skipped once it is spent.
+    """
+    if executor is None or not executor.parallel:
+        results = []
+        deadline = time.perf_counter() + fit_timeout * len(orders) if fit_timeout else None
+        for order in orders:
+            if deadline is not None and time.perf_counter() > deadline:
+                results.append({'order': order, 'error': 'search time budget exhausted', 'seconds': 0.0})
+                continue
+            results.append(fit_order(y_train, y_test, order))
+        return results
+
+    return executor.map(
+        functools.partial(fit_order, y_train, y_test), orders, timeout=fit_timeout,
+        on_timeout=lambda order: {'order': order, 'error': f'fit exceeded {fit_timeout}s', 'seconds': fit_timeout}
+    )
+
+def choose_differencing(y):
+    """Number of differences (up to MAX_ORDER) after which KPSS no longer rejects stationarity"""
+    d = 0
+    series = np.asarray(y, dtype=np.float64)
+    while d < MAX_ORDER and len(series) > 3:
+        with warnings.catch_warnings():
+            # Short series make KPSS warn that the p-value is outside its lookup table
+            warnings.simplefilter('ignore')
+            try:
+                p_value = kpss(series, regression='c', nlags='auto')[1]
+            except (ValueError, OverflowError, np.linalg.LinAlgError):
+                break
+        if p_value >= KPSS_ALPHA:
+            break
+        series = np.diff(series)
+        d += 1
+    return d
+
+def stepwise_search(y_train, y_test, executor=None, fit_timeout=None):
+    """AIC-guided neighbour search over (p, q) for the differencing KPSS picks
+
+    Starts from the usual four orders and moves to the best-AIC neighbour while it
+    improves. Orders that fail or do not converge are never expanded.
+    """
+    d = choose_differencing(y_train)
+    evaluated = {}
+
+    def usable(result):
+        return result['error'] is None and result['converged']
+
+    orders = list(dict.fromkeys((min(p, MAX_ORDER), d, min(q, MAX_ORDER)) for p, q in STEPWISE_START_ORDERS))
+    current = None
+    while orders:
+        for result in fit_orders(y_train, y_test, orders, executor, fit_timeout):
+            evaluated[result['order']] = result
+        candidates = [evaluated[order] for order in orders if usable(evaluated[order])]
+        best = min(candidates, key=lambda result: result['aic'], default=None)
+        if best is None or (current is not None and best['aic'] >= current['aic']):
+            break
+        current = best
+        p, _, q = current['order']
+        orders = [
+            (p + dp, d, q + dq)
+            for dp in (-1, 0, 1) for dq in (-1, 0, 1)
+            if (dp or dq) and 0 <= p + dp <= MAX_ORDER and 0 <= q + dq <= MAX_ORDER
+            and (p + dp, d, q + dq) not in evaluated
+        ]
+    return list(evaluated.values())
+
+def find_best_arima_model(y_train, y_test, strategy='grid', executor=None, fit_timeout=None):
+    """Pick the order with the lowest holdout error among the fitted candidates
+
+    'grid' fits all 27 orders; 'stepwise' fits the few its AIC-guided search
+    visits. Converged fits are preferred; a non-converged one is only chosen when
+    nothing converged. Returns (model, order, score), or (None, None, inf) when
+    every candidate failed.
+    """
+    if strategy not in SEARCH_STRATEGIES:
+        raise ValueError(f"Unknown search strategy '{strategy}', expected one of {SEARCH_STRATEGIES}")
+
+    if strategy == 'stepwise':
+        results = stepwise_search(y_train, y_test, executor, fit_timeout)
+    else:
+        orders = [(p, d, q) for p in range(MAX_ORDER + 1) for d in range(MAX_ORDER + 1) for q in range(MAX_ORDER + 1)]
+        results = fit_orders(y_train, y_test, orders, executor, fit_timeout)
+
+    fitted = [result for result in results if result['error'] is None and np.isfinite(result['mse'])]
+    if not fitted:
+        return None, None, float('inf')
+
+    best = min(fitted, key=lambda result: (not result['converged'], result['mse']))
+    best_model = ARIMA(y_train, order=best['order']).filter(best['params'])
+    return best_model, best['order'], best['mse']
 
 def mean_squared_error(actual, predicted):
     return (actual - predicted) ** 2
@@ -1,9 +1,18 @@
+import asyncio
 import boto3
 import requests
-from bs4 import BeautifulSoup
+import time
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from datetime import datetime, timedelta
+import json
 import logging
 import os
+import date_shards
+import re
+import s3_json
 from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
@@ -12,44 +21,306 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
 S3_BUCKET_NAME = os.environ['S3_BUCKET_NAME']
-GDELT_URL = 'http://data.gdeltproject.org/events/index.html'
+GDELT_BASE_URL = 'http://data.gdeltproject.org/events/'
+GDELT_URL = f'{GDELT_BASE_URL}index.html'
+S3_PREFIX = 'bronze/gdelt_data/'
+LEDGER_KEY = 'bronze/gdelt_ledger.json'
+# Marker per stored archive telling the unzip job to pick it up, even in a month it already covered
+UNZIP_PENDING_PREFIX = 'bronze/gdelt_unzip_pending/'
+
+# The index advertises sizes with one decimal place of a megabyte; whether that is 10^6
+# or 2^20 bytes, rounded or truncated, is not stated, so a size check accepts any of them
+SIZE_PATTERN = re.compile(r'([\d.]+)\s*MB', re.IGNORECASE)
+SIZE_STEP_MB = 0.1
+# Up to this many files missing from the ledger are checked with one HEAD each; more than that and
+# paging through the whole bronze prefix (1000 keys per LIST) takes fewer requests
+MAX_HEAD_CHECKS = 50
+MD5_PATTERN = re.compile(r'MD5:\s*([0-9a-fA-F]{32})')
+
+# Defaults for the asyncio ingestion mode; S3 rejects multipart parts under 5 MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE_MB = int(os.environ.get('INGESTION_PART_SIZE_MB', 8))
+DEFAULT_MAX_INFLIGHT_MB = int(os.environ.get('INGESTION_MAX_INFLIGHT_MB', 256))
+DEFAULT_MAX_CONNECTIONS = int(os.environ.get('INGESTION_MAX_CONNECTIONS', 16))
+
+# GDELT publishes one export file per day from this date on (older history comes in monthly/yearly archives)
+FIRST_DAILY_FILE_DATE = datetime(2013, 4, 1)
+DAILY_FILE_SUFFIX = '.export.CSV.zip'
 
 def lambda_handler(event, context):
-    response = requests.get(GDELT_URL)
+    options = event or {}
+    if 'backfill' in options:
+        return backfill_handler(options, context)
+
+    ledger = load_ledger()
+
+    response = requests.get(GDELT_URL, headers=conditional_headers(ledger), stream=True)
+    if response.status_code == 304:
+        logger.info("GDELT index unchanged since the last run, nothing to do.")
+        return {'statusCode': 200, 'body': 'GDELT index unchanged since the last run'}
     if response.status_code != 200:
         logger.error(f"Failed to retrieve GDELT file list: {response.status_code}")
         return {'statusCode': response.status_code, 'body': 'Failed to retrieve file list'}
 
-    soup = BeautifulSoup(response.text, 'html.parser')
-    zip_links = [link['href'] for link in soup.find_all('a', href=True) if link['href'].endswith('.zip')]
-    logger.info(f"Found {len(zip_links)} files to check.")
+    zip_links = scan_index(response)
+    logger.info(f"Found {len(zip_links)} files on the index.")
 
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = [executor.submit(process_file, zip_file) for zip_file in zip_links]
-        results = [future.result() for future in futures]
+    changed_files = [
+        zip_file for zip_file, entry in zip_links.items()
+        if zip_file in ledger['files'] and entry['md5'] and ledger['files'][zip_file].get('md5') != entry['md5']
+    ]
+    unseen_files = {
+        zip_file: entry['size'] for zip_file, entry in zip_links.items()
+        if zip_file not in ledger['files']
+    }
+    logger.info(f"{len(unseen_files)} files are not in the ledger and {len(changed_files)} changed checksum.")
+
+    pending_files = list(changed_files)
+    if unseen_files:
+        if len(unseen_files) <= MAX_HEAD_CHECKS:
+            existing_files = head_existing_files(unseen_files)
+        else:
+            existing_files = list_existing_files()
+        logger.info(f"Found {len(existing_files)} files already in S3.")
+        pending_files.extend(diff_against_inventory(unseen_files, existing_files))
+    logger.info(f"{len(pending_files)} files are missing, incomplete or changed in S3.")
 
+    results = upload_files(pending_files, options)
     new_files = sum(results)
+
+    # Files already present in S3 are recorded too, so they are not re-listed tomorrow
+    failed_files = {zip_file for zip_file, result in zip(pending_files, results) if not result}
+    for zip_file in set(unseen_files) | set(changed_files):
+        if zip_file not in failed_files:
+            ledger['files'][zip_file] = {'md5': zip_links[zip_file]['md5'], 'size': zip_links[zip_file]['size']}
+
+    # Only remember the index validators once everything on it is stored, so failures are retried
+    if not failed_files:
+        ledger['etag'] = response.headers.get('ETag')
+        ledger['last_modified'] = response.headers.get('Last-Modified')
+    save_ledger(ledger)
+
     logger.info(f"Successfully uploaded {new_files} new files to S3")
     return {
         'statusCode': 200,
         'body': f'Successfully uploaded {new_files} new files to S3'
     }
 
-def process_file(zip_file):
-    if not file_exists_in_s3(zip_file):
-        zip_url = f'http://data.gdeltproject.org/events/{zip_file}'
-        return download_and_upload_to_s3(zip_url, zip_file)
+def backfill_handler(options, context):
+    """Load the daily files of a date range, one shard of it per invocation
+
+    Without a 'shard' the invocation only fans out: it invokes this function
+    asynchronously once per shard and returns. Backfills neither read nor write
+    the ledger, so shards can run concurrently; the next daily run records the
+    files they uploaded when it sees them in the inventory.
+    """
+    backfill = options['backfill']
+    shard_count = int(backfill.get('shard_count', 1))
+    start_date = max(datetime.strptime(str(backfill['start_date']), '%Y%m%d'), FIRST_DAILY_FILE_DATE)
+    end_date = datetime.strptime(str(backfill['end_date']), '%Y%m%d')
+    if end_date < start_date:
+        return {'statusCode': 400, 'body': f'Invalid backfill range {start_date:%Y%m%d}-{end_date:%Y%m%d}'}
+
+    if 'shard' not in backfill:
+        lambda_client = boto3.client('lambda')
+        for shard in range(shard_count):
+            payload = dict(options, backfill=dict(backfill, shard=shard))
+            lambda_client.invoke(
+                FunctionName=context.invoked_function_arn,
+                InvocationType='Event',
+                Payload=json.dumps(payload)
+            )
+        logger.info(f"Started {shard_count} backfill shards for {start_date:%Y%m%d}-{end_date:%Y%m%d}")
+        return {'statusCode': 202, 'body': f'Started {shard_count} backfill shards'}
+
+    shard = int(backfill['shard'])
+    shard_range = date_shards.shard_date_range(start_date, end_date, shard, shard_count)
+    if shard_range is None:
+        return {'statusCode': 200, 'body': f'Backfill shard {shard} has no dates to load'}
+    first_date, last_date = shard_range
+    logger.info(f"Backfill shard {shard}/{shard_count} covers {first_date:%Y%m%d}-{last_date:%Y%m%d}")
+
+    zip_links = {}
+    day = first_date
+    while day <= last_date:
+        zip_links[f'{day:%Y%m%d}{DAILY_FILE_SUFFIX}'] = None
+        day += timedelta(days=1)
+
+    # The day before the slice sorts just ahead of its first file name
+    existing_files = list_existing_files(
+        start_after=f'{first_date - timedelta(days=1):%Y%m%d}{DAILY_FILE_SUFFIX}',
+        stop_after=f'{last_date:%Y%m%d}{DAILY_FILE_SUFFIX}'
+    )
+    pending_files = diff_against_inventory(zip_links, existing_files)
+    logger.info(f"{len(pending_files)} of {len(zip_links)} files in the shard are missing in S3.")
+
+    new_files = sum(upload_files(pending_files, options))
+    logger.info(f"Successfully uploaded {new_files} new files to S3")
+    return {
+        'statusCode': 200,
+        'body': f'Backfill shard {shard} uploaded {new_files} new files to S3'
+    }
+
+def upload_files(pending_files, options):
+    """Transfer the pending files and return 1 or 0 for each of them, in order
+
+    Every stored file also gets an unzip pending marker, so backfilled archives
+    in months the unzip job already covered are not skipped.
+    """
+    if options.get('mode') == 'async':
+        transfers = asyncio.run(ingest_async(
+            pending_files,
+            part_size=int(options.get('part_size_mb', DEFAULT_PART_SIZE_MB)) * 1024 * 1024,
+            max_inflight_bytes=int(options.get('max_inflight_mb', DEFAULT_MAX_INFLIGHT_MB)) * 1024 * 1024,
+            max_connections=int(options.get('max_connections', DEFAULT_MAX_CONNECTIONS))
+        ))
+        results = [1 if transfer['uploaded'] else 0 for transfer in transfers]
     else:
-        logger.info(f"File {zip_file} already exists in S3, skipping download.")
-        return 0
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            futures = [executor.submit(process_file, zip_file) for zip_file in pending_files]
+            results = [future.result() for future in futures]
 
-def file_exists_in_s3(file_name):
-    """Check if the file already exists in the S3 bucket"""
-    try:
-        s3_client.head_object(Bucket=S3_BUCKET_NAME, Key=f'bronze/gdelt_data/{file_name}')
-        return True
-    except:
-        return False
+    for zip_file, result in zip(pending_files, results):
+        if result:
+            s3_client.put_object(Bucket=S3_BUCKET_NAME, Key=f'{UNZIP_PENDING_PREFIX}{zip_file}', Body=b'')
+    return results
+
+def conditional_headers(ledger):
+    """Validators from the last complete run, so an unchanged index answers 304 Not Modified"""
+    headers = {}
+    if ledger.get('etag'):
+        headers['If-None-Match'] = ledger['etag']
+    if ledger.get('last_modified'):
+        headers['If-Modified-Since'] = ledger['last_modified']
+    return headers
+
+def load_ledger():
+    """Read the ingestion ledger from S3, or start an empty one on the first run"""
+    ledger = s3_json.load_json(s3_client, S3_BUCKET_NAME, LEDGER_KEY)
+    if ledger is None:
+        logger.info(f"No ledger found at {LEDGER_KEY}, starting a new one.")
+        return {'etag': None, 'last_modified': None, 'files': {}}
+    return ledger
+
+def save_ledger(ledger):
+    s3_json.save_json(s3_client, S3_BUCKET_NAME, LEDGER_KEY, ledger, compact=True)
+
+class IndexScanner(HTMLParser):
+    """Incremental scanner picking .zip links and the size/MD5 text that follows them, without building a DOM"""
+
+    def __init__(self):
+        super().__init__()
+        self.zip_links = {}
+        self.current = None
+        self.trailing_text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in ('a', 'li'):
+            return
+        self.finish_current()
+        if tag == 'a':
+            href = dict(attrs).get('href')
+            if href and href.endswith('.zip'):
+                self.current = href
+
+    def handle_endtag(self, tag):
+        if tag in ('li', 'ul'):
+            self.finish_current()
+
+    def handle_data(self, data):
+        if self.current is not None:
+            self.trailing_text.append(data)
+
+    def finish_current(self):
+        if self.current is None:
+            return
+        text = ''.join(self.trailing_text)
+        size_match = SIZE_PATTERN.search(text)
+        md5_match = MD5_PATTERN.search(text)
+        self.zip_links[self.current] = {
+            'size': float(size_match.group(1)) * 1024 * 1024 if size_match else None,
+            'md5': md5_match.group(1).lower() if md5_match else None
+        }
+        self.current = None
+        self.trailing_text = []
+
+    def close(self):
+        super().close()
+        self.finish_current()
+
+def scan_index(response):
+    """Stream the index response through the scanner and return {file name: {'size', 'md5'}}"""
+    scanner = IndexScanner()
+    for chunk in response.iter_content(chunk_size=64 * 1024, decode_unicode=True):
+        scanner.feed(chunk if isinstance(chunk, str) else chunk.decode('utf-8', errors='replace'))
+    scanner.close()
+    return scanner.zip_links
+
+def list_existing_files(start_after=None, stop_after=None):
+    """Page through the bronze prefix once and return a dict of file name -> object size
+
+    start_after/stop_after restrict the listing to a slice of file names, which keeps
+    a backfill shard from listing the whole archive.
+    """
+    existing_files = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    pagination = {'Bucket': S3_BUCKET_NAME, 'Prefix': S3_PREFIX}
+    if start_after:
+        pagination['StartAfter'] = f'{S3_PREFIX}{start_after}'
+    for page in paginator.paginate(**pagination):
+        for obj in page.get('Contents', []):
+            file_name = obj['Key'][len(S3_PREFIX):]
+            if stop_after and file_name > stop_after:
+                return existing_files
+            existing_files[file_name] = obj['Size']
+    return existing_files
+
+def head_existing_files(file_names):
+    """Return a dict of file name -> object size for just these files, one HEAD request each
+
+    Files that are not in the bronze prefix are left out, as in list_existing_files.
+    """
+    def head(file_name):
+        try:
+            return file_name, s3_client.head_object(Bucket=S3_BUCKET_NAME, Key=f'{S3_PREFIX}{file_name}')['ContentLength']
+        except s3_client.exceptions.NoSuchKey:
+            return file_name, None
+        except ClientError as e:
+            # HEAD responses have no body, so a missing object comes back as a bare 404
+            if e.response.get('Error', {}).get('Code') in ('404', 'NotFound'):
+                return file_name, None
+            raise
+
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        return {file_name: size for file_name, size in executor.map(head, file_names) if size is not None}
+
+def diff_against_inventory(zip_links, existing_files):
+    """Return the files that are missing from S3 or whose stored size does not match the index"""
+    pending_files = []
+    for zip_file, advertised_size in zip_links.items():
+        stored_size = existing_files.get(zip_file)
+        if stored_size is None or stored_size == 0:
+            pending_files.append(zip_file)
+        elif advertised_size is not None and not size_matches(stored_size, advertised_size):
+            logger.info(f"File {zip_file} has size {stored_size} in S3 but {advertised_size:.0f} on the index.")
+            pending_files.append(zip_file)
+    return pending_files
+
+def size_matches(stored_size, advertised_size):
+    """Whether a stored object of stored_size bytes can be the file the index lists as advertised_size
+
+    advertised_size is the index value read as MiB (see IndexScanner). The lowest
+    reading is that value rounded from 10^6-byte megabytes, the highest is it
+    truncated from MiB.
+    """
+    advertised_mb = advertised_size / (1024 * 1024)
+    lowest = (advertised_mb - SIZE_STEP_MB / 2) * 1000 * 1000
+    highest = (advertised_mb + SIZE_STEP_MB) * 1024 * 1024
+    return lowest <= stored_size <= highest
+
+def process_file(zip_file):
+    zip_url = f'{GDELT_BASE_URL}{zip_file}'
+    return download_and_upload_to_s3(zip_url, zip_file)
 
 def download_and_upload_to_s3(zip_url, zip_file):
     """Download the ZIP file and upload it to S3 using streaming"""
@@ -59,7 +330,7 @@ def download_and_upload_to_s3(zip_url, zip_file):
             session.mount('http://', HTTPAdapter(max_retries=retries))
             response = session.get(zip_url, stream=True)
             if response.status_code == 200:
-                s3_key = f'bronze/gdelt_data/{zip_file}'
+                s3_key = f'{S3_PREFIX}{zip_file}'
                 s3_client.upload_fileobj(response.raw, S3_BUCKET_NAME, s3_key)
                 logger.info(f"Successfully uploaded {zip_file} to S3")
                 return 1
@@ -69,3 +340,141 @@ def download_and_upload_to_s3(zip_url, zip_file):
     except Exception as e:
         logger.error(f"Error downloading or uploading file {zip_file}: {e}")
         return 0
+
+class InflightBudget:
+    """Byte-counting semaphore bounding how much downloaded data waits in memory for upload"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, size):
+        async with self.condition:
+            # A single part larger than the budget is still allowed through on its own
+            await self.condition.wait_for(lambda: self.used == 0 or self.used + size <= self.max_bytes)
+            self.used += size
+
+    async def release(self, size):
+        async with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+def build_pooled_session(max_connections):
+    """One requests session whose connection pool is shared by every transfer to data.gdeltproject.org"""
+    session = requests.Session()
+    retries = Retry(total=5, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections, max_retries=retries)
+    session.mount('http://', adapter)
+    return session
+
+def read_part(stream, part_size):
+    """Read exactly part_size bytes from the stream, or whatever is left before EOF"""
+    chunks = []
+    remaining = part_size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+async def ingest_async(zip_files, part_size, max_inflight_bytes, max_connections):
+    """Download the files over one pooled connection set while their parts upload to S3 concurrently"""
+    if part_size < MIN_PART_SIZE:
+        raise ValueError(f"Part size must be at least {MIN_PART_SIZE} bytes, got {part_size}")
+
+    loop = asyncio.get_running_loop()
+    session = build_pooled_session(max_connections)
+    upload_client = boto3.client('s3', config=Config(max_pool_connections=max_connections * 2))
+    budget = InflightBudget(max_inflight_bytes)
+    connections = asyncio.Semaphore(max_connections)
+    executor = ThreadPoolExecutor(max_workers=max_connections * 3)
+
+    async def run(function, *args, **kwargs):
+        return await loop.run_in_executor(executor, lambda: function(*args, **kwargs))
+
+    async def upload_part(s3_key, upload_id, part_number, body):
+        call = executor.submit(
+            upload_client.upload_part,
+            Bucket=S3_BUCKET_NAME, Key=s3_key, UploadId=upload_id, PartNumber=part_number, Body=body
+        )
+        try:
+            response = await asyncio.wrap_future(call)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        except asyncio.CancelledError:
+            # Cancelling only stops a part that has not started sending; wait for one that has
+            if not call.cancelled():
+                await asyncio.wait([asyncio.wrap_future(call)])
+            raise
+        finally:
+            await budget.release(len(body))
+
+    async def transfer(zip_file):
+        zip_url = f'{GDELT_BASE_URL}{zip_file}'
+        s3_key = f'{S3_PREFIX}{zip_file}'
+        result = {'file': zip_file, 'uploaded': False, 'bytes': 0, 'seconds': 0.0, 'mb_per_second': 0.0}
+        async with connections:
+            start = time.monotonic()
+            upload_id = None
+            part_uploads = []
+            try:
+                response = await run(session.get, zip_url, stream=True)
+                if response.status_code != 200:
+                    logger.error(f"Failed to download {zip_file} from {zip_url}: {response.status_code}")
+                    response.close()
+                    return result
+
+                multipart = await run(upload_client.create_multipart_upload, Bucket=S3_BUCKET_NAME, Key=s3_key)
+                upload_id = multipart['UploadId']
+                part_number = 1
+                while True:
+                    await budget.acquire(part_size)
+                    try:
+                        body = await run(read_part, response.raw, part_size)
+                    except Exception:
+                        await budget.release(part_size)
+                        raise
+                    if body or part_number == 1:
+                        # Give back the unused reservation of a short final part before handing it off
+                        await budget.release(part_size - len(body))
+                        part_uploads.append(asyncio.ensure_future(upload_part(s3_key, upload_id, part_number, body)))
+                        result['bytes'] += len(body)
+                        part_number += 1
+                    else:
+                        await budget.release(part_size)
+                    if len(body) < part_size:
+                        break
+                response.close()
+
+                parts = await asyncio.gather(*part_uploads)
+                await run(
+                    upload_client.complete_multipart_upload,
+                    Bucket=S3_BUCKET_NAME, Key=s3_key, UploadId=upload_id,
+                    MultipartUpload={'Parts': sorted(parts, key=lambda part: part['PartNumber'])}
+                )
+                result['uploaded'] = True
+            except Exception as e:
+                logger.error(f"Error downloading or uploading file {zip_file}: {e}")
+                # No part may still be sending when the upload is aborted, or it would be left behind
+                for part_upload in part_uploads:
+                    part_upload.cancel()
+                await asyncio.gather(*part_uploads, return_exceptions=True)
+                if upload_id is not None:
+                    await run(upload_client.abort_multipart_upload, Bucket=S3_BUCKET_NAME, Key=s3_key, UploadId=upload_id)
+                return result
+            finally:
+                result['seconds'] = time.monotonic() - start
+                if result['seconds'] > 0:
+                    result['mb_per_second'] = result['bytes'] / (1024 * 1024) / result['seconds']
+
+        logger.info(f"Successfully uploaded {zip_file} to S3: {result['bytes']} bytes in "
+                    f"{result['seconds']:.2f}s ({result['mb_per_second']:.2f} MB/s)")
+        return result
+
+    try:
+        return await asyncio.gather(*(transfer(zip_file) for zip_file in zip_files))
+    finally:
+        executor.shutdown(wait=False)
+        session.close()
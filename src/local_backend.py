@@ -0,0 +1,427 @@
+"""In-process stand-ins for the AWS services the pipeline talks to.
+
+LocalS3 keeps objects in a directory, LocalRedshiftData runs the Data API calls
+against SQLite (translating the few Redshift-only constructs the handlers use)
+and LocalLambda invokes handler modules directly. install() swaps them in for
+boto3.client, so the handler modules must be imported after calling it.
+"""
+import csv
+import hashlib
+import importlib
+import io
+import json
+import os
+import re
+import sqlite3
+import threading
+import uuid
+from datetime import date, datetime, timedelta, timezone
+
+import boto3
+
+RESULT_PAGE_SIZE = 1000
+
+
+class NoSuchKey(Exception):
+    """Raised like botocore's NoSuchKey when an object does not exist"""
+
+
+class PreconditionFailed(Exception):
+    """Raised when a conditional read's IfMatch ETag no longer matches"""
+
+
+class LocalS3:
+    """Directory-backed subset of the S3 client API; buckets are sub-directories of root"""
+
+    class exceptions:
+        NoSuchKey = NoSuchKey
+
+    def __init__(self, root):
+        self.root = root
+        self.multipart_uploads = {}
+        self.lock = threading.Lock()
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, *key.split('/'))
+
+    def _etag(self, data):
+        return f'"{hashlib.md5(data).hexdigest()}"'
+
+    def _read(self, bucket, key):
+        path = self._path(bucket, key)
+        if not os.path.isfile(path):
+            raise NoSuchKey(f"s3://{bucket}/{key}")
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _write(self, bucket, key, data):
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so concurrent readers never see a partial object
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        data = Body.read() if hasattr(Body, 'read') else Body
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._write(Bucket, Key, data)
+        return {'ETag': self._etag(data)}
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None, **kwargs):
+        data = self._read(Bucket, Key)
+        if IfMatch is not None and IfMatch != self._etag(data):
+            raise PreconditionFailed(f"s3://{Bucket}/{Key} changed")
+        if Range:
+            start, end = Range[len('bytes='):].split('-')
+            data = data[int(start):int(end) + 1]
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        data = self._read(Bucket, Key)
+        return {'ContentLength': len(data), 'ETag': self._etag(data)}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        path = self._path(Bucket, Key)
+        if os.path.isfile(path):
+            os.remove(path)
+        return {}
+
+    def _all_keys(self, bucket):
+        bucket_root = os.path.join(self.root, bucket)
+        keys = []
+        for directory, _, files in os.walk(bucket_root):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                relative = os.path.relpath(os.path.join(directory, name), bucket_root)
+                keys.append(relative.replace(os.sep, '/'))
+        return sorted(keys)
+
+    def list_objects_v2(self, Bucket, Prefix='', StartAfter=None, ContinuationToken=None, MaxKeys=1000, **kwargs):
+        after = ContinuationToken or StartAfter
+        keys = [key for key in self._all_keys(Bucket) if key.startswith(Prefix) and (after is None or key > after)]
+        page = keys[:MaxKeys]
+        contents = []
+        for key in page:
+            path = self._path(Bucket, key)
+            with open(path, 'rb') as f:
+                data = f.read()
+            contents.append({
+                'Key': key,
+                'Size': len(data),
+                'ETag': self._etag(data),
+                'LastModified': datetime.fromtimestamp(os.path.getmtime(path), tz=timezone.utc)
+            })
+        response = {'KeyCount': len(contents), 'IsTruncated': len(keys) > MaxKeys}
+        if contents:
+            response['Contents'] = contents
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = page[-1]
+        return response
+
+    def get_paginator(self, operation):
+        if operation != 'list_objects_v2':
+            raise NotImplementedError(operation)
+        return LocalPaginator(self.list_objects_v2)
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, Config=None, ExtraArgs=None, **kwargs):
+        self._write(Bucket, Key, Fileobj.read())
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        with open(Filename, 'rb') as f:
+            self._write(Bucket, Key, f.read())
+
+    def download_fileobj(self, Bucket, Key, Fileobj, **kwargs):
+        Fileobj.write(self._read(Bucket, Key))
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        with open(Filename, 'wb') as f:
+            f.write(self._read(Bucket, Key))
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = uuid.uuid4().hex
+        with self.lock:
+            self.multipart_uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        data = Body.read() if hasattr(Body, 'read') else Body
+        with self.lock:
+            self.multipart_uploads[UploadId][PartNumber] = data
+        return {'ETag': self._etag(data)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        with self.lock:
+            parts = self.multipart_uploads.pop(UploadId)
+        data = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+        self._write(Bucket, Key, data)
+        return {'ETag': self._etag(data)}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        with self.lock:
+            self.multipart_uploads.pop(UploadId, None)
+        return {}
+
+
+class LocalPaginator:
+    def __init__(self, operation):
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        token = None
+        while True:
+            response = self.operation(ContinuationToken=token, **kwargs) if token else self.operation(**kwargs)
+            yield response
+            if not response.get('IsTruncated'):
+                return
+            token = response['NextContinuationToken']
+
+
+def _to_date(value, fmt='YYYYMMDD'):
+    if value is None:
+        return None
+    value = str(value)
+    if fmt.upper() == 'YYYYMMDD':
+        return f"{value[0:4]}-{value[4:6]}-{value[6:8]}"
+    return value[:10]
+
+
+def _date_trunc(part, value):
+    if value is None:
+        return None
+    day = date.fromisoformat(str(value)[:10])
+    part = part.lower()
+    if part == 'week':
+        day -= timedelta(days=day.weekday())
+    elif part == 'month':
+        day = day.replace(day=1)
+    elif part == 'year':
+        day = day.replace(month=1, day=1)
+    return day.isoformat()
+
+
+def _add_months(value, months):
+    if value is None:
+        return None
+    day = date.fromisoformat(str(value)[:10])
+    month_index = day.year * 12 + day.month - 1 + int(months)
+    year, month = divmod(month_index, 12)
+    month += 1
+    last_day = (date(year + (month == 12), month % 12 + 1, 1) - timedelta(days=1)).day
+    return date(year, month, min(day.day, last_day)).isoformat()
+
+
+class LocalRedshiftData:
+    """SQLite-backed subset of the redshift-data client; statements run synchronously on submit"""
+
+    COPY_PATTERN = re.compile(r"^\s*COPY\s+(\w+)\s*(?:\(([^)]*)\))?\s+FROM\s+'s3://([^/]+)/([^']+)'(.*)$", re.IGNORECASE | re.DOTALL)
+    DELETE_USING_PATTERN = re.compile(r"^\s*DELETE\s+FROM\s+(\w+)\s+USING\s+(\w+)\s+WHERE\s+(.*?);?\s*$", re.IGNORECASE | re.DOTALL)
+    CREATE_LIKE_PATTERN = re.compile(r"CREATE\s+(TEMP\s+)?TABLE\s+(\w+)\s*\(\s*LIKE\s+(\w+)\s*\)", re.IGNORECASE)
+
+    def __init__(self, database_path, s3):
+        self.s3 = s3
+        self.connection = sqlite3.connect(database_path, check_same_thread=False, isolation_level=None)
+        self.connection.create_function('TO_DATE', 2, _to_date)
+        self.connection.create_function('DATE_TRUNC', 2, _date_trunc)
+        self.connection.create_function('ADD_MONTHS', 2, _add_months)
+        self.connection.create_function('GETDATE', 0, lambda: datetime.utcnow().isoformat(sep=' '))
+        self.lock = threading.Lock()
+        self.statements = {}
+
+    def translate(self, sql):
+        """Rewrite the Redshift-only syntax used by the handlers into SQLite"""
+        sql = re.sub(r'::\s*DATE\b', '', sql, flags=re.IGNORECASE)
+        sql = re.sub(r'\bDISTKEY\s*\([^)]*\)', '', sql, flags=re.IGNORECASE)
+        sql = re.sub(r'\b(?:COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)', '', sql, flags=re.IGNORECASE)
+        sql = re.sub(r'\bDOUBLE\s+PRECISION\b', 'REAL', sql, flags=re.IGNORECASE)
+        sql = re.sub(r'\bSYSDATE\b', 'GETDATE()', sql, flags=re.IGNORECASE)
+        sql = self.CREATE_LIKE_PATTERN.sub(lambda m: f"CREATE {m.group(1) or ''}TABLE {m.group(2)} AS SELECT * FROM {m.group(3)} WHERE 0", sql)
+        match = self.DELETE_USING_PATTERN.match(sql)
+        if match:
+            table, using, condition = match.groups()
+            sql = f"DELETE FROM {table} WHERE EXISTS (SELECT 1 FROM {using} WHERE {condition})"
+        return sql
+
+    def _copy(self, cursor, match):
+        table, columns, bucket, key, options = match.groups()
+        manifest = re.search(r'\bMANIFEST\b', options, re.IGNORECASE)
+        delimiter = re.search(r"DELIMITER\s+'([^']*)'", options, re.IGNORECASE)
+        delimiter = delimiter.group(1).replace('\\t', '\t') if delimiter else ','
+        ignore_header = re.search(r'IGNOREHEADER\s+(\d+)', options, re.IGNORECASE)
+        ignore_header = int(ignore_header.group(1)) if ignore_header else 0
+
+        if manifest:
+            entries = json.loads(self.s3.get_object(Bucket=bucket, Key=key)['Body'].read())['entries']
+            locations = [entry['url'][len('s3://'):].split('/', 1) for entry in entries]
+        else:
+            locations = [(bucket, key)]
+
+        if columns:
+            column_names = [column.strip() for column in columns.split(',')]
+        else:
+            column_names = [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+        # Redshift hash-joins on the leading key; without an index SQLite nested-loops the merge's joins
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {table}_{column_names[0]} ON {table} ({column_names[0]})")
+        placeholders = ', '.join('?' for _ in column_names)
+        insert = f"INSERT INTO {table} ({', '.join(column_names)}) VALUES ({placeholders})"
+
+        loaded = 0
+        for file_bucket, file_key in locations:
+            text = self.s3.get_object(Bucket=file_bucket, Key=file_key)['Body'].read().decode('utf-8')
+            reader = csv.reader(io.StringIO(text), delimiter=delimiter)
+            rows = [
+                [value if value != '' else None for value in row[:len(column_names)]]
+                for row in list(reader)[ignore_header:]
+            ]
+            cursor.executemany(insert, rows)
+            loaded += len(rows)
+        return loaded
+
+    def _run(self, cursor, sql):
+        match = self.COPY_PATTERN.match(sql)
+        if match:
+            return self._copy(cursor, match), None
+        cursor.execute(self.translate(sql))
+        if cursor.description is None:
+            return max(cursor.rowcount, 0), None
+        columns = [column[0] for column in cursor.description]
+        rows = cursor.fetchall()
+        return len(rows), (columns, rows)
+
+    def _drop_temp_tables(self, cursor):
+        # Redshift temp tables live as long as the Data API session, i.e. one statement or batch
+        for (name,) in cursor.execute("SELECT name FROM sqlite_temp_master WHERE type = 'table'").fetchall():
+            cursor.execute(f"DROP TABLE temp.{name}")
+
+    def _execute(self, sqls):
+        statement_id = uuid.uuid4().hex
+        description = {'Id': statement_id, 'Status': 'FINISHED', 'SubStatements': []}
+        results = []
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute('BEGIN')
+            try:
+                for index, sql in enumerate(sqls):
+                    result_rows, result = self._run(cursor, sql)
+                    results.append(result)
+                    description['SubStatements'].append({
+                        'Id': f"{statement_id}:{index + 1}", 'Status': 'FINISHED', 'ResultRows': result_rows
+                    })
+                cursor.execute('COMMIT')
+            except Exception as e:
+                cursor.execute('ROLLBACK')
+                description['Status'] = 'FAILED'
+                description['Error'] = f"{type(e).__name__}: {e}"
+            finally:
+                self._drop_temp_tables(cursor)
+        description['ResultRows'] = description['SubStatements'][-1]['ResultRows'] if description['SubStatements'] else 0
+        self.statements[statement_id] = (description, results[-1] if results else None)
+        for index, result in enumerate(results):
+            self.statements[f"{statement_id}:{index + 1}"] = (description['SubStatements'][index], result)
+        return statement_id
+
+    def execute_statement(self, Sql, **kwargs):
+        return {'Id': self._execute([Sql])}
+
+    def batch_execute_statement(self, Sqls, **kwargs):
+        return {'Id': self._execute(Sqls)}
+
+    def describe_statement(self, Id):
+        return dict(self.statements[Id][0])
+
+    def get_statement_result(self, Id, NextToken=None):
+        _, result = self.statements[Id]
+        columns, rows = result if result else ([], [])
+        start = int(NextToken) if NextToken else 0
+        page_rows = rows[start:start + RESULT_PAGE_SIZE]
+        response = {
+            'ColumnMetadata': [
+                {'name': name.lower(), 'typeName': self._type_name(rows, index)} for index, name in enumerate(columns)
+            ],
+            'Records': [[self._field(value) for value in row] for row in page_rows],
+            'TotalNumRows': len(rows)
+        }
+        if start + RESULT_PAGE_SIZE < len(rows):
+            response['NextToken'] = str(start + RESULT_PAGE_SIZE)
+        return response
+
+    def _type_name(self, rows, index):
+        for row in rows:
+            value = row[index]
+            if value is None:
+                continue
+            if isinstance(value, int):
+                return 'int8'
+            if isinstance(value, float):
+                return 'float8'
+            return 'varchar'
+        return 'varchar'
+
+    def _field(self, value):
+        if value is None:
+            return {'isNull': True}
+        if isinstance(value, bool):
+            return {'booleanValue': value}
+        if isinstance(value, int):
+            return {'longValue': value}
+        if isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': str(value)}
+
+
+class LocalLambda:
+    """Lambda client whose invoke calls the handler module named after the function directly"""
+
+    def invoke(self, FunctionName, Payload=b'{}', InvocationType='RequestResponse', **kwargs):
+        function_name = FunctionName.split(':')[-1]
+        handler = importlib.import_module(function_name).lambda_handler
+        context = LocalContext(function_name)
+        result = handler(json.loads(Payload or '{}'), context)
+        status_code = 202 if InvocationType == 'Event' else 200
+        return {'StatusCode': status_code, 'Payload': io.BytesIO(json.dumps(result, default=float).encode('utf-8'))}
+
+
+class LocalContext:
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.invoked_function_arn = f"arn:aws:lambda:local:000000000000:function:{function_name}"
+
+
+class LocalBackend:
+    """The three stand-ins sharing one state directory"""
+
+    def __init__(self, root):
+        os.makedirs(root, exist_ok=True)
+        self.root = root
+        self.s3 = LocalS3(os.path.join(root, 's3'))
+        self.redshift_data = LocalRedshiftData(os.path.join(root, 'redshift.sqlite'), self.s3)
+        self.lambda_client = LocalLambda()
+        self.original_client = None
+
+    def client(self, service_name, *args, **kwargs):
+        if service_name == 's3':
+            return self.s3
+        if service_name == 'redshift-data':
+            return self.redshift_data
+        if service_name == 'lambda':
+            return self.lambda_client
+        raise NotImplementedError(f"No local stand-in for {service_name}")
+
+    def install(self):
+        """Route boto3.client to the stand-ins; import the handler modules afterwards"""
+        self.original_client = boto3.client
+        boto3.client = self.client
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-2')
+        return self
+
+    def uninstall(self):
+        if self.original_client is not None:
+            boto3.client = self.original_client
+            self.original_client = None
+
+
+def install(root):
+    return LocalBackend(root).install()
@@ -1,8 +1,7 @@
 import json
-import boto3
 import cvxpy as cp
 import numpy as np
-import time
+import redshift_data
 
 def get_risk_aversion_level(risk_aversion_level):
     print(f"Getting risk aversion level for: {risk_aversion_level}")
@@ -15,6 +14,16 @@ def get_risk_aversion_level(risk_aversion_level):
     print(f"Risk aversion level (RA) set to: {RA}")
     return RA
 
+def quantile_risk_budget(RA, distance_map, n_items):
+    """Budget of the 'quantile' risk_budget mode: n_items times the RA quantile of every country's distance
+
+    The U-matrix distances are rescaled with every trained map, so this budget
+    follows their distribution where the absolute one may leave no feasible plan.
+    """
+    budget = n_items * float(np.quantile(list(distance_map.values()), RA))
+    print(f"Quantile risk budget set to: {budget}")
+    return budget
+
 def parse_items(event):
     print("Parsing items from event...")
     countries = []
@@ -51,42 +60,30 @@ def parse_items(event):
 
     return countries, cost, item_names
 
-def query_distance_table(client, workgroup_name, database, secret_arn, distance_table):
+def query_distance_table(distance_table):
     print(f"Querying distance table: {distance_table}")
     query = f"SELECT country, distance FROM {distance_table}"
-    response = client.execute_statement(
-        WorkgroupName=workgroup_name,
-        Database=database,
-        SecretArn=secret_arn,
-        Sql=query
-    )
-    
-    execution_id = response['Id']
-    print(f"Query execution ID: {execution_id}")
-    
-    while True:
-        status_response = client.describe_statement(Id=execution_id)
-        status = status_response['Status']
-        print(f"Query execution status: {status}")
-        
-        if status == 'FINISHED':
-            print("Query completed successfully.")
-            break
-        elif status == 'FAILED':
-            raise Exception(f"Query failed: {status_response['Error']}")
-        time.sleep(5)
-
-    result_response = client.get_statement_result(Id=execution_id)
-    print(f"Query result received with {len(result_response['Records'])} records.")
-    return result_response['Records']
-
-def build_distance_map(records):
+    try:
+        # One transaction, so the version read is the one of the rows read
+        status_response = redshift_data.run_batch([redshift_data.snapshot_version_sql(distance_table), query])
+        version_statement, distance_statement = status_response['SubStatements']
+        versions = [version for (version,) in redshift_data.iter_records(version_statement['Id'])]
+        print(f"Reading snapshot {versions[0] if versions else None} of {distance_table}.")
+    except redshift_data.StatementFailedError as e:
+        # Before the first swap there is no snapshot table to read the version from
+        print(f"No snapshot version available ({e.error}), reading {distance_table} directly.")
+        distance_statement = redshift_data.run_statement(query)
+    print("Query completed successfully.")
+
+    columns = redshift_data.fetch_columns(distance_statement['Id'])
+    print(f"Query result received with {len(columns.get('country', []))} records.")
+    return columns
+
+def build_distance_map(columns):
     print("Building distance map from records...")
     distance_map = {}
-    for record in records:
-        country_code = record[0]['stringValue']
-        distance = float(record[1]['stringValue'])
-        distance_map[country_code] = distance
+    for country_code, distance in zip(columns.get('country', []), columns.get('distance', [])):
+        distance_map[country_code] = float(distance)
     print(f"Distance map: {distance_map}")
     return distance_map
 
@@ -133,6 +130,8 @@ def solve_optimization_problem(cost, distance, RA, n_items, n_countries):
 def format_result(xi, item_names, countries, n_items, n_countries):
     print("Formatting optimization results...")
     print(f"countries {countries}")
+    if xi.value is None:
+        raise ValueError("No assignment of items to countries meets the risk aversion budget")
     result = []
     for i in range(n_items):
         for c in range(n_countries):
@@ -142,12 +141,6 @@ def format_result(xi, item_names, countries, n_items, n_countries):
     return result
 
 def lambda_handler(event, context):
-   
-    client = boto3.client('redshift-data')
-    
-    workgroup_name = 'default-workgroup'
-    database = 'dev'
-    secret_arn = 'arn:aws:secretsmanager:us-east-2:339713000240:secret:prod-dw-access-H7nfCP'
     distance_table = 'distance'
     
     try:
@@ -157,11 +150,15 @@ def lambda_handler(event, context):
         n_countries = len(countries)
         n_items = len(item_names)
         
-        records = query_distance_table(client, workgroup_name, database, secret_arn, distance_table)
-        distance_map = build_distance_map(records)
+        columns = query_distance_table(distance_table)
+        distance_map = build_distance_map(columns)
         distance = calculate_distances(countries, distance_map)
         
         validate_distances(distance, countries)
+
+        # 'absolute' usa o RA como orçamento total; 'quantile' o escala pela distribuição das distâncias
+        if event.get('risk_budget', 'absolute') == 'quantile':
+            RA = quantile_risk_budget(RA, distance_map, n_items)
         
         xi = solve_optimization_problem(cost, distance, RA, n_items, n_countries)
         print(f"xi:{xi.value}")
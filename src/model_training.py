@@ -1,164 +1,134 @@
 import boto3
 import json
+import redshift_data
 import time
-import pickle
+import weekly_metrics
 import numpy as np
-from minisom import MiniSom
+import batch_som
+import som_artifact
+import som_search
+
+SEARCH_RESULTS_KEY = 'dependencies/som_search_results.json'
+# Seconds of the Lambda timeout kept for serializing and uploading the model after training
+UPLOAD_MARGIN_SECONDS = 30
 
 def lambda_handler(event, context):
-    client = boto3.client('redshift-data')
     s3_client = boto3.client('s3')
     
-    workgroup_name = 'default-workgroup'
-    database = 'dev'
-    secret_arn = 'arn:aws:secretsmanager:us-east-2:339713000240:secret:prod-dw-access-H7nfCP'
-    s3_bucket = 'gdelt-project'
-    s3_key = 'dependencies/minisom_model.pkl'
+    s3_bucket = som_artifact.S3_BUCKET
+    s3_key = som_artifact.ARTIFACT_KEY
 
     # Recebendo o número de meses como parâmetro do evento
-    num_months = event.get('num_months', -4)  # Valor padrão de -4 se não for especificado
-
-    query = f"""
-    WITH recent_weeks AS (
-        SELECT DISTINCT DATE_TRUNC('week', TO_DATE(SQLDATE, 'YYYYMMDD')) AS Week
-        FROM gdelt_event
-        WHERE TO_DATE(SQLDATE, 'YYYYMMDD') >= ADD_MONTHS(DATE_TRUNC('week', CURRENT_DATE), {num_months})
-    )
-    SELECT 
-        aggregated_data.Week,
-        aggregated_data.TotalMentions,
-        aggregated_data.TotalSources,
-        aggregated_data.TotalArticles,
-        median_data.AvgTone AS MedianAvgTone,
-        median_data.GoldsteinScale AS MedianGoldsteinScale
-    FROM 
-        (
-            SELECT
-                DATE_TRUNC('week', TO_DATE(SQLDATE, 'YYYYMMDD')) AS Week,
-                SUM(NumMentions) AS TotalMentions,
-                SUM(NumSources) AS TotalSources,
-                SUM(NumArticles) AS TotalArticles
-            FROM 
-                gdelt_event
-            WHERE 
-                EventRootCode IN ('6', '7', '13', '14', '15', '16', '17', '18', '19', '20')
-                AND TO_DATE(SQLDATE, 'YYYYMMDD') >= ADD_MONTHS(DATE_TRUNC('week', CURRENT_DATE), {num_months})
-            GROUP BY 
-                DATE_TRUNC('week', TO_DATE(SQLDATE, 'YYYYMMDD'))
-        ) AS aggregated_data
-    JOIN 
-        (
-            SELECT 
-                Week,
-                AVG(AvgTone) AS AvgTone,
-                AVG(GoldsteinScale) AS GoldsteinScale
-            FROM (
-                SELECT 
-                    DATE_TRUNC('week', TO_DATE(SQLDATE, 'YYYYMMDD')) AS Week,
-                    AvgTone,
-                    GoldsteinScale,
-                    NTILE(2) OVER (PARTITION BY DATE_TRUNC('week', TO_DATE(SQLDATE, 'YYYYMMDD')) ORDER BY AvgTone) AS tone_ntile,
-                    NTILE(2) OVER (PARTITION BY DATE_TRUNC('week', TO_DATE(SQLDATE, 'YYYYMMDD')) ORDER BY GoldsteinScale) AS goldstein_ntile
-                FROM 
-                    gdelt_event
-                WHERE 
-                    EventRootCode IN ('6', '7', '13', '14', '15', '16', '17', '18', '19', '20')
-                    AND TO_DATE(SQLDATE, 'YYYYMMDD') >= ADD_MONTHS(DATE_TRUNC('week', CURRENT_DATE), {num_months})
-            ) AS subquery
-            WHERE tone_ntile = 1 AND goldstein_ntile = 1
-            GROUP BY 
-                Week
-        ) AS median_data
-    ON 
-        aggregated_data.Week = median_data.Week
-    WHERE aggregated_data.Week IN (SELECT Week FROM recent_weeks)
-    ORDER BY 
-        aggregated_data.Week DESC;
-    """
+    options = event or {}
+    num_months = options.get('num_months', -4)  # Valor padrão de -4 se não for especificado
+    # 'batch' treina o SOM em lote com NumPy; 'minisom' mantém o treino amostra a amostra do MiniSom;
+    # 'search' treina uma grade de configurações em paralelo e publica a melhor
+    training_mode = options.get('training_mode', 'batch')
+
+    # Uma linha por (país, semana) da tabela agregada weekly_country_metrics
+    query = weekly_metrics.weekly_series_sql(num_months=num_months)
 
     try:
-        response = client.execute_statement(
-            WorkgroupName=workgroup_name,
-            Database=database,
-            SecretArn=secret_arn,
-            Sql=query
-        )
-        
-        execution_id = response['Id']
-        print(f"Query execution ID: {execution_id}")
-        
-        while True:
-            status_response = client.describe_statement(Id=execution_id)
-            status = status_response['Status']
-            print(f"Query execution status: {status}")
-            
-            if status == 'FINISHED':
-                print("Query completed successfully.")
-                break
-            elif status == 'FAILED':
-                print(f"Query failed: {status_response['Error']}")
-                return {
-                    'statusCode': 500,
-                    'body': json.dumps(f"Query failed with error: {status_response['Error']}")
-                }
-            else:
-                print("Waiting for query to complete...")
-                time.sleep(5)
-
-        result_response = client.get_statement_result(Id=execution_id)
-        records = result_response['Records']
-
-        data = {
-            'Week': [],
-            'TotalMentions': [],
-            'TotalSources': [],
-            'TotalArticles': [],
-            'MedianAvgTone': [],
-            'MedianGoldsteinScale': []
-        }
+        status_response = redshift_data.run_statement(query)
+        print("Query completed successfully.")
+
+        data = weekly_metrics.series_from_columns(redshift_data.fetch_columns(status_response['Id']))
 
-        for record in records:
-            week_str = record[0]['stringValue'].split(" ")[0]
-            data['Week'].append(week_str)
-            data['TotalMentions'].append(float(record[1]['longValue']))
-            data['TotalSources'].append(float(record[2]['longValue']))
-            data['TotalArticles'].append(float(record[3]['longValue']))
-            data['MedianAvgTone'].append(float(record[4]['stringValue']))
-            data['MedianGoldsteinScale'].append(float(record[5]['stringValue']))
-
-        # Prepare data for MiniSom and convert to NumPy array
-        X_train = np.array([
-            [
-                data['TotalMentions'][i],
-                data['TotalSources'][i],
-                data['TotalArticles'][i],
-                data['MedianAvgTone'][i],
-                data['MedianGoldsteinScale'][i]
-            ]
-            for i in range(len(data['Week']))
-        ])
-
-        # Initialize and train the MiniSom model
-        print(f"X_Train: {X_train}")
-        som = MiniSom(5, 5, X_train.shape[1], sigma=1.0, learning_rate=0.5)
-        som.random_weights_init(X_train)
-        som.train_random(X_train, 100)
-
-        # Serialize the MiniSom model
-        with open('/tmp/minisom_model.pkl', 'wb') as f:
-            pickle.dump(som, f)
+        # Prepare data for the SOM and convert to NumPy array, without incomplete weeks
+        X_train = np.column_stack([data[column] for column in weekly_metrics.METRIC_COLUMNS]).astype(np.float64)
+        X_train = X_train[~np.isnan(X_train).any(axis=1)]
+        print(f"X_Train: {X_train.shape[0]} rows, {X_train.shape[1]} features")
+
+        # A padronização é ajustada aqui e guardada com o modelo, para o distance usar a mesma escala
+        mean, scale = batch_som.fit_scaling(X_train)
+        X_scaled = (X_train - mean) / scale
+        deadline = training_deadline(context)
+
+        if training_mode == 'search':
+            results, som = som_search.search(
+                X_scaled, mean, scale, options.get('search_grid'), options.get('max_workers'),
+                deadline, options.get('selection', 'combined')
+            )
+            print_search_results(results)
+            if som is None:
+                raise ValueError("Every SOM configuration in the search failed")
+            config = next(row for row in results if row['best'])
+        else:
+            config = training_config(training_mode, options)
+            som = som_search.train_som(X_scaled, mean, scale, config, deadline)
+            results = None
+        print(f"Trained {config['training_mode']} {config['x']}x{config['y']} SOM in {som.epochs_trained} iterations.")
+
+        # Serialize the SOM model as a compact .npz (pesos, mapa U, escala e hash)
+        metadata = {
+            'config': {key: config[key] for key in som_search.DEFAULT_CONFIG},
+            'epochs': som.epochs_trained,
+            'rows': int(X_train.shape[0]),
+            'quantization_error': som.quantization_error(X_scaled),
+            'topographic_error': som.topographic_error(X_scaled)
+        }
+        with open('/tmp/som_model.npz', 'wb') as f:
+            sha256 = som_artifact.write_artifact(f, som, metadata)
 
         # Upload the model to S3
-        s3_client.upload_file('/tmp/minisom_model.pkl', s3_bucket, s3_key)
+        s3_client.upload_file('/tmp/som_model.npz', s3_bucket, s3_key)
+        print(f"Uploaded SOM model {sha256}.")
+
+        # A tabela completa da busca vai junto, para escolher o tamanho do mapa pelo custo e pela qualidade
+        if results is not None:
+            s3_client.put_object(
+                Bucket=s3_bucket,
+                Key=SEARCH_RESULTS_KEY,
+                Body=json.dumps({'sha256': sha256, 'selection': options.get('selection', 'combined'), 'rows': int(X_train.shape[0]), 'results': results}).encode('utf-8'),
+                ContentType='application/json'
+            )
+            print(f"Uploaded {len(results)} search results to s3://{s3_bucket}/{SEARCH_RESULTS_KEY}")
 
         return {
             'statusCode': 200,
-            'body': json.dumps(f"MiniSom model successfully saved to s3://{s3_bucket}/{s3_key}")
+            'body': json.dumps(f"SOM model successfully saved to s3://{s3_bucket}/{s3_key}")
         }
     
+    except redshift_data.RedshiftDataError as e:
+        print(f"Query failed: {e.error}")
+        return {
+            'statusCode': 500,
+            'body': json.dumps(f"Query failed with error: {e.error}")
+        }
+
     except Exception as e:
         print(f"Error executing the query or training the model: {str(e)}")
         return {
             'statusCode': 500,
             'body': json.dumps(f"Error executing the query or training the model: {str(e)}")
         }
+
+def training_deadline(context):
+    """time.monotonic() value by which training must stop to leave time for the upload, or None outside Lambda"""
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    return time.monotonic() + context.get_remaining_time_in_millis() / 1000 - UPLOAD_MARGIN_SECONDS
+
+def training_config(training_mode, options):
+    """The single configuration to train, from the event's map_size, sigma, learning_rate and iterations"""
+    x, y = options.get('map_size', [som_search.DEFAULT_CONFIG['x'], som_search.DEFAULT_CONFIG['y']])
+    return {
+        'training_mode': training_mode,
+        'x': int(x),
+        'y': int(y),
+        'sigma': options.get('sigma', som_search.DEFAULT_CONFIG['sigma']),
+        'learning_rate': options.get('learning_rate', som_search.DEFAULT_CONFIG['learning_rate']),
+        # 'epochs' é o nome antigo de 'iterations' no modo batch
+        'iterations': options.get('iterations', options.get('epochs', som_search.DEFAULT_CONFIG['iterations'])),
+        'random_seed': options.get('random_seed'),
+    }
+
+def print_search_results(results):
+    print(f"{'mode':<8} {'size':>6} {'sigma':>6} {'lr':>5} {'iter':>5} {'qe':>8} {'te':>7} {'seconds':>8}")
+    for row in results:
+        if row['error'] is not None:
+            print(f"{row['training_mode']:<8} {row['x']}x{row['y']:<4} failed: {row['error']}")
+            continue
+        print(f"{row['training_mode']:<8} {str(row['x']) + 'x' + str(row['y']):>6} {str(row['sigma']):>6} {str(row['learning_rate']):>5} "
+              f"{row['iterations']:>5} {row['quantization_error']:>8.4f} {row['topographic_error']:>7.4f} {row['seconds']:>8.3f}"
+              f"{'  *' if row['best'] else ''}")
@@ -0,0 +1,356 @@
+"""End-to-end benchmark of the pipeline against the local_backend stand-ins.
+
+Generates synthetic GDELT daily export files, serves them like the GDELT index
+and runs every Step Function stage in-process, reporting wall time, rows per
+second and peak memory per stage:
+
+    python src/pipeline_benchmark.py --days 63 --events-per-day 20000 --countries 10
+
+The Glue unzip job needs awsglue/pyspark, so the unzip stage is an in-process
+equivalent writing the same keys. Peak memory is measured per stage with
+tracemalloc, which inflates the wall time of allocation-heavy stages; compare
+timings from runs with --no-trace-memory.
+"""
+import argparse
+import functools
+import hashlib
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+from datetime import date, timedelta
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import local_backend
+
+BUCKET = 'gdelt-project'
+STAGES = ['ingestion', 'unzip', 'redshift_load', 'model_training', 'execution', 'distance', 'minimize']
+EXAMPLE_EVENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'example.json')
+
+# Root codes the rollup keeps, plus a few it filters out
+CONFLICT_ROOT_CODES = ['6', '7', '13', '14', '15', '16', '17', '18', '19', '20']
+OTHER_ROOT_CODES = ['1', '2', '3', '4', '5']
+
+
+def actor_columns(actor):
+    return [(f"{actor}{suffix}", 'VARCHAR(256)') for suffix in [
+        'Code', 'Name', 'CountryCode', 'KnownGroupCode', 'EthnicCode',
+        'Religion1Code', 'Religion2Code', 'Type1Code', 'Type2Code', 'Type3Code'
+    ]]
+
+
+def geo_columns(geo):
+    return [
+        (f"{geo}_Type", 'INTEGER'),
+        (f"{geo}_FullName", 'VARCHAR(256)'),
+        (f"{geo}_CountryCode", 'VARCHAR(8)'),
+        (f"{geo}_ADM1Code", 'VARCHAR(16)'),
+        (f"{geo}_Lat", 'DOUBLE PRECISION'),
+        (f"{geo}_Long", 'DOUBLE PRECISION'),
+        (f"{geo}_FeatureID", 'VARCHAR(64)'),
+    ]
+
+
+# Same 58-column layout as gdelt_event_schema in unzip_job.py
+GDELT_EVENT_COLUMNS = (
+    [
+        ('GLOBALEVENTID', 'BIGINT'),
+        ('SQLDATE', 'INTEGER'),
+        ('MonthYear', 'INTEGER'),
+        ('Year', 'INTEGER'),
+        ('FractionDate', 'DOUBLE PRECISION'),
+    ]
+    + actor_columns('Actor1')
+    + actor_columns('Actor2')
+    + [
+        ('IsRootEvent', 'INTEGER'),
+        ('EventCode', 'VARCHAR(8)'),
+        ('EventBaseCode', 'VARCHAR(8)'),
+        ('EventRootCode', 'VARCHAR(8)'),
+        ('QuadClass', 'INTEGER'),
+        ('GoldsteinScale', 'DOUBLE PRECISION'),
+        ('NumMentions', 'INTEGER'),
+        ('NumSources', 'INTEGER'),
+        ('NumArticles', 'INTEGER'),
+        ('AvgTone', 'DOUBLE PRECISION'),
+    ]
+    + geo_columns('Actor1Geo')
+    + geo_columns('Actor2Geo')
+    + geo_columns('ActionGeo')
+    + [
+        ('DATEADDED', 'INTEGER'),
+        ('SOURCEURL', 'VARCHAR(1024)'),
+    ]
+)
+COLUMN_INDEX = {name: index for index, (name, _) in enumerate(GDELT_EVENT_COLUMNS)}
+
+TABLE_DDL = [
+    "CREATE TABLE IF NOT EXISTS gdelt_event ({});".format(
+        ', '.join(f"{name} {data_type}" for name, data_type in GDELT_EVENT_COLUMNS)
+    ),
+    """
+    CREATE TABLE IF NOT EXISTS forecast (
+        country VARCHAR(8),
+        TotalMentions DOUBLE PRECISION,
+        TotalSources DOUBLE PRECISION,
+        TotalArticles DOUBLE PRECISION,
+        MedianAvgTone DOUBLE PRECISION,
+        MedianGoldsteinScale DOUBLE PRECISION
+    );
+    """,
+    "CREATE TABLE IF NOT EXISTS distance (country VARCHAR(8), distance DOUBLE PRECISION);",
+]
+
+
+def example_countries():
+    with open(EXAMPLE_EVENT) as f:
+        event = json.load(f)
+    countries = []
+    for item in event['items']:
+        for country_costs in item.values():
+            for country_cost in country_costs:
+                countries.extend(country for country in country_cost if country not in countries)
+    return countries
+
+
+def synthetic_events(day, first_event_id, events, countries, rng):
+    """Tab-separated GDELT export rows for one day"""
+    sql_date = int(day.strftime('%Y%m%d'))
+    lines = []
+    for event_id in range(first_event_id, first_event_id + events):
+        root_code = rng.choice(CONFLICT_ROOT_CODES if rng.random() < 0.7 else OTHER_ROOT_CODES)
+        country = rng.choice(countries)
+        row = [''] * len(GDELT_EVENT_COLUMNS)
+        row[COLUMN_INDEX['GLOBALEVENTID']] = str(event_id)
+        row[COLUMN_INDEX['SQLDATE']] = str(sql_date)
+        row[COLUMN_INDEX['MonthYear']] = day.strftime('%Y%m')
+        row[COLUMN_INDEX['Year']] = str(day.year)
+        row[COLUMN_INDEX['FractionDate']] = f"{day.year + (day.timetuple().tm_yday - 1) / 365:.4f}"
+        row[COLUMN_INDEX['IsRootEvent']] = '1'
+        row[COLUMN_INDEX['EventCode']] = f"{root_code}0"
+        row[COLUMN_INDEX['EventBaseCode']] = f"{root_code}0"
+        row[COLUMN_INDEX['EventRootCode']] = root_code
+        row[COLUMN_INDEX['QuadClass']] = str(rng.randint(1, 4))
+        row[COLUMN_INDEX['GoldsteinScale']] = f"{rng.uniform(-10, 10):.1f}"
+        row[COLUMN_INDEX['NumMentions']] = str(rng.randint(1, 50))
+        row[COLUMN_INDEX['NumSources']] = str(rng.randint(1, 10))
+        row[COLUMN_INDEX['NumArticles']] = str(rng.randint(1, 50))
+        row[COLUMN_INDEX['AvgTone']] = f"{rng.gauss(-2, 3):.4f}"
+        row[COLUMN_INDEX['ActionGeo_Type']] = '1'
+        row[COLUMN_INDEX['ActionGeo_CountryCode']] = country
+        row[COLUMN_INDEX['ActionGeo_FullName']] = country
+        row[COLUMN_INDEX['DATEADDED']] = str(sql_date)
+        row[COLUMN_INDEX['SOURCEURL']] = f"http://example.com/{event_id}"
+        lines.append('\t'.join(row))
+    return '\n'.join(lines) + '\n'
+
+
+def generate_gdelt_files(directory, days, events_per_day, countries, seed):
+    """Write one zipped export file per day up to today plus an index.html like GDELT's; returns the event count"""
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    today = date.today()
+    entries = []
+    for offset in range(days):
+        day = today - timedelta(days=offset)
+        csv_name = f"{day:%Y%m%d}.export.CSV"
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(csv_name, synthetic_events(day, offset * events_per_day + 1, events_per_day, countries, rng))
+        content = buffer.getvalue()
+        with open(os.path.join(directory, f"{csv_name}.zip"), 'wb') as f:
+            f.write(content)
+        entries.append(
+            f'<LI><A HREF="{csv_name}.zip">{csv_name}.zip</A> '
+            f'{len(content) / (1024 * 1024):.1f}MB (MD5: {hashlib.md5(content).hexdigest()})'
+        )
+    with open(os.path.join(directory, 'index.html'), 'w') as f:
+        f.write("<HTML><BODY><UL>\n" + "\n".join(entries) + "\n</UL></BODY></HTML>\n")
+    return days * events_per_day
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_directory(directory):
+    """Serve the generated files over HTTP on a free local port; returns the server"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def unzip_archives(s3_client):
+    """In-process equivalent of unzip_job.py: extract every bronze archive next to the others"""
+    extracted = 0
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=BUCKET, Prefix='bronze/gdelt_data/'):
+        for obj in page.get('Contents', []):
+            if not obj['Key'].endswith('.zip'):
+                continue
+            buffer = io.BytesIO()
+            s3_client.download_fileobj(BUCKET, obj['Key'], buffer)
+            with zipfile.ZipFile(buffer) as archive:
+                for filename in archive.namelist():
+                    with archive.open(filename) as file:
+                        s3_client.upload_fileobj(file, BUCKET, f"bronze/gdelt_data_unzip/{filename}")
+                    extracted += 1
+    return {'statusCode': 200, 'body': json.dumps(f"Extracted {extracted} files")}
+
+
+def count_rows(backend, table):
+    with backend.redshift_data.lock:
+        return backend.redshift_data.connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+
+def minimize_event(countries):
+    """The example request restricted to the generated countries"""
+    with open(EXAMPLE_EVENT) as f:
+        event = json.load(f)
+    items = []
+    for item in event['items']:
+        for item_name, country_costs in item.items():
+            kept = [country_cost for country_cost in country_costs if set(country_cost) <= set(countries)]
+            if kept:
+                items.append({item_name: kept})
+    event['items'] = items
+    # The synthetic countries rarely fit the absolute budgets, so the budget follows their distances
+    event['risk_budget'] = 'quantile'
+    return event
+
+
+def run_stage(name, function, rows, trace_memory=True):
+    """Run one stage and measure it; rows is called afterwards to count what the stage produced"""
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    result = function()
+    seconds = time.perf_counter() - started
+    peak_bytes = None
+    if trace_memory:
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    produced = rows()
+    return {
+        'stage': name,
+        'status': result.get('statusCode') if isinstance(result, dict) else None,
+        'seconds': round(seconds, 3),
+        'rows': produced,
+        'rows_per_second': round(produced / seconds, 1) if seconds > 0 else None,
+        'peak_traced_mb': round(peak_bytes / (1024 * 1024), 1) if peak_bytes is not None else None,
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+
+def run_benchmark(args):
+    countries = example_countries()[:args.countries]
+    backend = local_backend.install(os.path.join(args.workdir, 'backend'))
+    os.environ['S3_BUCKET_NAME'] = BUCKET
+
+    print(f"Generating {args.days} days x {args.events_per_day} events for {len(countries)} countries...")
+    total_events = generate_gdelt_files(os.path.join(args.workdir, 'gdelt'), args.days, args.events_per_day, countries, args.seed)
+    server = serve_directory(os.path.join(args.workdir, 'gdelt'))
+
+    # Handlers create their clients at import time, so they are imported once the stand-ins are in place
+    import distance
+    import execution
+    import ingestion_function
+    import minimize
+    import model_training
+    import redshift_data
+    import redshift_load
+    import weekly_metrics
+
+    ingestion_function.GDELT_BASE_URL = f"http://127.0.0.1:{server.server_address[1]}/"
+    ingestion_function.GDELT_URL = f"{ingestion_function.GDELT_BASE_URL}index.html"
+    redshift_data.run_batch(TABLE_DDL)
+
+    stages = {
+        'ingestion': (
+            lambda: ingestion_function.lambda_handler({'mode': args.ingestion_mode}, None),
+            lambda: total_events
+        ),
+        'unzip': (lambda: unzip_archives(backend.s3), lambda: total_events),
+        'redshift_load': (lambda: redshift_load.lambda_handler({}, None), lambda: count_rows(backend, 'gdelt_event')),
+        'model_training': (
+            lambda: model_training.lambda_handler({}, None),
+            lambda: count_rows(backend, weekly_metrics.ROLLUP_TABLE)
+        ),
+        'execution': (
+            lambda: execution.lambda_handler({'forecast_mode': args.forecast_mode, 'forecast_engine': args.forecast_engine}, None),
+            lambda: count_rows(backend, 'forecast')
+        ),
+        'distance': (lambda: distance.lambda_handler({}, None), lambda: count_rows(backend, 'distance')),
+        'minimize': (
+            lambda: minimize.lambda_handler(minimize_event(countries), None),
+            lambda: len(minimize_event(countries)['items'])
+        ),
+    }
+
+    report = []
+    try:
+        for stage in args.stages:
+            function, rows = stages[stage]
+            print(f"Running {stage}...")
+            report.append(run_stage(stage, function, rows, args.trace_memory))
+    finally:
+        server.shutdown()
+        backend.uninstall()
+    return report
+
+
+def print_report(report):
+    header = f"{'stage':<16}{'status':>8}{'seconds':>10}{'rows':>10}{'rows/s':>12}{'peak MB':>10}{'rss MB':>10}"
+    print(header)
+    print('-' * len(header))
+    for stage in report:
+        print(
+            f"{stage['stage']:<16}{str(stage['status']):>8}{stage['seconds']:>10.3f}{stage['rows']:>10}"
+            f"{str(stage['rows_per_second']):>12}{str(stage['peak_traced_mb']):>10}{stage['max_rss_mb']:>10.1f}"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--workdir', help="Directory for the generated files and local backend state (default: a temp dir)")
+    parser.add_argument('--days', type=int, default=63, help="Days of daily export files ending today")
+    parser.add_argument('--events-per-day', type=int, default=2000)
+    parser.add_argument('--countries', type=int, default=10, help="Countries taken from example.json")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--ingestion-mode', choices=['threads', 'async'], default='threads')
+    parser.add_argument('--forecast-mode', choices=['batch', 'lambda'], default='batch')
+    parser.add_argument('--forecast-engine', choices=['arima', 'vectorized'], default='arima')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--no-trace-memory', dest='trace_memory', action='store_false',
+        help="Skip tracemalloc, which slows allocation-heavy stages down several times"
+    )
+    parser.add_argument('--output', help="Also write the report as JSON to this file")
+    args = parser.parse_args(argv)
+
+    keep_workdir = args.workdir is not None
+    args.workdir = args.workdir or tempfile.mkdtemp(prefix='pipeline_benchmark_')
+    try:
+        report = run_benchmark(args)
+    finally:
+        if not keep_workdir:
+            shutil.rmtree(args.workdir, ignore_errors=True)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0 if all(stage['status'] == 200 for stage in report) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,352 @@
+"""Shared Redshift Data API access for the Lambda handlers.
+
+One module-level client (created once per container, with a connection pool
+sized for the handlers' worker threads) and statement polling with exponential
+backoff, so a short query is picked up after tens of milliseconds instead of a
+fixed five second sleep.
+"""
+import csv
+import io
+import math
+import os
+import time
+import uuid
+
+import boto3
+import numpy as np
+from botocore.config import Config
+
+WORKGROUP_NAME = 'default-workgroup'
+DATABASE = 'dev'
+SECRET_ARN = 'arn:aws:secretsmanager:us-east-2:339713000240:secret:prod-dw-access-H7nfCP'
+IAM_ROLE = 'arn:aws:iam::339713000240:role/RedshiftRole'
+STAGING_BUCKET = 'gdelt-project'
+STAGING_PREFIX = 'temp/bulk_write/'
+
+# Up to this many rows are written with multi-row INSERTs; larger writes go through S3 and COPY
+MAX_INSERT_ROWS = 5000
+# Rows per INSERT statement, keeping each statement well under the Data API's 100 KB SQL limit
+INSERT_CHUNK_ROWS = 500
+
+# One row per swap of a table refreshed by replace_table, the newest being the live snapshot
+SNAPSHOT_TABLE = 'table_snapshots'
+CREATE_SNAPSHOT_TABLE_SQL = f"""
+CREATE TABLE IF NOT EXISTS {SNAPSHOT_TABLE} (
+    table_name VARCHAR(128) NOT NULL,
+    version VARCHAR(32) NOT NULL,
+    row_count BIGINT,
+    created_at TIMESTAMP
+);
+"""
+# Snapshots kept per table by replace_table, the live one included; older ones are dropped with their rows
+SNAPSHOT_RETENTION = 3
+
+# Handlers fan out to up to 50 threads; the default pool of 10 connections would serialize them
+MAX_POOL_CONNECTIONS = int(os.environ.get('REDSHIFT_DATA_MAX_CONNECTIONS', 50))
+
+# Data API column type names, grouped by the NumPy dtype their values decode to
+INTEGER_TYPES = {'int2', 'int4', 'int8', 'smallint', 'integer', 'bigint', 'serial', 'bigserial'}
+FLOAT_TYPES = {'float4', 'float8', 'float', 'real', 'double precision', 'numeric', 'decimal'}
+BOOLEAN_TYPES = {'bool', 'boolean'}
+
+POLL_INITIAL_DELAY = 0.02
+POLL_MAX_DELAY = 2.0
+POLL_BACKOFF = 1.5
+
+client = boto3.client(
+    'redshift-data',
+    config=Config(max_pool_connections=MAX_POOL_CONNECTIONS, retries={'max_attempts': 10, 'mode': 'adaptive'})
+)
+
+
+class RedshiftDataError(Exception):
+    """Base class for statements that did not finish successfully"""
+
+    def __init__(self, statement_id, message):
+        super().__init__(message)
+        self.statement_id = statement_id
+        self.error = message
+
+
+class StatementFailedError(RedshiftDataError):
+    """Redshift reported the statement as FAILED"""
+
+
+class StatementAbortedError(RedshiftDataError):
+    """The statement was cancelled before it finished"""
+
+
+class StatementTimeoutError(RedshiftDataError):
+    """The statement was still running when the caller's timeout expired"""
+
+
+def execute_statement(sql):
+    """Submit one statement and return its id without waiting for it"""
+    response = client.execute_statement(
+        WorkgroupName=WORKGROUP_NAME,
+        Database=DATABASE,
+        SecretArn=SECRET_ARN,
+        Sql=sql
+    )
+    return response['Id']
+
+
+def batch_execute_statement(sqls):
+    """Submit several statements that run in order in a single transaction and return the batch id"""
+    response = client.batch_execute_statement(
+        WorkgroupName=WORKGROUP_NAME,
+        Database=DATABASE,
+        SecretArn=SECRET_ARN,
+        Sqls=sqls
+    )
+    return response['Id']
+
+
+def wait_for_statement(statement_id, timeout=None):
+    """Poll a statement with exponential backoff until it finishes and return its description
+
+    Raises StatementFailedError, StatementAbortedError or StatementTimeoutError when it
+    does not finish successfully.
+    """
+    delay = POLL_INITIAL_DELAY
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while True:
+        description = client.describe_statement(Id=statement_id)
+        status = description['Status']
+        if status == 'FINISHED':
+            return description
+        if status == 'FAILED':
+            raise StatementFailedError(statement_id, description.get('Error', 'unknown error'))
+        if status == 'ABORTED':
+            raise StatementAbortedError(statement_id, f"Statement {statement_id} was aborted")
+        if deadline is not None and time.monotonic() + delay > deadline:
+            raise StatementTimeoutError(statement_id, f"Statement {statement_id} still {status} after {timeout}s")
+        time.sleep(delay)
+        delay = min(delay * POLL_BACKOFF, POLL_MAX_DELAY)
+
+
+def run_statement(sql, timeout=None):
+    """Execute one statement and wait for it; returns the describe_statement response"""
+    statement_id = execute_statement(sql)
+    print(f"Query execution ID: {statement_id}")
+    return wait_for_statement(statement_id, timeout)
+
+
+def run_batch(sqls, timeout=None):
+    """Execute a transactional batch and wait for it; returns the describe_statement response"""
+    statement_id = batch_execute_statement(sqls)
+    print(f"Batch execution ID: {statement_id}")
+    return wait_for_statement(statement_id, timeout)
+
+
+def iter_result_pages(statement_id):
+    """Yield the result pages of a finished statement, fetching the next one only when needed"""
+    next_token = None
+    while True:
+        if next_token:
+            page = client.get_statement_result(Id=statement_id, NextToken=next_token)
+        else:
+            page = client.get_statement_result(Id=statement_id)
+        yield page
+        next_token = page.get('NextToken')
+        if not next_token:
+            return
+
+
+def iter_records(statement_id):
+    """Stream the rows of a finished statement as tuples of plain Python values, one page in memory at a time"""
+    for page in iter_result_pages(statement_id):
+        for record in page['Records']:
+            yield tuple(field_value(field) for field in record)
+
+
+def field_value(field):
+    """Python value of one Data API field ({'longValue': 3}, {'isNull': True}, ...)"""
+    if field.get('isNull'):
+        return None
+    return next(iter(field.values()))
+
+
+def column_dtype(type_name):
+    """NumPy dtype for a Redshift column type, or None to keep the values as Python objects"""
+    type_name = type_name.lower()
+    if type_name in INTEGER_TYPES:
+        return np.int64
+    if type_name in FLOAT_TYPES:
+        return np.float64
+    if type_name in BOOLEAN_TYPES:
+        return np.bool_
+    return None
+
+
+def decode_column(values, dtype):
+    """Turn one column of raw field values into a typed array
+
+    NUMERIC values arrive as strings and are parsed in one vectorized pass. Integer
+    and boolean columns with NULLs fall back to float64 with NaN in their place.
+    """
+    if dtype is None:
+        return np.array(values, dtype=object)
+    has_nulls = any(value is None for value in values)
+    if has_nulls:
+        return np.array([np.nan if value is None else value for value in values], dtype=object).astype(np.float64)
+    return np.array(values).astype(dtype)
+
+
+def decode_page(page):
+    """Decode one result page into a dict of column name -> NumPy array"""
+    metadata = page['ColumnMetadata']
+    records = page['Records']
+    columns = {}
+    for index, column in enumerate(metadata):
+        values = [field_value(record[index]) for record in records]
+        columns[column['name']] = decode_column(values, column_dtype(column['typeName']))
+    return columns
+
+
+def iter_column_pages(statement_id):
+    """Stream a large result as one dict of typed column arrays per page"""
+    for page in iter_result_pages(statement_id):
+        yield decode_page(page)
+
+
+def fetch_columns(statement_id):
+    """The complete result of a finished statement as a dict of column name -> NumPy array"""
+    pages = list(iter_column_pages(statement_id))
+    if not pages:
+        return {}
+    return {name: np.concatenate([page[name] for page in pages]) for name in pages[0]}
+
+
+def sql_literal(value):
+    """Render a Python value as a SQL literal for the generated INSERT statements"""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def insert_statements(table, columns, rows):
+    """Multi-row INSERT statements for the rows, INSERT_CHUNK_ROWS per statement"""
+    statements = []
+    for start in range(0, len(rows), INSERT_CHUNK_ROWS):
+        values = ',\n'.join(
+            '(' + ', '.join(sql_literal(value) for value in row) + ')'
+            for row in rows[start:start + INSERT_CHUNK_ROWS]
+        )
+        statements.append(f"INSERT INTO {table} ({', '.join(columns)}) VALUES\n{values};")
+    return statements
+
+
+def write_rows(table, columns, rows, s3_client=None):
+    """Append rows to a table in as few Data API calls as possible
+
+    Small writes become one multi-row INSERT (or a transactional batch of them);
+    large ones are staged to S3 as a CSV file and loaded with a single COPY.
+    Returns the number of rows written.
+    """
+    if not rows:
+        return 0
+
+    if len(rows) <= MAX_INSERT_ROWS:
+        statements = insert_statements(table, columns, rows)
+        if len(statements) == 1:
+            run_statement(statements[0])
+        else:
+            run_batch(statements)
+        return len(rows)
+
+    s3_client = s3_client or boto3.client('s3')
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['' if sql_literal(value) == 'NULL' else value for value in row])
+    staging_key = f"{STAGING_PREFIX}{table}-{uuid.uuid4().hex}.csv"
+    s3_client.put_object(Bucket=STAGING_BUCKET, Key=staging_key, Body=buffer.getvalue().encode('utf-8'))
+    try:
+        run_statement(f"""
+        COPY {table} ({', '.join(columns)})
+        FROM 's3://{STAGING_BUCKET}/{staging_key}'
+        IAM_ROLE '{IAM_ROLE}'
+        FORMAT AS CSV
+        EMPTYASNULL;
+        """)
+    finally:
+        s3_client.delete_object(Bucket=STAGING_BUCKET, Key=staging_key)
+    return len(rows)
+
+
+def replace_table(table, columns, rows, s3_client=None, keep_versions=SNAPSHOT_RETENTION):
+    """Replace the contents of a table with rows without readers ever seeing it empty or half written
+
+    The rows are written to a new table created LIKE the target (same distribution
+    and sort keys), which is then swapped in by renames in one transaction that
+    also records the snapshot version in SNAPSHOT_TABLE (stamped with SYSDATE,
+    which unlike GETDATE keeps microseconds). Unlike a DELETE followed by
+    inserts, nothing is deleted row by row: the replaced table is kept whole as
+    {table}_v<version> and dropped whole once it falls out of the newest
+    keep_versions snapshots, so no dead rows are left behind for VACUUM. The
+    same transaction deletes the snapshot rows of the dropped versions. Returns
+    the version.
+    """
+    version = uuid.uuid4().hex
+    staging_table = f"{table}_staging_{version[:12]}"
+    run_statement(CREATE_SNAPSHOT_TABLE_SQL)
+    versions = [
+        recorded for (recorded,) in iter_records(run_statement(
+            f"SELECT version FROM {SNAPSHOT_TABLE} WHERE table_name = '{table}' ORDER BY created_at DESC;"
+        )['Id'])
+    ]
+    expired = versions[max(keep_versions - 1, 0):]
+    if versions and keep_versions > 1:
+        # The live table becomes the copy of the version it holds
+        retire = [f"ALTER TABLE {table} RENAME TO {snapshot_table(table, versions[0])};"]
+    else:
+        retired_table = f"{table}_retired_{version[:12]}"
+        retire = [f"ALTER TABLE {table} RENAME TO {retired_table};", f"DROP TABLE {retired_table};"]
+    prune = [f"DROP TABLE IF EXISTS {snapshot_table(table, expired_version)};" for expired_version in expired]
+    if expired:
+        expired_list = ', '.join(f"'{expired_version}'" for expired_version in expired)
+        prune.append(f"DELETE FROM {SNAPSHOT_TABLE} WHERE table_name = '{table}' AND version IN ({expired_list});")
+
+    run_statement(f"CREATE TABLE {staging_table} (LIKE {table});")
+    try:
+        write_rows(staging_table, columns, rows, s3_client)
+        run_batch(retire + [
+            f"ALTER TABLE {staging_table} RENAME TO {table};",
+            f"INSERT INTO {SNAPSHOT_TABLE} (table_name, version, row_count, created_at) VALUES ('{table}', '{version}', {len(rows)}, SYSDATE);"
+        ] + prune)
+    except Exception:
+        run_statement(f"DROP TABLE IF EXISTS {staging_table};")
+        raise
+    return version
+
+
+def snapshot_table(table, version):
+    """Name of the table keeping an earlier snapshot version of a table refreshed by replace_table"""
+    return f"{table}_v{version[:12]}"
+
+
+def refresh_table(table, columns, rows, refresh_mode='swap', s3_client=None):
+    """Refresh a derived table, by replace_table ('swap') or by DELETE and append ('delete')
+
+    Returns the snapshot version of a swap, or None.
+    """
+    if refresh_mode == 'swap':
+        return replace_table(table, columns, rows, s3_client)
+    run_statement(f"DELETE FROM {table}")
+    write_rows(table, columns, rows, s3_client)
+    return None
+
+
+def snapshot_version_sql(table):
+    """Query for the live snapshot version of a table refreshed by replace_table"""
+    return f"""
+    SELECT version FROM {SNAPSHOT_TABLE}
+    WHERE table_name = '{table}'
+    ORDER BY created_at DESC
+    LIMIT 1;
+    """
@@ -1,63 +1,187 @@
 import boto3
 import json
-import time
+import redshift_data
+import s3_json
+import weekly_metrics
+from datetime import datetime, timezone
+
+S3_BUCKET = 'gdelt-project'
+UNZIP_PREFIX = 'bronze/gdelt_data_unzip/'
+MANIFEST_PREFIX = 'dependencies/manifests/'
+WATERMARK_KEY = 'dependencies/load_watermark.json'
+
+# Positions of the COPY and final INSERT in merge_statements, for reading their row counts
+MERGE_COPY_STATEMENT = 1
+MERGE_INSERT_STATEMENT = 3
+# Position of the INSERT in append_statements
+APPEND_INSERT_STATEMENT = 2
 
 def lambda_handler(event, context):
-    client = boto3.client('redshift-data')
-    
-    # Retrieve database connection information from environment variables
-    workgroup_name = 'default-workgroup'
-    database = 'dev'
-    secret_arn = 'arn:aws:secretsmanager:us-east-2:339713000240:secret:prod-dw-access-H7nfCP'
-
-    copy_sql = """
-    COPY gdelt_event
-    FROM 's3://gdelt-project/dependencies/manifest.json'
-    IAM_ROLE 'arn:aws:iam::339713000240:role/RedshiftRole'
-    FORMAT AS CSV
-    DELIMITER '\t'
-    IGNOREHEADER 0
-    MANIFEST;
-    """
-    
+    s3_client = boto3.client('s3')
+
+    options = event or {}
+    load_mode = options.get('load_mode', 'merge')
+
     try:
-        # Execute the COPY command using the specified secret for authentication
-        response = client.execute_statement(
-            WorkgroupName=workgroup_name,
-            Database=database,
-            SecretArn=secret_arn,
-            Sql=copy_sql
-        )
-        
-        execution_id = response['Id']
-        print(f"Query execution ID: {execution_id}")
-        
-        while True:
-            status_response = client.describe_statement(Id=execution_id)
-            status = status_response['Status']
-            print(f"Query execution status: {status}")
-            
-            if status == 'FINISHED':
-                print("COPY command completed successfully.")
-                break
-            elif status == 'FAILED':
-                print(f"Query failed: {status_response['Error']}")
+        if options.get('rebuild_rollup'):
+            # Recompute weekly_country_metrics for every week, without loading anything
+            print(f"Rebuilding {weekly_metrics.ROLLUP_TABLE} from gdelt_event.")
+            load_mode = 'rebuild_rollup'
+            new_files = []
+            statements = weekly_metrics.refresh_statements(weekly_metrics.ALL_WEEKS_SQL)
+        else:
+            watermark = load_watermark(s3_client)
+            new_files = list_new_files(s3_client, watermark)
+            if not new_files:
+                print(f"No files arrived since {watermark['last_modified']}, nothing to load.")
                 return {
-                    'statusCode': 500,
-                    'body': json.dumps(f"Query failed with error: {status_response['Error']}")
+                    'statusCode': 200,
+                    'body': json.dumps("No new files to load.")
                 }
+
+            manifest_key = write_manifest(s3_client, new_files)
+            print(f"Loading {len(new_files)} new files through s3://{S3_BUCKET}/{manifest_key}")
+
+            copy_options = f"""
+            FROM 's3://{S3_BUCKET}/{manifest_key}'
+            IAM_ROLE 'arn:aws:iam::339713000240:role/RedshiftRole'
+            FORMAT AS CSV
+            DELIMITER '\t'
+            IGNOREHEADER 0
+            MANIFEST;
+            """
+            # The rollup is refreshed in the same transaction for the weeks the new rows touch
+            if load_mode == 'append':
+                statements = append_statements(copy_options)
             else:
-                print("Waiting for query to complete...")
-                time.sleep(5) 
-        
+                statements = merge_statements(copy_options)
+            statements += weekly_metrics.refresh_statements(weekly_metrics.STAGED_WEEKS_SQL)
+
+        # A batch runs as one transaction, so the load and its rollup refresh are all-or-nothing
+        status_response = redshift_data.run_batch(statements)
+        status = status_response['Status']
+        print("COPY command completed successfully.")
+
+        result = {'status': status, 'load_mode': load_mode, 'files': len(new_files)}
+        if load_mode == 'merge':
+            sub_statements = status_response['SubStatements']
+            staged_rows = sub_statements[MERGE_COPY_STATEMENT]['ResultRows']
+            inserted_rows = sub_statements[MERGE_INSERT_STATEMENT]['ResultRows']
+            result.update({
+                'staged_rows': staged_rows,
+                'inserted_rows': inserted_rows,
+                'skipped_rows': staged_rows - inserted_rows
+            })
+            print(f"Merged {inserted_rows} new events, skipped {staged_rows - inserted_rows} duplicates.")
+        elif load_mode == 'append':
+            result['inserted_rows'] = status_response['SubStatements'][APPEND_INSERT_STATEMENT]['ResultRows']
+
+        # Only move the watermark once the files are in the table, so a failed COPY is retried
+        if new_files:
+            save_watermark(s3_client, watermark, new_files)
+
         return {
             'statusCode': 200,
-            'body': json.dumps(f"Query execution completed with status: {status}")
+            'body': json.dumps(result)
         }
-    
+
+    except redshift_data.RedshiftDataError as e:
+        print(f"Query failed: {e.error}")
+        return {
+            'statusCode': 500,
+            'body': json.dumps(f"Query failed with error: {e.error}")
+        }
+
     except Exception as e:
         print(f"Error executing the query: {str(e)}")
         return {
             'statusCode': 500,
             'body': json.dumps(f"Error executing the query: {str(e)}")
         }
+
+def append_statements(copy_options):
+    """COPY into a session temp table and append all of it, without checking for events already loaded
+
+    Going through the staging table lets the rollup refresh find the weeks the
+    new rows touch, as it does after a merge.
+    """
+    return [
+        "CREATE TEMP TABLE gdelt_event_staging (LIKE gdelt_event);",
+        f"COPY gdelt_event_staging {copy_options}",
+        "INSERT INTO gdelt_event SELECT * FROM gdelt_event_staging;"
+    ]
+
+def merge_statements(copy_options):
+    """COPY into a session temp table, drop events already loaded and append the latest copy of each new one"""
+    return [
+        "CREATE TEMP TABLE gdelt_event_staging (LIKE gdelt_event);",
+        f"COPY gdelt_event_staging {copy_options}",
+        """
+        DELETE FROM gdelt_event_staging
+        USING gdelt_event
+        WHERE gdelt_event_staging.GLOBALEVENTID = gdelt_event.GLOBALEVENTID;
+        """,
+        """
+        INSERT INTO gdelt_event
+        SELECT DISTINCT gdelt_event_staging.*
+        FROM gdelt_event_staging
+        JOIN (
+            SELECT GLOBALEVENTID, MAX(DATEADDED) AS DATEADDED
+            FROM gdelt_event_staging
+            GROUP BY GLOBALEVENTID
+        ) AS latest
+        ON gdelt_event_staging.GLOBALEVENTID = latest.GLOBALEVENTID
+        AND gdelt_event_staging.DATEADDED = latest.DATEADDED;
+        """
+    ]
+
+def load_watermark(s3_client):
+    """Read the last load watermark: the newest LastModified loaded and the keys that carried it"""
+    watermark = s3_json.load_json(s3_client, S3_BUCKET, WATERMARK_KEY)
+    if watermark is None:
+        print(f"No watermark found at {WATERMARK_KEY}, loading every unzipped file.")
+        return {'last_modified': None, 'keys': []}
+    return watermark
+
+def save_watermark(s3_client, previous, loaded_files):
+    last_modified = max(f['LastModified'] for f in loaded_files)
+    keys = {f['Key'] for f in loaded_files if f['LastModified'] == last_modified}
+    if previous['last_modified'] and datetime.fromisoformat(previous['last_modified']) == last_modified:
+        keys.update(previous['keys'])
+    watermark = {
+        'last_modified': last_modified.isoformat(),
+        'keys': sorted(keys)
+    }
+    s3_json.save_json(s3_client, S3_BUCKET, WATERMARK_KEY, watermark)
+    print(f"Load watermark moved to {watermark['last_modified']}")
+
+def list_new_files(s3_client, watermark):
+    """Return the unzipped event files that arrived after the watermark"""
+    last_modified = None
+    if watermark['last_modified']:
+        last_modified = datetime.fromisoformat(watermark['last_modified']).astimezone(timezone.utc)
+    loaded_at_watermark = set(watermark['keys'])
+
+    new_files = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=UNZIP_PREFIX):
+        for obj in page.get('Contents', []):
+            if not obj['Key'].upper().endswith('.CSV') or obj['Size'] == 0:
+                continue
+            if last_modified is None or obj['LastModified'] > last_modified:
+                new_files.append(obj)
+            elif obj['LastModified'] == last_modified and obj['Key'] not in loaded_at_watermark:
+                new_files.append(obj)
+    return new_files
+
+def write_manifest(s3_client, files):
+    """Write a COPY manifest listing exactly these files; Redshift spreads them across slices"""
+    manifest = {
+        'entries': [
+            {'url': f"s3://{S3_BUCKET}/{f['Key']}", 'mandatory': True, 'meta': {'content_length': f['Size']}}
+            for f in files
+        ]
+    }
+    manifest_key = f"{MANIFEST_PREFIX}manifest-{datetime.now(timezone.utc):%Y%m%dT%H%M%S}.json"
+    s3_json.save_json(s3_client, S3_BUCKET, manifest_key, manifest)
+    return manifest_key
@@ -0,0 +1,24 @@
+"""JSON documents kept as S3 objects: ledgers, watermarks, manifests and caches.
+
+Every stage keeps some small state between runs in S3. These two helpers read
+and write it the same way everywhere, with a missing object read as a default
+rather than an error, since each of them starts out absent on the first run.
+"""
+
+import json
+
+
+def load_json(s3_client, bucket, key, default=None):
+    """The parsed JSON object at s3://bucket/key, or `default` when there is no such object"""
+    try:
+        obj = s3_client.get_object(Bucket=bucket, Key=key)
+    except s3_client.exceptions.NoSuchKey:
+        return default
+    return json.loads(obj['Body'].read())
+
+
+def save_json(s3_client, bucket, key, value, compact=False):
+    """Write value as a JSON object; compact drops whitespace and sorts keys, for documents that grow large"""
+    options = {'separators': (',', ':'), 'sort_keys': True} if compact else {}
+    body = json.dumps(value, **options)
+    s3_client.put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'), ContentType='application/json')
@@ -0,0 +1,139 @@
+"""Compact, versioned SOM model file, and a scorer that needs nothing but NumPy.
+
+The model is an uncompressed .npz with the codebook weights, the U-matrix
+(distance map) computed at training time, the feature mean and scale, the
+format version and a SHA-256 of those arrays. Members of an uncompressed .npz
+sit verbatim inside the zip, so load_artifact memory-maps each one in place
+instead of reading and copying it, and nothing is unpickled: scoring does not
+depend on MiniSom or on the class that trained the map.
+"""
+
+import hashlib
+import io
+import json
+import struct
+import zipfile
+
+import numpy as np
+
+FORMAT_VERSION = 1
+S3_BUCKET = 'gdelt-project'
+ARTIFACT_KEY = 'dependencies/som_model.npz'
+ARRAY_NAMES = ('weights', 'distance_map', 'mean', 'scale')
+
+
+def content_hash(arrays):
+    """SHA-256 over the name, dtype, shape and bytes of every model array, in a fixed order"""
+    digest = hashlib.sha256()
+    for name in ARRAY_NAMES:
+        array = np.ascontiguousarray(arrays[name], dtype=np.float64)
+        digest.update(json.dumps([name, array.dtype.str, array.shape]).encode('utf-8'))
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def model_arrays(som):
+    """The arrays of a trained map (weights, distance_map(), mean, scale), as float64"""
+    return {
+        'weights': np.asarray(som.get_weights(), dtype=np.float64),
+        'distance_map': np.asarray(som.distance_map(), dtype=np.float64),
+        'mean': np.asarray(som.mean, dtype=np.float64),
+        'scale': np.asarray(som.scale, dtype=np.float64),
+    }
+
+
+def write_artifact(target, som, metadata=None):
+    """Write the model of a trained map to a path or file object; returns its content hash
+
+    `metadata` (JSON-serializable, e.g. training settings and errors) is stored
+    alongside but left out of the hash.
+    """
+    arrays = model_arrays(som)
+    sha256 = content_hash(arrays)
+    np.savez(
+        target,
+        format_version=np.array(FORMAT_VERSION),
+        sha256=np.array(sha256),
+        metadata=np.array(json.dumps(metadata or {})),
+        **arrays
+    )
+    return sha256
+
+
+def _member_offset(handle, info):
+    """Offset of a stored member's data in the zip file, past its local header"""
+    handle.seek(info.header_offset)
+    header = handle.read(30)
+    if header[:4] != b'PK\x03\x04':
+        raise ValueError(f"Bad local header for {info.filename}")
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    return info.header_offset + 30 + name_length + extra_length
+
+
+def _map_member(path, handle, info):
+    """Memory-map one uncompressed .npy member of the archive"""
+    offset = _member_offset(handle, info)
+    handle.seek(offset)
+    version = np.lib.format.read_magic(handle)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(handle)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(handle)
+    if dtype.hasobject or not shape:
+        # Strings and scalars are tiny; read them normally
+        handle.seek(offset)
+        return np.lib.format.read_array(handle)
+    return np.memmap(path, dtype=dtype, mode='r', offset=handle.tell(), shape=shape,
+                     order='F' if fortran_order else 'C')
+
+
+class SOMModel:
+    """A loaded artifact: scales raw features and scores them against the U-matrix"""
+
+    def __init__(self, arrays, sha256, format_version, metadata=None):
+        self.weights = arrays['weights']
+        self.distance_map = arrays['distance_map']
+        self.mean = arrays['mean']
+        self.scale = arrays['scale']
+        self.sha256 = sha256
+        self.format_version = format_version
+        self.metadata = metadata or {}
+        self._codebook = np.asarray(self.weights).reshape(-1, self.weights.shape[-1])
+        self._codebook_sq = (self._codebook ** 2).sum(axis=1)
+
+    def transform(self, features):
+        return (np.asarray(features, dtype=np.float64) - self.mean) / self.scale
+
+    def winners(self, features):
+        """Flat index of the best matching unit of every raw feature row"""
+        scaled = self.transform(features)
+        return np.argmin(self._codebook_sq[np.newaxis, :] - 2 * scaled @ self._codebook.T, axis=1)
+
+    def distances(self, features):
+        """U-matrix value at the best matching unit of every raw feature row"""
+        return np.asarray(self.distance_map).reshape(-1)[self.winners(features)]
+
+
+def load_artifact(path, mmap=True, verify=True):
+    """Load a model file written by write_artifact, memory-mapping its arrays when they are stored uncompressed
+
+    Raises ValueError for an unknown format version or, with verify, a content
+    hash that does not match the arrays.
+    """
+    with open(path, 'rb') as handle, zipfile.ZipFile(handle) as archive:
+        members = {info.filename[:-len('.npy')]: info for info in archive.infolist() if info.filename.endswith('.npy')}
+        values = {}
+        for name, info in members.items():
+            if mmap and info.compress_type == zipfile.ZIP_STORED:
+                values[name] = _map_member(path, handle, info)
+            else:
+                values[name] = np.lib.format.read_array(io.BytesIO(archive.read(info)))
+
+    format_version = int(values['format_version'])
+    if format_version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported SOM model format {format_version}, expected {FORMAT_VERSION}")
+    sha256 = str(values['sha256'])
+    arrays = {name: values[name] for name in ARRAY_NAMES}
+    if verify and content_hash(arrays) != sha256:
+        raise ValueError(f"SOM model {path} does not match its content hash {sha256}")
+    return SOMModel(arrays, sha256, format_version, json.loads(str(values.get('metadata', '{}'))))
@@ -0,0 +1,167 @@
+"""SOM training and a parallel search over map sizes and training settings.
+
+train_som fits one configuration (training mode, map size, sigma, learning rate
+and iterations) to the standardized training matrix. search trains a whole grid
+of them on worker processes, which inherit the matrix when they are forked
+rather than receiving a pickled copy with every task. Each configuration
+is timed and scored by quantization error (mean distance of a row to its best
+matching unit) and topographic error (share of rows whose two best units are
+not adjacent). The results are returned as a table, so map sizes can be chosen
+by cost as well as quality.
+"""
+
+import itertools
+import math
+import os
+import time
+
+import numpy as np
+from minisom import MiniSom
+
+import batch_som
+import worker_pool
+
+TRAINING_MODES = ('batch', 'minisom')
+# Settings of the single model trained outside a search
+DEFAULT_CONFIG = {'training_mode': 'batch', 'x': 5, 'y': 5, 'sigma': None, 'learning_rate': 0.5, 'iterations': 100}
+# Grid searched when the event gives none; learning rates only apply to minisom
+DEFAULT_GRID = {
+    'training_modes': ['batch'],
+    'map_sizes': [[4, 4], [5, 5], [6, 6], [8, 8], [10, 10]],
+    'sigmas': [None, 1.0],
+    'learning_rates': [0.5],
+    'iterations': [50, 100],
+}
+SELECTION_CRITERIA = ('combined', 'quantization', 'topographic')
+
+# Training matrix of a worker process, set by its initializer
+_training_matrix = None
+
+
+def train_som(X_scaled, mean, scale, config=None, deadline=None):
+    """Train one configuration on standardized rows; returns a BatchSOM carrying the given scaling
+
+    'iterations' counts epochs in batch mode and single-sample updates in minisom
+    mode. A sigma of None means half the larger map side for the batch algorithm
+    and 1.0 for MiniSom.
+    """
+    config = {**DEFAULT_CONFIG, **(config or {})}
+    training_mode = config['training_mode']
+    if training_mode not in TRAINING_MODES:
+        raise ValueError(f"Unknown training_mode {training_mode!r}, expected one of {TRAINING_MODES}")
+    x, y = config['x'], config['y']
+
+    if training_mode == 'minisom':
+        # Initialize and train the MiniSom model, then keep only its weights
+        sigma = config['sigma'] if config['sigma'] is not None else 1.0
+        minisom = MiniSom(x, y, X_scaled.shape[1], sigma=sigma, learning_rate=config['learning_rate'], random_seed=config.get('random_seed'))
+        minisom.random_weights_init(X_scaled)
+        minisom.train_random(X_scaled, config['iterations'])
+        som = batch_som.BatchSOM.from_weights(minisom.get_weights(), mean, scale)
+        som.epochs_trained = config['iterations']
+        return som
+
+    som = batch_som.BatchSOM(x, y, X_scaled.shape[1], sigma=config['sigma'], random_seed=config.get('random_seed'))
+    som.mean, som.scale = mean, scale
+    som.pca_weights_init(X_scaled)
+    som.train(X_scaled, config['iterations'], deadline)
+    return som
+
+
+def expand_grid(grid=None):
+    """Every distinct configuration of a grid, smallest maps first"""
+    grid = {**DEFAULT_GRID, **(grid or {})}
+    configs = []
+    for training_mode, (x, y), sigma, learning_rate, iterations in itertools.product(
+            grid['training_modes'], grid['map_sizes'], grid['sigmas'], grid['learning_rates'], grid['iterations']):
+        config = {
+            'training_mode': training_mode, 'x': int(x), 'y': int(y),
+            # MiniSom trains a sigma of None as 1.0, so both are the same configuration
+            'sigma': 1.0 if training_mode == 'minisom' and sigma is None else sigma,
+            # The batch algorithm has no learning rate; keep one configuration instead of one per rate
+            'learning_rate': learning_rate if training_mode == 'minisom' else None,
+            'iterations': int(iterations),
+        }
+        if config not in configs:
+            configs.append(config)
+    return sorted(configs, key=lambda config: config['x'] * config['y'])
+
+
+def set_training_matrix(X_scaled):
+    """Worker initializer: the standardized matrix every configuration is trained on"""
+    global _training_matrix
+    _training_matrix = X_scaled
+
+
+def evaluate_config(item):
+    """Worker task: train one configuration on the training matrix, then time and score it
+
+    Returns the result row and the trained weights (small next to the data),
+    so the best map is published without training it again.
+    """
+    config, mean, scale, deadline = item
+    X_scaled = _training_matrix
+    row = dict(config, units=config['x'] * config['y'])
+    started = time.perf_counter()
+    try:
+        som = train_som(X_scaled, mean, scale, config, deadline)
+        row['train_seconds'] = time.perf_counter() - started
+        row['quantization_error'] = som.quantization_error(X_scaled)
+        row['topographic_error'] = som.topographic_error(X_scaled)
+        row['epochs_trained'] = som.epochs_trained
+        row['seconds'] = time.perf_counter() - started
+        row['error'] = None
+        return row, som.get_weights()
+    except Exception as e:
+        row['seconds'] = time.perf_counter() - started
+        row['error'] = str(e)
+        return row, None
+
+
+def selection_score(row, criterion='combined'):
+    """Lower is better, as a (score, tie-break) pair; configurations that failed or have no topographic error rank last"""
+    unusable = (math.inf, math.inf)
+    if row.get('error') is not None:
+        return unusable
+    quantization, topographic = row['quantization_error'], row['topographic_error']
+    if criterion == 'quantization':
+        return (quantization, math.inf if math.isnan(topographic) else topographic)
+    if math.isnan(topographic):
+        return unusable
+    if criterion == 'topographic':
+        return (topographic, quantization)
+    return (quantization + topographic, quantization)
+
+
+def search(X_scaled, mean, scale, grid=None, max_workers=None, deadline=None, criterion='combined'):
+    """Train and score every configuration of the grid on worker processes
+
+    Returns (results, best), where results has one row per configuration,
+    smallest maps first, marked 'best' for the winner by `criterion`, and best is the
+    winning map as a BatchSOM, or None when every configuration failed.
+    """
+    if criterion not in SELECTION_CRITERIA:
+        raise ValueError(f"Unknown selection criterion {criterion!r}, expected one of {SELECTION_CRITERIA}")
+    global _training_matrix
+    configs = expand_grid(grid)
+    X_scaled = np.ascontiguousarray(X_scaled, dtype=np.float64)
+    items = [(config, mean, scale, deadline) for config in configs]
+    max_workers = min(max_workers or os.cpu_count() or 1, len(configs))
+    print(f"Searching {len(configs)} SOM configurations with {max_workers} workers.")
+
+    try:
+        with worker_pool.WorkerPool(max_workers, initializer=set_training_matrix, initargs=(X_scaled,)) as pool:
+            outcomes = pool.map(evaluate_config, items)
+    finally:
+        # Set in this process too when the pool runs the tasks here
+        _training_matrix = None
+
+    results = [row for row, _ in outcomes]
+    best_index = min(range(len(results)), key=lambda index: selection_score(results[index], criterion), default=None)
+    best = None
+    if best_index is not None and outcomes[best_index][1] is not None:
+        best = batch_som.BatchSOM.from_weights(outcomes[best_index][1], mean, scale)
+        best.epochs_trained = results[best_index]['epochs_trained']
+    for index, row in enumerate(results):
+        row['best'] = index == best_index and best is not None
+    return results, best
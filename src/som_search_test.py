@@ -0,0 +1,37 @@
+import math
+
+import numpy as np
+import pytest
+
+import batch_som
+import som_search
+
+
+def training_data():
+    data = np.random.default_rng(0).normal(size=(200, 5))
+    mean, scale = batch_som.fit_scaling(data)
+    return (data - mean) / scale, mean, scale
+
+
+@pytest.mark.parametrize('criterion', som_search.SELECTION_CRITERIA)
+def test_search_ranks_failed_and_single_unit_configs_last(criterion):
+    X_scaled, mean, scale = training_data()
+    # 'unknown' makes train_som raise, and a 1x1 map has no topographic error
+    grid = {'training_modes': ['batch', 'unknown'], 'map_sizes': [[1, 1], [3, 3]], 'sigmas': [None], 'iterations': [5]}
+
+    results, best = som_search.search(X_scaled, mean, scale, grid, max_workers=1, criterion=criterion)
+
+    assert [row['error'] is not None for row in results].count(True) == 2
+    winner = next(row for row in results if row['best'])
+    assert best is not None and winner['error'] is None
+    if criterion != 'quantization':
+        assert (winner['x'], winner['y']) == (3, 3)
+
+
+def test_selection_score_keys_compare_across_rows():
+    failed = {'error': 'boom'}
+    single_unit = {'error': None, 'quantization_error': 0.5, 'topographic_error': math.nan}
+    usable = {'error': None, 'quantization_error': 1.0, 'topographic_error': 0.1}
+    for criterion in som_search.SELECTION_CRITERIA:
+        rows = [failed, single_unit, usable]
+        assert min(rows, key=lambda row: som_search.selection_score(row, criterion)) is not failed
@@ -5,7 +5,17 @@ from pyspark.context import SparkContext
 from awsglue.context import GlueContext
 from awsglue.job import Job
 
-args = getResolvedOptions(sys.argv, ["JOB_NAME"])
+# Optional backfill arguments: --start_date/--end_date (YYYYMMDD) restrict the run to a
+# date range and --shard/--shard_count pick one contiguous slice of it, so several job
+# runs can unzip years of history concurrently.
+# --full_scan true lists every archive instead of starting at the newest ledger month.
+# --write_silver true additionally converts the newly unzipped files into the typed
+# Parquet silver layer, compressed with --silver_compression (snappy by default).
+optional_options = [
+    option for option in ["start_date", "end_date", "shard", "shard_count", "full_scan", "write_silver", "silver_compression"]
+    if f"--{option}" in sys.argv
+]
+args = getResolvedOptions(sys.argv, ["JOB_NAME"] + optional_options)
 sc = SparkContext()
 glueContext = GlueContext(sc)
 spark = glueContext.spark_session
@@ -17,75 +27,405 @@ logger.info("Starting the ZIP file processing job")
 
 import boto3
 import io
+import date_shards
+import re
+import s3_json
+from boto3.s3.transfer import TransferConfig
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from zipfile import ZipFile
+from pyspark.sql.functions import col, lit, to_date
+from pyspark.sql.types import DoubleType, IntegerType, LongType, StringType, StructField, StructType
 
 s3 = boto3.client("s3")
 
 bucket = "gdelt-project"
 prefix = "bronze/gdelt_data/"
 unzip_prefix = "bronze/gdelt_data_unzip/"
+silver_prefix = "silver/gdelt_event/"
+# One small JSON object per month of archives, mapping archive name -> ETag once fully unzipped
+ledger_prefix = "bronze/gdelt_unzip_ledger/"
+# One empty marker object per archive still to unzip: written by ingestion for every archive it
+# stores (backfills included) and here for archives that failed, deleted once one is unzipped
+pending_prefix = "bronze/gdelt_unzip_pending/"
+
+write_silver = args.get("write_silver", "false").lower() == "true"
+silver_compression = args.get("silver_compression", "snappy")
+full_scan = args.get("full_scan", "false").lower() == "true"
+
+
+def gdelt_column(name, data_type=StringType()):
+    return StructField(name, data_type, True)
+
+
+def actor_columns(actor):
+    return [gdelt_column(f"{actor}{suffix}") for suffix in [
+        "Code", "Name", "CountryCode", "KnownGroupCode", "EthnicCode",
+        "Religion1Code", "Religion2Code", "Type1Code", "Type2Code", "Type3Code"
+    ]]
+
+
+def geo_columns(geo):
+    return [
+        gdelt_column(f"{geo}_Type", IntegerType()),
+        gdelt_column(f"{geo}_FullName"),
+        gdelt_column(f"{geo}_CountryCode"),
+        gdelt_column(f"{geo}_ADM1Code"),
+        gdelt_column(f"{geo}_Lat", DoubleType()),
+        gdelt_column(f"{geo}_Long", DoubleType()),
+        gdelt_column(f"{geo}_FeatureID"),
+    ]
+
+
+# Column layout of the GDELT 1.0 daily event export files. CAMEO codes stay strings
+# because their leading zeros are significant.
+gdelt_event_schema = StructType(
+    [
+        gdelt_column("GLOBALEVENTID", LongType()),
+        gdelt_column("SQLDATE", IntegerType()),
+        gdelt_column("MonthYear", IntegerType()),
+        gdelt_column("Year", IntegerType()),
+        gdelt_column("FractionDate", DoubleType()),
+    ]
+    + actor_columns("Actor1")
+    + actor_columns("Actor2")
+    + [
+        gdelt_column("IsRootEvent", IntegerType()),
+        gdelt_column("EventCode"),
+        gdelt_column("EventBaseCode"),
+        gdelt_column("EventRootCode"),
+        gdelt_column("QuadClass", IntegerType()),
+        gdelt_column("GoldsteinScale", DoubleType()),
+        gdelt_column("NumMentions", IntegerType()),
+        gdelt_column("NumSources", IntegerType()),
+        gdelt_column("NumArticles", IntegerType()),
+        gdelt_column("AvgTone", DoubleType()),
+    ]
+    + geo_columns("Actor1Geo")
+    + geo_columns("Actor2Geo")
+    + geo_columns("ActionGeo")
+    + [
+        gdelt_column("DATEADDED", IntegerType()),
+        gdelt_column("SOURCEURL"),
+    ]
+)
+# The monthly and yearly archives of the history before April 2013 have no SOURCEURL column
+historical_event_schema = StructType([field for field in gdelt_event_schema.fields if field.name != "SOURCEURL"])
+daily_file_pattern = re.compile(r"\d{8}\.export\.CSV$", re.IGNORECASE)
+corrupt_column = "_corrupt_record"
+
+# Archives are read with ranged GETs of read_block_size bytes, keeping at most
+# read_cache_blocks of them in memory; members are streamed to S3 in multipart
+# chunks, so peak memory does not depend on the archive or member size.
+read_block_size = 8 * 1024 * 1024
+read_cache_blocks = 4
+upload_config = TransferConfig(multipart_chunksize=16 * 1024 * 1024, max_concurrency=4)
+
+
+class S3RangeReader(io.RawIOBase):
+    """Seekable read-only file object over an S3 object, backed by ranged GETs and a small block cache"""
+
+    def __init__(self, client, bucket_name, key, block_size=read_block_size, cache_blocks=read_cache_blocks):
+        head = client.head_object(Bucket=bucket_name, Key=key)
+        self.client = client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.size = head["ContentLength"]
+        # Pin every range request to this version of the object
+        self.etag = head["ETag"]
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        self.blocks = OrderedDict()
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        if position < 0:
+            # ZipFile turns OSError from a seek before the start into BadZipFile
+            raise OSError(f"Negative seek position {position}")
+        self.position = position
+        return self.position
+
+    def readinto(self, buffer):
+        view = memoryview(buffer).cast("B")
+        written = 0
+        # Fill the whole buffer (up to EOF): ZipFile treats short reads as truncated data
+        while written < len(view) and self.position < self.size:
+            index, offset = divmod(self.position, self.block_size)
+            block = self._block(index)
+            count = min(len(block) - offset, len(view) - written)
+            view[written:written + count] = block[offset:offset + count]
+            written += count
+            self.position += count
+        return written
+
+    def _block(self, index):
+        if index in self.blocks:
+            self.blocks.move_to_end(index)
+            return self.blocks[index]
+        start = index * self.block_size
+        end = min(start + self.block_size, self.size) - 1
+        response = self.client.get_object(Bucket=self.bucket_name, Key=self.key, Range=f"bytes={start}-{end}", IfMatch=self.etag)
+        block = response["Body"].read()
+        self.blocks[index] = block
+        if len(self.blocks) > self.cache_blocks:
+            self.blocks.popitem(last=False)
+        return block
+
+
+def list_objects(list_prefix, start_after=None, stop_after=None):
+    """List the objects under a prefix, optionally only those sorting after start_after and up to stop_after"""
+    objects = []
+    continuation_token = None
+    while True:
+        request = {"Bucket": bucket, "Prefix": list_prefix}
+        if continuation_token:
+            request["ContinuationToken"] = continuation_token
+        elif start_after:
+            request["StartAfter"] = list_prefix + start_after
+        response = s3.list_objects_v2(**request)
+
+        for o in response.get("Contents", []):
+            if stop_after and o["Key"][len(list_prefix):] > stop_after:
+                return objects
+            objects.append({"Key": o["Key"], "ETag": o["ETag"]})
+
+        if response.get("IsTruncated"):
+            continuation_token = response["NextContinuationToken"]
+        else:
+            return objects
+
+
+def ledger_month(key):
+    """Ledger partition of an archive: YYYYMM for daily and monthly files, YYYY for yearly ones"""
+    name = key[len(prefix):]
+    return name[:6] if name[:6].isdigit() else name[:4]
+
+
+def load_ledger_month(month):
+    return s3_json.load_json(s3, bucket, f"{ledger_prefix}{month}.json", default={})
+
+
+def save_ledger_month(month, entries):
+    s3_json.save_json(s3, bucket, f"{ledger_prefix}{month}.json", entries, compact=True)
+
+
+def mark_pending(names):
+    for name in names:
+        s3.put_object(Bucket=bucket, Key=f"{pending_prefix}{name}", Body=b"")
+
+
+def clear_pending(names):
+    names = sorted(names)
+    for start in range(0, len(names), 1000):
+        batch = names[start:start + 1000]
+        s3.delete_objects(Bucket=bucket, Delete={"Objects": [{"Key": f"{pending_prefix}{name}"} for name in batch], "Quiet": True})
+
+
+# Daily files are named YYYYMMDD.export.CSV(.zip), so a date slice is a contiguous key range
+start_after = None
+stop_after = None
+if "start_date" in args or "end_date" in args:
+    start_date = datetime.strptime(args.get("start_date", "20130401"), "%Y%m%d")
+    end_date = datetime.strptime(args["end_date"], "%Y%m%d") if "end_date" in args else datetime.utcnow()
+    shard_range = date_shards.shard_date_range(start_date, end_date, int(args.get("shard", 0)), int(args.get("shard_count", 1)))
+    if shard_range is None:
+        logger.info("This shard has no dates to process")
+        job.commit()
+        sys.exit(0)
+    first_date, last_date = shard_range
+    start_after = f"{first_date - timedelta(days=1):%Y%m%d}.export.CSV.zip"
+    # "~" sorts after every file name of the last day, zipped or not
+    stop_after = f"{last_date:%Y%m%d}~"
+    logger.info(f"Processing files dated {first_date:%Y%m%d} to {last_date:%Y%m%d}")
+
+pending_names = {o["Key"][len(pending_prefix):] for o in list_objects(pending_prefix)}
+if start_after is None and stop_after is None and not full_scan:
+    # Regular runs only look at archives from the newest month recorded in the ledger on,
+    # or from the oldest month with an archive still pending, whichever comes first
+    recorded_months = [o["Key"][len(ledger_prefix):-len(".json")] for o in list_objects(ledger_prefix)]
+    pending_months = [ledger_month(prefix + name) for name in pending_names]
+    if recorded_months:
+        start_after = min([max(recorded_months)] + pending_months)
+        logger.info(f"Listing archives from month {start_after} ({len(pending_names)} pending archives)")
 
 logger.info(f"Searching for ZIP files in bucket '{bucket}' with prefix '{prefix}'")
 
-object_keys = []
-unzipped_object_keys = []
+listed_objects = list_objects(prefix, start_after, stop_after)
+ledger = {month: load_ledger_month(month) for month in sorted({ledger_month(o["Key"]) for o in listed_objects})}
 
-continuation_token = None
-while True:
-    if continuation_token:
-        response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix, ContinuationToken=continuation_token)
-    else:
-        response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix)
-    
-    if 'Contents' in response:
-        object_keys.extend([o["Key"] for o in response["Contents"]])
-    
-    if response.get('IsTruncated'):
-        continuation_token = response['NextContinuationToken']
-    else:
-        break
+# Only archives that are new or whose ETag changed since they were last unzipped are opened
+pending_objects = [
+    o for o in listed_objects
+    if ledger[ledger_month(o["Key"])].get(o["Key"][len(prefix):]) != o["ETag"]
+]
 
-continuation_token = None
-while True:
-    if continuation_token:
-        response = s3.list_objects_v2(Bucket=bucket, Prefix=unzip_prefix, ContinuationToken=continuation_token)
-    else:
-        response = s3.list_objects_v2(Bucket=bucket, Prefix=unzip_prefix)
-    
-    if 'Contents' in response:
-        unzipped_object_keys.extend([o["Key"] for o in response["Contents"]])
-    
-    if response.get('IsTruncated'):
-        continuation_token = response['NextContinuationToken']
+logger.info(f"Found {len(listed_objects)} ZIP files in prefix '{prefix}', {len(pending_objects)} new or changed")
+
+
+def unzip_partition(objects):
+    """Unzip one partition of archives on an executor, reusing one S3 client for all of them"""
+    client = boto3.client("s3")
+    for o in objects:
+        key = o["Key"]
+        uploaded = []
+        try:
+            with S3RangeReader(client, bucket, key) as objbuffer, ZipFile(objbuffer) as zip:
+                for filename in zip.namelist():
+                    filepath = unzip_prefix + filename
+                    with zip.open(filename) as file:
+                        client.upload_fileobj(file, bucket, filepath, Config=upload_config)
+                    uploaded.append(filepath)
+            yield {"key": key, "etag": o["ETag"], "success": True, "uploaded": uploaded, "error": None}
+        except Exception as e:
+            yield {"key": key, "etag": o["ETag"], "success": False, "uploaded": uploaded, "error": str(e)}
+
+
+# Each executor downloads, unzips and uploads its own share of the archives
+results = []
+if pending_objects:
+    partitions = min(len(pending_objects), sc.defaultParallelism)
+    results = sc.parallelize(pending_objects, partitions).mapPartitions(unzip_partition).collect()
+
+failures = [result for result in results if not result["success"]]
+for result in results:
+    for filepath in result["uploaded"]:
+        logger.info(f"Processed and uploaded {filepath} from {result['key']}")
+for result in failures:
+    logger.error(f"Failed to process {result['key']}: {result['error']}")
+logger.info(f"Processed {len(results) - len(failures)} ZIP files, {len(failures)} failed")
+
+def existing_silver_dates():
+    """EventDate values that already have a partition in the silver layer"""
+    dates = set()
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=silver_prefix, Delimiter="/"):
+        for common_prefix in page.get("CommonPrefixes", []):
+            name = common_prefix["Prefix"][len(silver_prefix):].rstrip("/")
+            if name.startswith("EventDate="):
+                dates.add(name[len("EventDate="):])
+    return dates
+
+
+def read_event_files(paths, schema):
+    """Read tab-separated event files, keeping the lines that do not fit the schema in corrupt_column"""
+    return spark.read.csv(
+        paths, sep="\t", header=False, mode="PERMISSIVE",
+        schema=StructType(schema.fields + [StructField(corrupt_column, StringType(), True)]),
+        columnNameOfCorruptRecord=corrupt_column,
+    )
+
+
+def write_silver_layer(csv_keys):
+    """Convert unzipped event files into Parquet partitioned by event date
+
+    Daily exports and the older monthly/yearly files have different layouts, so
+    each is read with its own schema; lines that fit neither are counted and
+    dropped. A daily export also carries events dated days earlier, so the
+    partitions it touches are rewritten with their existing rows plus the new
+    ones, one file per partition. Rows previously loaded from files with the same
+    DATEADDED are replaced, so reprocessing a file does not append it again.
+    """
+    spark.conf.set("spark.sql.sources.partitionOverwriteMode", "dynamic")
+    silver_path = f"s3://{bucket}/{silver_prefix}"
+    daily_paths = [f"s3://{bucket}/{key}" for key in csv_keys if daily_file_pattern.search(key)]
+    historical_paths = [f"s3://{bucket}/{key}" for key in csv_keys if not daily_file_pattern.search(key)]
+
+    parts = []
+    if daily_paths:
+        parts.append(read_event_files(daily_paths, gdelt_event_schema))
+    if historical_paths:
+        parts.append(read_event_files(historical_paths, historical_event_schema).withColumn("SOURCEURL", lit(None).cast(StringType())))
+    events = parts[0]
+    for part in parts[1:]:
+        events = events.unionByName(part)
+    # Spark only lets the corrupt record column be queried on cached data
+    parsed = events.cache()
+    malformed = parsed.filter(col(corrupt_column).isNotNull()).count()
+    if malformed:
+        logger.warn(f"Dropped {malformed} malformed lines from {len(csv_keys)} files")
+    events = (
+        parsed.filter(col(corrupt_column).isNull())
+        .drop(corrupt_column)
+        .withColumn("EventDate", to_date(col("SQLDATE").cast("string"), "yyyyMMdd"))
+        .withColumn("AddedDate", to_date(col("DATEADDED").cast("string"), "yyyyMMdd"))
+        .filter(col("EventDate").isNotNull())
+    )
+
+    new_dates = {row["EventDate"].isoformat() for row in events.select("EventDate").distinct().collect()}
+    touched_dates = sorted(new_dates & existing_silver_dates())
+    rows = events
+    if touched_dates:
+        existing = (
+            spark.read.option("basePath", silver_path)
+            .parquet(*[f"{silver_path}EventDate={date}" for date in touched_dates])
+            .join(events.select("AddedDate").distinct(), "AddedDate", "left_anti")
+        )
+        rows = events.unionByName(existing.select(*events.columns))
+    # Materialized first, so the partitions being replaced are fully read before the write swaps them
+    rows = rows.localCheckpoint()
+    logger.info(f"Writing {len(new_dates)} event date partitions, {len(touched_dates)} of them merged with existing rows")
+    (
+        rows.repartition("EventDate")
+        .write.mode("overwrite")
+        .partitionBy("EventDate")
+        .option("compression", silver_compression)
+        .parquet(silver_path)
+    )
+    parsed.unpersist()
+
+
+if write_silver:
+    silver_keys = [filepath for result in results for filepath in result["uploaded"] if filepath.upper().endswith(".CSV")]
+    if silver_keys:
+        logger.info(f"Writing {len(silver_keys)} files to the silver layer with {silver_compression} compression")
+        write_silver_layer(silver_keys)
     else:
-        break
-
-if object_keys:
-    logger.info(f"Found {len(object_keys)} ZIP files in prefix '{prefix}'   {object_keys[0]}")
-else:
-    logger.info(f"No ZIP files found in prefix '{prefix}'")
-
-if unzipped_object_keys:
-    logger.info(f"Found {len(unzipped_object_keys)} unzipped files in prefix '{unzip_prefix}'   {unzipped_object_keys[0]}")
-else:
-    logger.info(f"No unzipped files found in prefix '{unzip_prefix}'")
-
-logger.info(f"Objects length {len(object_keys)}")
-logger.info(f"Unzipped objects length {len(unzipped_object_keys)}")
-
-for key in object_keys:
-    logger.info(f"Starting processing of file {key}")
-    obj = s3.get_object(Bucket=bucket, Key=key)
-    objbuffer = io.BytesIO(obj["Body"].read())
-    
-    with ZipFile(objbuffer) as zip:
-        filenames = zip.namelist()
-        for filename in filenames:
-            filepath = unzip_prefix + filename
-            if filepath not in unzipped_object_keys:
-                with zip.open(filename) as file:
-                    s3.upload_fileobj(file, bucket, filepath)
-                logger.info(f"Processed and uploaded {filename} to {filepath}")
+        logger.info("No new files for the silver layer")
+
+# Record fully processed archives only once their rows are in the silver layer too, so a
+# failed silver write makes the next run unzip and convert them again. Failed archives
+# stay out of the ledger and get a pending marker, which makes the next regular run list
+# their month again.
+# Concurrent backfill shards only share the ledger months at their boundaries, and a lost
+# entry there just means that archive is unzipped once more.
+changed_months = set()
+for result in results:
+    if result["success"]:
+        month = ledger_month(result["key"])
+        ledger[month][result["key"][len(prefix):]] = result["etag"]
+        changed_months.add(month)
+for month in sorted(changed_months):
+    save_ledger_month(month, ledger[month])
+
+# Markers are cleared for archives now recorded with their current ETag, and for listed-range
+# archives that no longer exist; anything else keeps (or gets) its marker
+listed_etags = {o["Key"][len(prefix):]: o["ETag"] for o in listed_objects}
+done_names = {
+    name for name in pending_names
+    if (name in listed_etags and ledger[ledger_month(prefix + name)].get(name) == listed_etags[name])
+    or (name not in listed_etags and (start_after is None or name > start_after) and (stop_after is None or name <= stop_after))
+}
+failed_names = {result["key"][len(prefix):] for result in failures}
+clear_pending(done_names - failed_names)
+mark_pending(failed_names - pending_names)
+logger.info(f"{len(done_names - failed_names)} pending archives done, {len(failed_names)} failed and left pending")
 
 logger.info("Finalizing the ZIP file processing job")
 job.commit()
@@ -0,0 +1,153 @@
+"""SQL for the weekly_country_metrics rollup.
+
+The rollup keeps one row per (country, week) with the metrics the forecasting and
+SOM training Lambdas used to aggregate from gdelt_event on every call. It is
+refreshed by redshift_load for the weeks touched by each load.
+"""
+
+import numpy as np
+
+ROLLUP_TABLE = 'weekly_country_metrics'
+
+# Metrics of the rollup, in the order the forecast and SOM feature vectors use them
+METRIC_COLUMNS = ['TotalMentions', 'TotalSources', 'TotalArticles', 'MedianAvgTone', 'MedianGoldsteinScale']
+
+# CAMEO root codes of the conflict-related events the risk model looks at
+EVENT_ROOT_CODES = "('6', '7', '13', '14', '15', '16', '17', '18', '19', '20')"
+
+# The medians stay DECIMAL so the Data API returns them as strings, like the original queries did
+CREATE_ROLLUP_SQL = f"""
+CREATE TABLE IF NOT EXISTS {ROLLUP_TABLE} (
+    country VARCHAR(8) NOT NULL,
+    Week DATE NOT NULL,
+    TotalMentions BIGINT,
+    TotalSources BIGINT,
+    TotalArticles BIGINT,
+    MedianAvgTone DECIMAL(18, 6),
+    MedianGoldsteinScale DECIMAL(18, 6)
+)
+DISTKEY(country)
+COMPOUND SORTKEY(country, Week);
+"""
+
+# Same aggregation as the former per-request queries, with the NTILE median
+# partitioned by (country, week) so every country is computed in one pass
+AGGREGATE_WEEKS_SQL = f"""
+SELECT
+    aggregated_data.country,
+    aggregated_data.Week,
+    aggregated_data.TotalMentions,
+    aggregated_data.TotalSources,
+    aggregated_data.TotalArticles,
+    median_data.AvgTone AS MedianAvgTone,
+    median_data.GoldsteinScale AS MedianGoldsteinScale
+FROM
+    (
+        SELECT
+            ActionGeo_CountryCode AS country,
+            DATE_TRUNC('week', TO_DATE(SQLDATE, 'YYYYMMDD'))::DATE AS Week,
+            SUM(NumMentions) AS TotalMentions,
+            SUM(NumSources) AS TotalSources,
+            SUM(NumArticles) AS TotalArticles
+        FROM
+            gdelt_event
+        WHERE
+            EventRootCode IN {EVENT_ROOT_CODES}
+            AND ActionGeo_CountryCode IS NOT NULL
+            AND DATE_TRUNC('week', TO_DATE(SQLDATE, 'YYYYMMDD'))::DATE IN (SELECT Week FROM rollup_weeks)
+        GROUP BY
+            1, 2
+    ) AS aggregated_data
+JOIN
+    (
+        SELECT
+            country,
+            Week,
+            AVG(AvgTone) AS AvgTone,
+            AVG(GoldsteinScale) AS GoldsteinScale
+        FROM (
+            SELECT
+                ActionGeo_CountryCode AS country,
+                DATE_TRUNC('week', TO_DATE(SQLDATE, 'YYYYMMDD'))::DATE AS Week,
+                AvgTone,
+                GoldsteinScale,
+                NTILE(2) OVER (PARTITION BY ActionGeo_CountryCode, DATE_TRUNC('week', TO_DATE(SQLDATE, 'YYYYMMDD')) ORDER BY AvgTone) AS tone_ntile,
+                NTILE(2) OVER (PARTITION BY ActionGeo_CountryCode, DATE_TRUNC('week', TO_DATE(SQLDATE, 'YYYYMMDD')) ORDER BY GoldsteinScale) AS goldstein_ntile
+            FROM
+                gdelt_event
+            WHERE
+                EventRootCode IN {EVENT_ROOT_CODES}
+                AND ActionGeo_CountryCode IS NOT NULL
+                AND DATE_TRUNC('week', TO_DATE(SQLDATE, 'YYYYMMDD'))::DATE IN (SELECT Week FROM rollup_weeks)
+        ) AS subquery
+        WHERE tone_ntile = 1 AND goldstein_ntile = 1
+        GROUP BY
+            country, Week
+    ) AS median_data
+ON
+    aggregated_data.country = median_data.country
+    AND aggregated_data.Week = median_data.Week
+"""
+
+# Weeks with events in the rows a merge load just inserted (the staging table after dedup)
+STAGED_WEEKS_SQL = "SELECT DISTINCT DATE_TRUNC('week', TO_DATE(SQLDATE, 'YYYYMMDD'))::DATE AS Week FROM gdelt_event_staging"
+
+# Countries with a weekly series, read from the rollup instead of scanning the fact table
+COUNTRIES_SQL = f"SELECT DISTINCT country FROM {ROLLUP_TABLE}"
+
+# Every week in the fact table, for rebuilding the rollup from scratch
+ALL_WEEKS_SQL = "SELECT DISTINCT DATE_TRUNC('week', TO_DATE(SQLDATE, 'YYYYMMDD'))::DATE AS Week FROM gdelt_event"
+
+
+def refresh_statements(weeks_sql):
+    """Statements that recompute the rollup rows of the weeks returned by weeks_sql
+
+    They create temp tables, so they must run in one session (a single
+    batch_execute_statement), ideally the same transaction as the load.
+    """
+    return [
+        CREATE_ROLLUP_SQL,
+        f"CREATE TEMP TABLE rollup_weeks AS {weeks_sql};",
+        f"DELETE FROM {ROLLUP_TABLE} USING rollup_weeks WHERE {ROLLUP_TABLE}.Week = rollup_weeks.Week;",
+        f"INSERT INTO {ROLLUP_TABLE} (country, Week, TotalMentions, TotalSources, TotalArticles, MedianAvgTone, MedianGoldsteinScale) {AGGREGATE_WEEKS_SQL};"
+    ]
+
+
+def weekly_series_sql(country_code=None, num_months=-2):
+    """Weekly metrics from the rollup since num_months before the current week, newest first"""
+    country_filter = f"AND country = '{country_code}'" if country_code is not None else ""
+    return f"""
+    SELECT Week, TotalMentions, TotalSources, TotalArticles, MedianAvgTone, MedianGoldsteinScale
+    FROM {ROLLUP_TABLE}
+    WHERE Week >= ADD_MONTHS(DATE_TRUNC('week', CURRENT_DATE), {num_months})
+    {country_filter}
+    ORDER BY Week DESC;
+    """
+
+
+def all_series_sql(num_months=-2):
+    """Weekly metrics of every country in one query, grouped by country and newest week first within each"""
+    return f"""
+    SELECT country, Week, TotalMentions, TotalSources, TotalArticles, MedianAvgTone, MedianGoldsteinScale
+    FROM {ROLLUP_TABLE}
+    WHERE Week >= ADD_MONTHS(DATE_TRUNC('week', CURRENT_DATE), {num_months})
+    ORDER BY country, Week DESC;
+    """
+
+
+def series_from_columns(columns):
+    """Map the decoded (lower-cased) columns of weekly_series_sql back to float arrays per metric"""
+    data = {'Week': [str(week).split(' ')[0] for week in columns.get('week', [])]}
+    for metric in METRIC_COLUMNS:
+        data[metric] = np.asarray(columns.get(metric.lower(), []), dtype=np.float64)
+    return data
+
+
+def series_by_country(columns):
+    """Split the decoded columns of all_series_sql into {country: series_from_columns(...)}"""
+    countries = columns.get('country', [])
+    series = {}
+    for country in dict.fromkeys(countries):
+        mask = countries == country
+        series[country] = series_from_columns({name: values[mask] for name, values in columns.items()})
+    return series
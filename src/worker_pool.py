@@ -0,0 +1,152 @@
+"""Worker processes that also start inside AWS Lambda, with a timeout per task.
+
+ProcessPoolExecutor and multiprocessing.Pool need POSIX semaphores, which Lambda
+cannot create because it has no /dev/shm. A multiprocessing.Process talking
+over a Pipe needs neither, so WorkerPool keeps one such process per worker and
+hands each one task at a time. A task's timeout therefore starts when a worker
+picks it up, not when it was queued, and a worker still busy when the timeout
+runs out is terminated and replaced, which stops the work instead of leaving it
+running. Where no process can be started at all, or a single worker is asked
+for, tasks run one after another in the calling process.
+"""
+
+import multiprocessing
+import os
+import time
+from multiprocessing.connection import wait
+
+
+def _serve(connection, initializer, initargs):
+    """Worker loop: run (function, item) tasks from the pipe until it closes or sends None"""
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        function, item = task
+        try:
+            outcome = (True, function(item))
+        except Exception as e:
+            outcome = (False, e)
+        try:
+            connection.send(outcome)
+        except Exception as e:
+            # The result or the exception could not be pickled
+            connection.send((False, RuntimeError(f"Task result could not be sent back: {e!r}")))
+
+
+class WorkerPool:
+    """A fixed set of worker processes running one task each at a time; use it as a context manager
+
+    `parallel` is False when the tasks run in the calling process, where a
+    running task cannot be interrupted and timeouts are not applied.
+    """
+
+    def __init__(self, max_workers=None, initializer=None, initargs=()):
+        self.max_workers = max_workers if max_workers is not None else os.cpu_count() or 1
+        self.initializer = initializer
+        self.initargs = initargs
+        self._workers = []
+        if self.max_workers > 1:
+            try:
+                for _ in range(self.max_workers):
+                    self._workers.append(self._start())
+            except OSError as e:
+                self.close()
+                print(f"Worker processes unavailable ({e}), running tasks in this process.")
+        if not self._workers and initializer is not None:
+            initializer(*initargs)
+
+    @property
+    def parallel(self):
+        return bool(self._workers)
+
+    def _start(self):
+        parent_end, child_end = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_serve, args=(child_end, self.initializer, self.initargs), daemon=True)
+        process.start()
+        child_end.close()
+        return process, parent_end
+
+    def _stop(self, worker):
+        process, connection = worker
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        connection.close()
+
+    def map(self, function, items, timeout=None, on_timeout=None):
+        """Results of function(item) for every item, in order
+
+        `function` must be picklable (a module-level function or a partial of
+        one). A task running longer than `timeout` seconds gets on_timeout(item)
+        as its result, or raises TimeoutError when there is no on_timeout. An
+        exception raised by a task is raised here.
+        """
+        items = list(items)
+        if not self._workers:
+            return [function(item) for item in items]
+
+        results = [None] * len(items)
+        pending = iter(enumerate(items))
+        # Worker slot -> (index, item, started) of the task it is running
+        running = {}
+
+        def dispatch(slot):
+            for index, item in pending:
+                self._workers[slot][1].send((function, item))
+                running[slot] = (index, item, time.monotonic())
+                return
+
+        for slot in range(len(self._workers)):
+            dispatch(slot)
+        while running:
+            wait_for = None
+            if timeout is not None:
+                oldest = min(started for _, _, started in running.values())
+                wait_for = max(0.0, oldest + timeout - time.monotonic())
+            ready = wait([self._workers[slot][1] for slot in running], wait_for)
+            for slot in list(running):
+                index, item, started = running[slot]
+                connection = self._workers[slot][1]
+                if connection in ready:
+                    try:
+                        ok, value = connection.recv()
+                    except EOFError:
+                        raise RuntimeError(f"Worker process exited with code {self._workers[slot][0].exitcode}")
+                    if not ok:
+                        raise value
+                elif timeout is not None and time.monotonic() - started >= timeout:
+                    self._stop(self._workers[slot])
+                    self._workers[slot] = self._start()
+                    if on_timeout is None:
+                        raise TimeoutError(f"Task exceeded {timeout}s")
+                    value = on_timeout(item)
+                else:
+                    continue
+                results[index] = value
+                del running[slot]
+                dispatch(slot)
+        return results
+
+    def close(self):
+        for _, connection in self._workers:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+        for worker in self._workers:
+            worker[0].join(timeout=1)
+            self._stop(worker)
+        self._workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False